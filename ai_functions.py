@@ -1,129 +1,410 @@
 # ai_functions.py
-import ollama
-import requests
 import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
+import clients
+from cache import TieredCache, open_store
+from geometry import encode_polyline, simplify
+from http_client import get_http_client
+from itinerary_edits import modify_itinerary
+from itinerary_parser import DayParser, parse_days
+from metrics import span, submit_with_context
+from prompt_builder import create_prompt_builder
+from llm_client import LLMClient, create_llm_cache, parse_keep_alive
+from llm_scheduler import PRIORITY_EDIT, PRIORITY_ITINERARY, PRIORITY_TIPS, AdmissionError, create_scheduler
+from route_planner import PlaceMatcher, plan_day
+from poi_store import PLACE_TYPE_TAGS, get_poi_store, places_from_overpass
+from singleflight import SingleFlight
 
 GEONAMES_USERNAME = os.getenv("GEONAMES_USERNAME")
 OPENROUTE_API_KEY = os.getenv("OPENROUTE_API_KEY")
-client = ollama.Client()
+# Responses for destination-only prompts such as travel tips are cached, and
+# every generation shares one admission-controlled queue in front of Ollama.
+# The model is kept loaded for LLM_KEEP_ALIVE after each call; the default
+# keeps it loaded for as long as Ollama runs.
+LLM_KEEP_ALIVE = parse_keep_alive(os.getenv("LLM_KEEP_ALIVE", "-1"))
+llm_scheduler = create_scheduler()
+client = LLMClient(clients.ollama_client, cache=create_llm_cache(), scheduler=llm_scheduler, keep_alive=LLM_KEEP_ALIVE)
 model = "AI-Planner"
+# Edit prompts, their token budget and the conversations kept between
+# consecutive edits of an itinerary
+edit_prompts = create_prompt_builder()
+
+# Loads the model at startup, before the server reports ready; LLM_WARMUP=0
+# skips it (the first generation then pays for the load)
+model_warmup = clients.ModelWarmup(
+    lambda: client.warm_up(model),
+    enabled=os.getenv("LLM_WARMUP", "1").lower() not in ("0", "false", "no")
+)
+
+# Geocoding cache: popular destinations dominate traffic, and place coordinates
+# practically never change, so a long TTL is safe. "Not found" results are
+# cached for a shorter time in case GeoNames picks the place up later.
+geocode_cache = TieredCache(
+    "geocode",
+    ttl=int(os.getenv("GEOCODE_CACHE_TTL", 30 * 24 * 3600)),
+    negative_ttl=int(os.getenv("GEOCODE_CACHE_NEGATIVE_TTL", 24 * 3600)),
+    max_entries=int(os.getenv("GEOCODE_CACHE_SIZE", 2048)),
+    store=open_store("geocode")
+)
+
+# Concurrent identical lookups (a trending destination) share one upstream call
+geocode_flights = SingleFlight("geocode")
+places_flights = SingleFlight("places")
+
+# Routes between the same two points rarely change; the full geometry is
+# cached and simplified per request
+route_cache = TieredCache(
+    "route",
+    ttl=int(os.getenv("ROUTE_CACHE_TTL", 7 * 24 * 3600)),
+    max_entries=int(os.getenv("ROUTE_CACHE_SIZE", 1024)),
+    store=open_store("route", max_entries=int(os.getenv("ROUTE_CACHE_STORE_SIZE", 20000)))
+)
+route_flights = SingleFlight("route")
+ROUTE_TOLERANCE_M = float(os.getenv("ROUTE_TOLERANCE_M", 10))
+
+# Independent stages of create_structured_itinerary run concurrently on this
+# pool. Each stage has its own timeout; a stage that misses it is replaced by
+# a partial result instead of failing the whole itinerary. The pool is
+# created on first use.
+_pipeline_executor = clients.LazyClient(lambda: ThreadPoolExecutor(
+    max_workers=int(os.getenv("PIPELINE_WORKERS", 32)),
+    thread_name_prefix="itinerary"
+))
+PLACES_TIMEOUT = float(os.getenv("PLACES_TIMEOUT", 15))
+ITINERARY_TIMEOUT = float(os.getenv("ITINERARY_TIMEOUT", 300))
+TIPS_TIMEOUT = float(os.getenv("TIPS_TIMEOUT", 60))
+ROUTING_TIMEOUT = float(os.getenv("ROUTING_TIMEOUT", 20))
+
+# Latencies of recent streamed itineraries, for get_stream_stats()
+_stream_metrics = deque(maxlen=1000)
+_stream_metrics_lock = threading.Lock()
+
+def normalize_place_name(place_name):
+    """Cache key for a place: case-insensitive with collapsed whitespace."""
+    return " ".join(str(place_name).casefold().replace(",", " ").split())
 
 def get_location_info(place_name):
     try:
-        response = requests.get(
-            "http://api.geonames.org/searchJSON",
-            params={"q": place_name, "maxRows": 1, "username": GEONAMES_USERNAME}
-        )
-        data = response.json()
-        if data["totalResultsCount"] > 0:
-            result = data["geonames"][0]
-            return {
-                "lat": result["lat"],
-                "lng": result["lng"],
-                "country": result.get("countryName", ""),
-                "timezone": result.get("timezone", {}).get("timeZoneId", ""),
-                "population": result.get("population", ""),
-                "name": result["name"]
-            }
-        return None
+        key = normalize_place_name(place_name)
+        location = geocode_flights.do(key, lambda: geocode_cache.get_or_load(
+            key,
+            lambda: _fetch_location_info(place_name)
+        ))
+        # Callers get their own copy so they can't modify the cached entry
+        return dict(location) if location else None
     except Exception as e:
         print(f"Error getting location info: {e}")
         return None
 
-# Add to ai_functions.py
-def get_places_of_interest(lat, lng, radius=5000, amenity_type=None):
-    """Get real places using OpenStreetMap Overpass API"""
-    url = "https://overpass-api.de/api/interpreter"
-    
-    query = f"""
+def get_geocode_cache_stats():
+    return geocode_cache.stats()
+
+def get_llm_cache_stats():
+    return client.site_stats()
+
+def get_scheduler_stats():
+    return llm_scheduler.stats()
+
+def get_edit_prompt_stats():
+    return edit_prompts.stats()
+
+def _fetch_location_info(place_name):
+    response = get_http_client("geonames").get(
+        "/searchJSON",
+        params={"q": place_name, "maxRows": 1, "username": GEONAMES_USERNAME}
+    )
+    response.raise_for_status()
+    return _location_from_geonames(response.json())
+
+def _location_from_geonames(data):
+    if data["totalResultsCount"] > 0:
+        result = data["geonames"][0]
+        return {
+            "lat": result["lat"],
+            "lng": result["lng"],
+            "country": result.get("countryName", ""),
+            "timezone": result.get("timezone", {}).get("timeZoneId", ""),
+            "population": result.get("population", ""),
+            "name": result["name"]
+        }
+    return None
+
+def build_overpass_query(lat, lng, radius, place_types=None):
+    """Overpass QL for the given place types, or every supported type if None.
+
+    Filtering by type in the query itself means Overpass only sends back the
+    elements we are going to use.
+    """
+    if place_types:
+        selectors = []
+        for tag in ("tourism", "amenity"):
+            values = [t for t in place_types if PLACE_TYPE_TAGS.get(t) == tag]
+            if len(values) == 1:
+                selectors.append(f'["{tag}"="{values[0]}"]')
+            elif values:
+                selectors.append(f'["{tag}"~"^({"|".join(values)})$"]')
+    else:
+        selectors = [
+            '["tourism"~"hotel|guesthouse|attraction"]',
+            '["amenity"~"restaurant|cafe|bar"]',
+        ]
+
+    clauses = "\n".join(
+        f"        {element}{selector}(around:{radius},{lat},{lng});"
+        for selector in selectors
+        for element in ("node", "way", "relation")
+    )
+    return f"""
     [out:json];
     (
-        node["tourism"~"hotel|guesthouse|attraction"](around:{radius},{lat},{lng});
-        way["tourism"~"hotel|guesthouse|attraction"](around:{radius},{lat},{lng});
-        relation["tourism"~"hotel|guesthouse|attraction"](around:{radius},{lat},{lng});
-        node["amenity"~"restaurant|cafe|bar"](around:{radius},{lat},{lng});
-        way["amenity"~"restaurant|cafe|bar"](around:{radius},{lat},{lng});
-        relation["amenity"~"restaurant|cafe|bar"](around:{radius},{lat},{lng});
+{clauses}
     );
     out center;
     """
-    
+
+def _query_overpass(lat, lng, radius, place_types=None):
+    response = get_http_client("overpass").post(
+        "/api/interpreter",
+        data={"data": build_overpass_query(lat, lng, radius, place_types)}
+    )
+    response.raise_for_status()
+    return places_from_overpass(response.json())
+
+def _query_places(lat, lng, radius, place_types=None, limit=None):
+    # Serve from the offline store when one is configured and covers the area
+    store = get_poi_store()
+    if store is not None and store.covers(float(lat), float(lng), radius):
+        return store.query(lat, lng, radius, place_types, limit=limit)
+
+    key = (round(float(lat), 5), round(float(lng), 5), radius, tuple(sorted(place_types or ())))
+    return places_flights.do(key, lambda: _query_overpass(lat, lng, radius, place_types))
+
+def get_places_by_type(lat, lng, radius=5000, place_types=None, limit=None):
+    """Fetch places once and partition them by type.
+
+    Returns a dict mapping each type to its places, e.g. {'hotel': [...],
+    'restaurant': [...]}. Pass `place_types` to restrict the Overpass query
+    to just those types, and `limit` to keep at most that many per type.
+    """
     try:
-        response = requests.post(url, data=query)
-        response.raise_for_status()
-        data = response.json()
-        
-        results = []
-        for element in data['elements']:
-            if 'tags' not in element:
-                continue
-                
-            result = {
-                'id': element['id'],
-                'name': element['tags'].get('name', 'Unnamed Location'),
-                'type': element['tags'].get('tourism') or element['tags'].get('amenity'),
-                'lat': element.get('lat'),
-                'lon': element.get('lon'),
-                'address': element['tags'].get('addr:street'),
-                'website': element['tags'].get('website'),
-                'phone': element['tags'].get('phone')
-            }
-            
-            if amenity_type and result['type'] != amenity_type:
-                continue
-                
-            results.append(result)
-            
-        return results
-        
+        places = _query_places(lat, lng, radius, place_types, limit)
     except Exception as e:
         print(f"Overpass API error: {e}")
-        return []
+        return {}
+    return _partition_places(places, place_types, limit)
 
-def get_route(start_coords, end_coords, profile='driving-car'):
-    """Optimized route fetching with OpenRouteService."""
-    url = f"https://api.openrouteservice.org/v2/directions/{profile}"
+def _partition_places(places, place_types, limit):
+    by_type = {}
+    for place in places:
+        if place_types and place['type'] not in place_types:
+            continue
+        of_type = by_type.setdefault(place['type'], [])
+        if limit is None or len(of_type) < limit:
+            of_type.append(place)
+    return by_type
 
-    headers = {
-        'Authorization': OPENROUTE_API_KEY,
-        'Accept': 'application/json'
-    }
-
-    params = {
-        'start': f"{start_coords[1]},{start_coords[0]}",
-        'end': f"{end_coords[1]},{end_coords[0]}",
-        'overview': 'simplified',  # Reduces response size
-        'geometry_simplify': 'true'
-    }
+def get_places_of_interest(lat, lng, radius=5000, amenity_type=None, server_filter=True):
+    """Get real places using OpenStreetMap Overpass API"""
+    # Types we don't know the Overpass tag for are still filtered locally
+    place_types = None
+    if server_filter and amenity_type in PLACE_TYPE_TAGS:
+        place_types = [amenity_type]
 
     try:
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
+        results = _query_places(lat, lng, radius, place_types)
+    except Exception as e:
+        print(f"Overpass API error: {e}")
+        return []
 
-        summary = data['routes'][0]['summary']
-        route_coords = data['routes'][0]['geometry']['coordinates']
+    if amenity_type:
+        results = [r for r in results if r['type'] == amenity_type]
+    return results
 
-        return {
-            'distance_km': round(summary['distance'] / 1000, 2),  # Convert to km
-            'duration_min': round(summary['duration'] / 60, 2),  # Convert to minutes
-            'route_points': [(lon, lat) for lon, lat in route_coords[::10]]  # Reduce points density
-        }
+def get_route(start_coords, end_coords, profile='driving-car', tolerance_m=ROUTE_TOLERANCE_M, encoding='points'):
+    """Route between two (lat, lng) points from OpenRouteService.
 
+    The geometry is simplified to within `tolerance_m` metres of the real
+    road (Douglas-Peucker) rather than keeping every tenth point. With
+    encoding='polyline' it is returned as an encoded polyline string in
+    'route_polyline' instead of a 'route_points' list of (lon, lat).
+    """
+    key = "{:.5f},{:.5f}|{:.5f},{:.5f}|{}".format(
+        float(start_coords[0]), float(start_coords[1]),
+        float(end_coords[0]), float(end_coords[1]), profile
+    )
+    try:
+        route = route_flights.do(key, lambda: route_cache.get_or_load(
+            key,
+            lambda: _fetch_route(start_coords, end_coords, profile)
+        ))
     except Exception as e:
         print(f"OpenRouteService error: {e}")
         return None
 
+    points = simplify(route['coordinates'], tolerance_m)
+    result = {
+        'distance_km': round(route['distance'] / 1000, 2),  # Convert to km
+        'duration_min': round(route['duration'] / 60, 2),  # Convert to minutes
+        'point_count': len(points)
+    }
+    if encoding == 'polyline':
+        result['route_polyline'] = encode_polyline(points)
+    else:
+        result['route_points'] = [(lon, lat) for lon, lat in points.tolist()]
+    return result
+
+def _fetch_route(start_coords, end_coords, profile):
+    # The GET endpoint answers with a GeoJSON FeatureCollection
+    response = get_http_client("openrouteservice").get(
+        f"/v2/directions/{profile}",
+        headers={
+            'Authorization': OPENROUTE_API_KEY,
+            'Accept': 'application/geo+json, application/json'
+        },
+        params={
+            'start': f"{start_coords[1]},{start_coords[0]}",
+            'end': f"{end_coords[1]},{end_coords[0]}"
+        }
+    )
+    response.raise_for_status()
+    feature = response.json()['features'][0]
+    summary = feature['properties']['summary']
+    # Full-resolution geometry is cached so any tolerance can be served from it
+    return {
+        'distance': summary.get('distance', 0),
+        'duration': summary.get('duration', 0),
+        'coordinates': [coord[:2] for coord in feature['geometry']['coordinates']]
+    }
+
 
-def create_structured_itinerary(user_info, location_info):
+def create_structured_itinerary(user_info, location_info, progress=None, places=None):
+    """Generate a structured day-by-day itinerary.
+
+    `progress`, if given, is called with "places", "generating", "routing"
+    and "tips" as the pipeline reaches each stage. `places`, if given, is
+    what get_places_by_type returned for the destination with no type
+    filter; batch requests look places up once per city and pass them in.
+    """
+    progress = progress or (lambda stage: None)
     arrival_date = parse_date(user_info['arrival_date'])
     duration = int(user_info['duration'])
     
     # Create a day-by-day itinerary structure
-    itinerary = {
+    itinerary = _new_itinerary(user_info, location_info, duration)
+    
+    # Travel tips only need the destination, so start them right away; they
+    # overlap with the place lookup and the main itinerary generation
+    tips_future = submit_with_context(_pipeline_executor, generate_travel_tips, user_info['destination'], location_info)
+
+    # One lookup gives both the hotels and restaurants for the prompt and
+    # every place the model might send travellers to, for routing later
+    progress("places")
+    if places is None:
+        with span("place_lookup"):
+            places = _lookup_places(location_info)
+    hotels, restaurants = _prompt_places(places)
+    activity_prompt = _build_activity_prompt(user_info, duration, hotels, restaurants)
+    
+    # Get AI response for the structured itinerary
+    progress("generating")
+    itinerary_future = submit_with_context(
+        _pipeline_executor, client.generate, model=model, prompt=activity_prompt, priority=PRIORITY_ITINERARY
+    )
+    # A saturated model host is reported to the caller rather than hidden
+    # behind the fallback itinerary
+    ai_response = _stage_result(
+        itinerary_future, ITINERARY_TIMEOUT, None, "Itinerary generation", reraise=(AdmissionError,)
+    )
+    
+    # Process and structure the AI response
+    try:
+        if ai_response is None:
+            raise ValueError("no response from the model")
+
+        with span("parse"):
+            itinerary["days"] = parse_days(ai_response.response, arrival_date)
+    
+    except Exception as e:
+        print(f"Error processing AI response: {e}")
+        # Fallback to a simpler structure
+        itinerary["days"] = _fallback_days(duration, arrival_date)
+
+    progress("routing")
+    route_places = [place for of_type in places.values() for place in of_type]
+    with span("routing"):
+        _plan_routes(itinerary["days"], route_places)
+    
+    # Add travel tips based on location
+    progress("tips")
+    itinerary["travel_tips"] = _stage_result(tips_future, TIPS_TIMEOUT, [], "Travel tips")
+    
+    return itinerary
+
+def stream_structured_itinerary(user_info, location_info):
+    """Streaming variant of create_structured_itinerary.
+
+    Yields (event, data) pairs while the model is still generating:
+      ("itinerary", trip)  trip details, before any days exist
+      ("day", day)         each day as soon as its DAY block is complete
+      ("tips", tips)       general travel tips
+      ("complete", {"itinerary": ..., "metrics": ...})
+    """
+    started = time.perf_counter()
+    arrival_date = parse_date(user_info['arrival_date'])
+    duration = int(user_info['duration'])
+
+    itinerary = _new_itinerary(user_info, location_info, duration)
+    yield "itinerary", {key: value for key, value in itinerary.items() if key != "days"}
+
+    tips_future = submit_with_context(_pipeline_executor, generate_travel_tips, user_info['destination'], location_info)
+    hotels, restaurants = _prompt_places(_lookup_places(location_info))
+    activity_prompt = _build_activity_prompt(user_info, duration, hotels, restaurants)
+
+    first_day_at = None
+    try:
+        chunks = client.generate(model=model, prompt=activity_prompt, stream=True, priority=PRIORITY_ITINERARY)
+        for day in _parse_stream(chunks, DayParser(arrival_date)):
+            if first_day_at is None:
+                first_day_at = time.perf_counter()
+            itinerary["days"].append(day)
+            yield "day", day
+    except AdmissionError:
+        raise
+    except Exception as e:
+        print(f"Error streaming AI response: {e}")
+
+    # Days already sent stay as they are; only fill in if nothing came through
+    if not itinerary["days"]:
+        for day in _fallback_days(duration, arrival_date):
+            itinerary["days"].append(day)
+            yield "day", day
+
+    itinerary["travel_tips"] = _stage_result(tips_future, TIPS_TIMEOUT, [], "Travel tips")
+    yield "tips", itinerary["travel_tips"]
+
+    finished = time.perf_counter()
+    metrics = {
+        "time_to_first_day_ms": round(((first_day_at or finished) - started) * 1000, 1),
+        "total_ms": round((finished - started) * 1000, 1),
+        "days": len(itinerary["days"])
+    }
+    _record_stream_metrics(metrics)
+    yield "complete", {"itinerary": itinerary, "metrics": metrics}
+
+def _parse_stream(chunks, parser):
+    """Days from a streamed response, each yielded as soon as it is complete."""
+    for chunk in chunks:
+        yield from parser.feed(chunk.response)
+    yield from parser.close()
+
+def _new_itinerary(user_info, location_info, duration):
+    return {
         "destination": str(user_info['destination']),
         "country": str(location_info.get('country', '')),
         "budget": str(user_info['budget']),
@@ -133,24 +414,36 @@ def create_structured_itinerary(user_info, location_info):
         "accommodation": str(user_info['shelter']),
         "days": []
     }
-    
-    # Generate activities based on user preferences
-    activities = user_info['activities'].split(',')
-
-        # Get real hotels
-    hotels = get_places_of_interest(
-        location_info['lat'], 
-        location_info['lng'],
-        amenity_type='hotel'
-    )[:3]  # Get top 3 hotels
-    
-    # Get real restaurants
-    restaurants = get_places_of_interest(
-        location_info['lat'],
-        location_info['lng'],
-        amenity_type='restaurant'
-    )[:5]  # Get top 5 restaurants
-    
+
+def _lookup_places(location_info):
+    """Every place near the destination by type, from a single Overpass query."""
+    if not (location_info.get('lat') and location_info.get('lng')):
+        return {}
+    places_future = submit_with_context(
+        _pipeline_executor, get_places_by_type, location_info['lat'], location_info['lng']
+    )
+    return _stage_result(places_future, PLACES_TIMEOUT, {}, "Place lookup")
+
+def _prompt_places(places):
+    """Real hotels and restaurants to mention in the itinerary prompt."""
+    return places.get('hotel', [])[:3], places.get('restaurant', [])[:5]
+
+def _plan_routes(days, places):
+    """Reorder each day's stops and attach travel times, all days in parallel.
+
+    Days whose planning fails or runs past ROUTING_TIMEOUT keep the order the
+    model gave them.
+    """
+    if not places:
+        return
+    matcher = PlaceMatcher(places)
+    futures = [submit_with_context(_pipeline_executor, plan_day, day, matcher) for day in days]
+    deadline = time.monotonic() + ROUTING_TIMEOUT
+    for index, future in enumerate(futures):
+        remaining = max(deadline - time.monotonic(), 0)
+        days[index] = _stage_result(future, remaining, days[index], f"Routing day {days[index]['day_number']}")
+
+def _build_activity_prompt(user_info, duration, hotels, restaurants):
     # Create a prompt for the AI model to generate detailed day plans
     activity_prompt = f"""
     Create a {duration}-day travel itinerary for {user_info['destination']} with a budget of {user_info['budget']}.
@@ -200,113 +493,74 @@ def create_structured_itinerary(user_info, location_info):
     
     ESTIMATED DAILY COST: [amount]
     """
-    
-    # Get AI response for the structured itinerary
-    ai_response = client.generate(model=model, prompt=activity_prompt)
-    
-    # Process and structure the AI response
+    return activity_prompt
+
+def _fallback_days(duration, arrival_date):
+    days = []
+    for i in range(1, duration + 1):
+        current_date = arrival_date + timedelta(days=i-1)
+        day_info = {
+            "day_number": i,
+            "date": current_date.strftime("%A, %B %d, %Y"),
+            "activities": {
+                "morning": ["Explore local attractions"],
+                "afternoon": ["Enjoy local cuisine"],
+                "evening": ["Relax and experience local culture"]
+            },
+            "estimated_cost": "Varies"
+        }
+        days.append(day_info)
+    return days
+
+def _record_stream_metrics(metrics):
+    with _stream_metrics_lock:
+        _stream_metrics.append((metrics["time_to_first_day_ms"], metrics["total_ms"]))
+
+def get_stream_stats():
+    """Time-to-first-day and total latency percentiles over recent streams."""
+    with _stream_metrics_lock:
+        samples = list(_stream_metrics)
+    if not samples:
+        return {"count": 0}
+
+    def percentile(values, pct):
+        values = sorted(values)
+        return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+    first_day = [sample[0] for sample in samples]
+    total = [sample[1] for sample in samples]
+    return {
+        "count": len(samples),
+        "time_to_first_day_ms": {"p50": percentile(first_day, 50), "p95": percentile(first_day, 95)},
+        "total_ms": {"p50": percentile(total, 50), "p95": percentile(total, 95)}
+    }
+
+def _stage_result(future, timeout, fallback, stage, reraise=()):
+    """Wait for a pipeline stage, returning `fallback` if it times out or fails.
+
+    Exceptions listed in `reraise` are passed on to the caller instead.
+    """
     try:
-        # Split the response by days
-        day_sections = ai_response.response.split("DAY ")
-        
-        # Process each day section
-        for i in range(1, len(day_sections)):
-            day_content = day_sections[i].strip()
-            current_date = arrival_date + timedelta(days=i-1)
-            
-            # Extract day information
-            day_parts = {}
-            
-            # Try to parse the structured content
-            if "MORNING:" in day_content:
-                morning_content = day_content.split("MORNING:")[1].split("AFTERNOON:")[0].strip()
-                day_parts["morning"] = [item.strip() for item in morning_content.split("\n- ") if item.strip()]
-            
-            if "AFTERNOON:" in day_content:
-                afternoon_content = day_content.split("AFTERNOON:")[1].split("EVENING:")[0].strip()
-                day_parts["afternoon"] = [item.strip() for item in afternoon_content.split("\n- ") if item.strip()]
-            
-            if "EVENING:" in day_content:
-                evening_section = day_content.split("EVENING:")[1]
-                evening_end = None
-                
-                # Find where the evening section ends
-                for possible_end in ["DAILY TIPS:", "ESTIMATED DAILY COST:", "DAY "]:
-                    if possible_end in evening_section:
-                        if evening_end is None or evening_section.find(possible_end) < evening_section.find(evening_end):
-                            evening_end = possible_end
-                
-                # Extract evening content
-                if evening_end:
-                    evening_content = evening_section.split(evening_end)[0].strip()
-                else:
-                    evening_content = evening_section.strip()
-                
-                # Process the evening activities
-                evening_activities = []
-                for line in evening_content.split("\n"):
-                    line = line.strip()
-                    if line.startswith("-") or line.startswith("*"):
-                        evening_activities.append(line[1:].strip())
-                    elif line and not line.startswith("**") and "Food recommendation:" not in line:
-                        # Catch any non-empty lines that don't start with list markers
-                        evening_activities.append(line)
-                
-                # Filter out empty lines and duplicates
-                evening_activities = [item for item in evening_activities if item.strip()]
-                day_parts["evening"] = evening_activities
-            
-            if "DAILY TIPS:" in day_content:
-                tips_section = day_content.split("DAILY TIPS:")[1]
-                if "ESTIMATED DAILY COST:" in tips_section:
-                    tips_content = tips_section.split("ESTIMATED DAILY COST:")[0].strip()
-                else:
-                    tips_content = tips_section.strip()
-                day_parts["tips"] = [item.strip() for item in tips_content.split("\n- ") if item.strip()]
-            
-            # Try to extract cost estimate
-            cost_estimate = ""
-            if "ESTIMATED DAILY COST:" in day_content:
-                cost_parts = day_content.split("ESTIMATED DAILY COST:")[1].strip().split("\n")[0]
-                cost_estimate = cost_parts.strip()
-            
-            # Create the day structure
-            day_info = {
-                "day_number": i,
-                "date": current_date.strftime("%A, %B %d, %Y"),
-                "activities": day_parts,
-                "estimated_cost": cost_estimate
-            }
-            
-            # Add the day to the itinerary
-            itinerary["days"].append(day_info)
-    
+        return future.result(timeout=timeout)
+    except reraise:
+        raise
+    except FutureTimeoutError:
+        print(f"{stage} timed out after {timeout}s, continuing without it")
     except Exception as e:
-        print(f"Error processing AI response: {e}")
-        # Fallback to a simpler structure
-        for i in range(1, duration + 1):
-            current_date = arrival_date + timedelta(days=i-1)
-            day_info = {
-                "day_number": i,
-                "date": current_date.strftime("%A, %B %d, %Y"),
-                "activities": {
-                    "morning": ["Explore local attractions"],
-                    "afternoon": ["Enjoy local cuisine"],
-                    "evening": ["Relax and experience local culture"]
-                },
-                "estimated_cost": "Varies"
-            }
-            itinerary["days"].append(day_info)
-    
-    # Add travel tips based on location
-    itinerary["travel_tips"] = generate_travel_tips(user_info['destination'], location_info)
-    
-    return itinerary
-
+        print(f"{stage} failed: {e}")
+    return fallback
 
 
 def generate_travel_tips(destination, location_info):
-    tip_prompt = f"""
+    # The prompt only depends on the destination, so every traveller going
+    # to the same city can share one answer
+    tip_response = client.generate(
+        model=model, prompt=_tips_prompt(destination, location_info), cache_site="travel_tips", priority=PRIORITY_TIPS
+    )
+    return _parse_tips(tip_response.response)
+
+def _tips_prompt(destination, location_info):
+    return f"""
     Provide 5 essential travel tips for visiting {destination}, {location_info.get('country', '')}.
     Include information about:
     1. Local transportation
@@ -317,17 +571,34 @@ def generate_travel_tips(destination, location_info):
     
     Format each tip with a title and brief description.
     """
-    
-    tip_response = client.generate(model=model, prompt=tip_prompt)
-    
-    # Process the tips
+
+def _parse_tips(text):
     tips = []
-    for line in tip_response.response.split("\n"):
+    for line in text.split("\n"):
         if line.strip():
             tips.append(line.strip())
-    
     return tips
 
+def get_ai_response(prompt, priority=PRIORITY_EDIT, **kwargs):
+    """Plain text answer to a free-form prompt, e.g. an itinerary edit."""
+    response = client.generate(model=model, prompt=prompt, priority=priority, **kwargs)
+    return response.response
+
+def apply_modification(itinerary, modification, itinerary_id=None, version=None):
+    """Edit an itinerary by regenerating only the days and sections a request touches.
+
+    With the itinerary's id and version, consecutive edits continue one
+    conversation with the model. Returns (updated_itinerary, patch); see
+    itinerary_edits.modify_itinerary.
+    """
+    return modify_itinerary(
+        itinerary, modification,
+        lambda prompt, context: client.generate(
+            model=model, prompt=prompt, priority=PRIORITY_EDIT, format="json", context=context
+        ),
+        edit_prompts, itinerary_id, version
+    )
+
 def parse_date(date_string):
     try:
         return datetime.strptime(date_string, "%m/%d/%Y")
@@ -0,0 +1,185 @@
+# ai_functions_async.py
+"""Coroutine versions of the ai_functions pipeline, for asgi_server.
+
+Prompts, parsing, caches and fallbacks are the ones ai_functions uses;
+only the waiting is different. Every call to GeoNames, Overpass,
+OpenRouteService and Ollama goes through an async client, so a request
+that is waiting on one of them holds a suspended coroutine, not a thread.
+"""
+import asyncio
+
+import clients
+from ai_functions import (GEONAMES_USERNAME, ITINERARY_TIMEOUT, LLM_KEEP_ALIVE, PLACES_TIMEOUT, ROUTING_TIMEOUT,
+                          TIPS_TIMEOUT, _build_activity_prompt, _fallback_days, _location_from_geonames, _new_itinerary,
+                          _parse_tips, _partition_places, _prompt_places, _tips_prompt, build_overpass_query,
+                          edit_prompts, geocode_cache, model, model_warmup, normalize_place_name, parse_date)
+from ai_functions import client as sync_client
+from http_client import get_async_http_client
+from itinerary_edits import modify_itinerary_async
+from itinerary_parser import parse_days
+from llm_client import AsyncLLMClient
+from llm_scheduler import (PRIORITY_EDIT, PRIORITY_ITINERARY, PRIORITY_TIPS, AdmissionError,
+                           AsyncGenerationScheduler, create_scheduler)
+from metrics import span
+from poi_store import get_poi_store, places_from_overpass
+from route_planner import PlaceMatcher, plan_day_async
+from singleflight import AsyncSingleFlight
+
+# The response cache is shared with the threaded client, so answers cached
+# by either server are reused by the other
+llm_scheduler = create_scheduler(AsyncGenerationScheduler)
+client = AsyncLLMClient(clients.async_ollama_client, cache=sync_client.cache, scheduler=llm_scheduler,
+                        keep_alive=LLM_KEEP_ALIVE)
+
+geocode_flights = AsyncSingleFlight("geocode_async")
+places_flights = AsyncSingleFlight("places_async")
+
+
+async def get_location_info(place_name):
+    try:
+        key = normalize_place_name(place_name)
+        location = await geocode_flights.do(key, lambda: geocode_cache.get_or_load_async(
+            key,
+            lambda: _fetch_location_info(place_name)
+        ))
+        # Callers get their own copy so they can't modify the cached entry
+        return dict(location) if location else None
+    except Exception as e:
+        print(f"Error getting location info: {e}")
+        return None
+
+
+async def _fetch_location_info(place_name):
+    response = await get_async_http_client("geonames").get(
+        "/searchJSON",
+        params={"q": place_name, "maxRows": 1, "username": GEONAMES_USERNAME}
+    )
+    response.raise_for_status()
+    return _location_from_geonames(response.json())
+
+
+async def _query_overpass(lat, lng, radius, place_types=None):
+    response = await get_async_http_client("overpass").post(
+        "/api/interpreter",
+        data={"data": build_overpass_query(lat, lng, radius, place_types)}
+    )
+    response.raise_for_status()
+    return places_from_overpass(response.json())
+
+
+async def _query_places(lat, lng, radius, place_types=None, limit=None):
+    store = get_poi_store()
+    if store is not None and store.covers(float(lat), float(lng), radius):
+        return store.query(lat, lng, radius, place_types, limit=limit)
+
+    key = (round(float(lat), 5), round(float(lng), 5), radius, tuple(sorted(place_types or ())))
+    return await places_flights.do(key, lambda: _query_overpass(lat, lng, radius, place_types))
+
+
+async def get_places_by_type(lat, lng, radius=5000, place_types=None, limit=None):
+    """See ai_functions.get_places_by_type."""
+    try:
+        places = await _query_places(lat, lng, radius, place_types, limit)
+    except Exception as e:
+        print(f"Overpass API error: {e}")
+        return {}
+    return _partition_places(places, place_types, limit)
+
+
+async def create_structured_itinerary(user_info, location_info):
+    """Generate a structured day-by-day itinerary; see ai_functions.create_structured_itinerary."""
+    arrival_date = parse_date(user_info['arrival_date'])
+    duration = int(user_info['duration'])
+    itinerary = _new_itinerary(user_info, location_info, duration)
+
+    # Tips overlap with generation; one place lookup serves both the prompt
+    # and routing
+    tips_task = asyncio.create_task(generate_travel_tips(user_info['destination'], location_info))
+    try:
+        with span("place_lookup"):
+            places = await _lookup_places(location_info)
+        hotels, restaurants = _prompt_places(places)
+        activity_prompt = _build_activity_prompt(user_info, duration, hotels, restaurants)
+
+        ai_response = await _stage_result(
+            client.generate(model=model, prompt=activity_prompt, priority=PRIORITY_ITINERARY),
+            ITINERARY_TIMEOUT, None, "Itinerary generation", reraise=(AdmissionError,)
+        )
+        try:
+            if ai_response is None:
+                raise ValueError("no response from the model")
+            with span("parse"):
+                itinerary["days"] = parse_days(ai_response.response, arrival_date)
+        except Exception as e:
+            print(f"Error processing AI response: {e}")
+            itinerary["days"] = _fallback_days(duration, arrival_date)
+
+        route_places = [place for of_type in places.values() for place in of_type]
+        with span("routing"):
+            itinerary["days"] = await _plan_routes(itinerary["days"], route_places)
+
+        itinerary["travel_tips"] = await _stage_result(tips_task, TIPS_TIMEOUT, [], "Travel tips")
+    except BaseException:
+        tips_task.cancel()
+        raise
+    return itinerary
+
+
+async def _lookup_places(location_info):
+    """See ai_functions._lookup_places."""
+    if not (location_info.get('lat') and location_info.get('lng')):
+        return {}
+    return await _stage_result(
+        get_places_by_type(location_info['lat'], location_info['lng']), PLACES_TIMEOUT, {}, "Place lookup"
+    )
+
+
+async def _plan_routes(days, places):
+    """Every day routed concurrently; a day that fails or times out keeps its order."""
+    if not places:
+        return days
+    matcher = PlaceMatcher(places)
+    return list(await asyncio.gather(*(
+        _stage_result(plan_day_async(day, matcher), ROUTING_TIMEOUT, day, f"Routing day {day['day_number']}")
+        for day in days
+    )))
+
+
+async def _stage_result(awaitable, timeout, fallback, stage, reraise=()):
+    """Await a pipeline stage, returning `fallback` if it times out or fails."""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except reraise:
+        raise
+    except asyncio.TimeoutError:
+        print(f"{stage} timed out after {timeout}s, continuing without it")
+    except Exception as e:
+        print(f"{stage} failed: {e}")
+    return fallback
+
+
+async def generate_travel_tips(destination, location_info):
+    tip_response = await client.generate(
+        model=model, prompt=_tips_prompt(destination, location_info), cache_site="travel_tips", priority=PRIORITY_TIPS
+    )
+    return _parse_tips(tip_response.response)
+
+
+async def get_ai_response(prompt, priority=PRIORITY_EDIT, **kwargs):
+    response = await client.generate(model=model, prompt=prompt, priority=priority, **kwargs)
+    return response.response
+
+
+async def apply_modification(itinerary, modification, itinerary_id=None, version=None):
+    """See ai_functions.apply_modification."""
+    return await modify_itinerary_async(
+        itinerary, modification,
+        lambda prompt, context: client.generate(
+            model=model, prompt=prompt, priority=PRIORITY_EDIT, format="json", context=context
+        ),
+        edit_prompts, itinerary_id, version
+    )
+
+
+def get_scheduler_stats():
+    return llm_scheduler.stats()
@@ -0,0 +1,389 @@
+# asgi_server.py
+"""The itinerary API as an ASGI app, for serving many slow requests at once.
+
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5000
+    python asgi_server.py
+
+Covers the routes the Svelte app uses (itinerary create/get/update, auth
+and gather_info) with the same paths and response bodies as server.py,
+plus /metrics and the LLM stats. Every upstream call goes through an
+async client (httpx.AsyncClient, ollama.AsyncClient and the async
+Supabase client), so a request waiting on the model or an API costs a
+coroutine rather than a thread.
+
+Itineraries are always generated while the request waits; ?async=1 job
+submission and the SSE stream are only served by server.py.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from supabase import acreate_client
+
+import clients
+import metrics
+import storage_codec
+from ai_functions import get_edit_prompt_stats
+from ai_functions_async import (apply_modification, create_structured_itinerary, get_location_info,
+                                get_scheduler_stats, model_warmup)
+from cache import MISSING, LRUCache
+from http_client import close_async_http_clients
+from itinerary_edits import EditError, InvalidEditTarget
+from itinerary_store import AsyncItineraryStore, VersionConflict, create_itinerary_store
+from llm_scheduler import AdmissionError
+from log_shipper import create_log_handler
+from metrics import span
+from prompt_builder import PromptTooLarge
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+REQUIRED_FIELDS = ['destination', 'budget', 'arrival_date', 'duration', 'people', 'shelter', 'activities']
+
+# Created on startup, since the async client has to be made inside the event loop
+supabase = None
+itinerary_store = None
+
+# Log shipping runs on its own thread, so it uses the shared blocking client.
+# It is attached and started on startup.
+log_handler = create_log_handler(clients.supabase)
+
+
+def log_to_supabase(log_message, level=logging.ERROR):
+    """Log at `level`; records at or above LOG_SHIP_LEVEL are shipped."""
+    logging.log(level, log_message)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global supabase, itinerary_store
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    itinerary_store = create_itinerary_store(supabase, AsyncItineraryStore)
+    logging.getLogger().addHandler(log_handler)
+    log_handler.start()
+    # Loads in the background; /ready reports when it's done
+    model_warmup.start()
+    yield
+    await close_async_http_clients()
+    logging.getLogger().removeHandler(log_handler)
+    await asyncio.to_thread(log_handler.close)
+
+
+def error(message, status):
+    return JSONResponse({"error": message}, status_code=status)
+
+
+def failure(message, status, headers=None):
+    # The itinerary and gather_info routes report errors in this shape
+    return JSONResponse({"status": "error", "message": message}, status_code=status, headers=headers)
+
+
+def model_busy(retry_after):
+    return failure("The itinerary model is busy, please retry shortly", 429, {"Retry-After": str(retry_after)})
+
+
+async def request_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def health_check(request):
+    return JSONResponse({"status": "healthy", "message": "API is running"})
+
+
+async def readiness_check(request):
+    # As in server.py
+    model_warmup.start()
+    status = model_warmup.status()
+    if model_warmup.ready:
+        return JSONResponse({"status": "ready", "model": status})
+    return JSONResponse({"status": "not_ready", "model": status}, status_code=503)
+
+
+async def signup(request):
+    try:
+        data = await request.json()
+        response = await supabase.auth.sign_up({"email": data['email'], "password": data['password']})
+        return JSONResponse({
+            "status": "success",
+            "user": response.user.model_dump(mode="json"),
+            "session": response.session.model_dump(mode="json")
+        })
+    except Exception as e:
+        return error(str(e), 400)
+
+
+async def login(request):
+    try:
+        data = await request.json()
+        response = await supabase.auth.sign_in_with_password({"email": data['email'], "password": data['password']})
+        return JSONResponse({
+            "status": "success",
+            "user": response.user.model_dump(mode="json"),
+            "session": response.session.model_dump(mode="json")
+        })
+    except Exception:
+        return error("Invalid credentials", 401)
+
+
+async def logout(request):
+    try:
+        await supabase.auth.sign_out()
+        return JSONResponse({"status": "success"})
+    except Exception as e:
+        return error(str(e), 400)
+
+
+async def get_session(request):
+    try:
+        session = await supabase.auth.get_session()
+        return JSONResponse({
+            "status": "success",
+            "user": session.user.model_dump(mode="json") if session else None
+        })
+    except Exception as e:
+        return error(str(e), 400)
+
+
+async def gather_user_info(request):
+    data = await request_json(request)
+    if data:
+        log_to_supabase("User info gathered", logging.INFO)
+        return JSONResponse({"status": "success", "message": "User info gathered successfully"})
+    log_to_supabase("Failed to gather user info", logging.INFO)
+    return failure("Failed to gather user info", 400)
+
+
+async def generate_itinerary(request):
+    try:
+        user_info = json.loads(await request.body())
+    except ValueError as e:
+        return failure(f"Invalid JSON: {e}", 400)
+    if not user_info:
+        return failure("No user information provided", 400)
+    for field in REQUIRED_FIELDS:
+        if field not in user_info or not user_info[field]:
+            return failure(f"Missing required field: {field}", 400)
+
+    try:
+        with span("geocode"):
+            location_info = await get_location_info(user_info['destination'])
+        if not location_info:
+            log_to_supabase(f"Location info fetch failed for: {user_info['destination']}", logging.INFO)
+            location_info = {"name": user_info['destination']}
+
+        try:
+            itinerary_data = await create_structured_itinerary(user_info, location_info)
+        except AdmissionError:
+            raise
+        except Exception as e:
+            error_msg = f"Failed to create itinerary: {str(e)}"
+            log_to_supabase(error_msg)
+            return failure(error_msg, 500)
+
+        try:
+            with span("supabase_insert"):
+                itinerary_id = await itinerary_store.create(itinerary_data)
+        except Exception as e:
+            error_msg = f"Failed to store itinerary in Supabase: {str(e)}"
+            log_to_supabase(error_msg)
+            return failure(error_msg, 500)
+
+        return JSONResponse({"status": "success", "id": itinerary_id, "itinerary": itinerary_data})
+    except AdmissionError as e:
+        return model_busy(e.retry_after)
+    except Exception as e:
+        error_msg = f"Unexpected error creating itinerary: {str(e)}"
+        log_to_supabase(error_msg)
+        return failure(error_msg, 500)
+
+
+# Serialized GET responses and update markers, as in server.py
+itinerary_cache = LRUCache(max_entries=int(os.getenv("ITINERARY_CACHE_SIZE", 1000)))
+ITINERARY_CACHE_TTL = int(os.getenv("ITINERARY_CACHE_TTL", 300))
+_itinerary_updates = LRUCache(max_entries=int(os.getenv("ITINERARY_CACHE_SIZE", 1000)))
+ITINERARY_UPDATE_MARKER_TTL = 60
+_itinerary_cache_lock = threading.Lock()
+
+
+def invalidate_itinerary(itinerary_id):
+    with _itinerary_cache_lock:
+        _itinerary_updates.set(itinerary_id, object(), ITINERARY_UPDATE_MARKER_TTL)
+        itinerary_cache.delete(itinerary_id)
+
+
+def itinerary_etag(itinerary_id, version, body):
+    """See server.itinerary_etag."""
+    return f"{itinerary_id}-v{version}" if version else hashlib.sha256(body).hexdigest()
+
+
+def itinerary_response(request, body, etag):
+    quoted = f'"{etag}"'
+    headers = {"ETag": f"W/{quoted}", "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or quoted in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def get_itinerary(request):
+    itinerary_id = request.path_params["itinerary_id"]
+    try:
+        cached = itinerary_cache.get(itinerary_id)
+        if cached is not MISSING:
+            return itinerary_response(request, *cached)
+        with _itinerary_cache_lock:
+            last_update = _itinerary_updates.get(itinerary_id)
+
+        with span("supabase_fetch"):
+            response = await supabase.table('itineraries').select(
+                'itinerary_data::text, version'
+            ).eq('id', itinerary_id).execute()
+        if not response.data:
+            return error("Itinerary not found", 404)
+
+        body = storage_codec.to_json(response.data[0]['itinerary_data'])
+        etag = itinerary_etag(itinerary_id, response.data[0].get('version'), body)
+        with _itinerary_cache_lock:
+            if _itinerary_updates.get(itinerary_id) is last_update:
+                itinerary_cache.set(itinerary_id, (body, etag), ITINERARY_CACHE_TTL)
+        return itinerary_response(request, body, etag)
+    except Exception as e:
+        error_msg = f"Error retrieving itinerary: {str(e)}"
+        log_to_supabase(error_msg)
+        return error(error_msg, 500)
+
+
+async def update_itinerary(request):
+    itinerary_id = request.path_params["itinerary_id"]
+    try:
+        if not request.headers.get('Authorization'):
+            return error("Missing authorization header", 401)
+        try:
+            session = await supabase.auth.get_session()
+            if not session:
+                return error("Invalid session", 401)
+        except Exception as auth_error:
+            return error(f"Auth verification failed: {str(auth_error)}", 401)
+
+        data = await request_json(request)
+        if not data or 'modification' not in data:
+            return error("No modification specified", 400)
+
+        try:
+            current_itinerary, version = await itinerary_store.load(itinerary_id)
+            if current_itinerary is None:
+                return error("Itinerary not found", 404)
+        except json.JSONDecodeError as parse_error:
+            return error(f"Stored itinerary is invalid: {str(parse_error)}", 400)
+        except Exception as fetch_error:
+            log_to_supabase(f"Fetch error: {str(fetch_error)}")
+            return error("Database error", 500)
+
+        try:
+            with span("edit"):
+                updated_itinerary, patch = await apply_modification(current_itinerary, data['modification'],
+                                                                    itinerary_id, version)
+        except AdmissionError as e:
+            return model_busy(e.retry_after)
+        except InvalidEditTarget as invalid_target:
+            return error(str(invalid_target), 400)
+        except PromptTooLarge as too_large:
+            return error(str(too_large), 413)
+        except EditError as edit_error:
+            return error(f"AI returned an unusable edit: {str(edit_error)}", 500)
+        except Exception as ai_error:
+            return error(f"AI processing failed: {str(ai_error)}", 500)
+
+        try:
+            with span("supabase_upsert"):
+                await itinerary_store.save(itinerary_id, updated_itinerary, previous=current_itinerary,
+                                           version=version, patch=patch)
+            invalidate_itinerary(itinerary_id)
+            return JSONResponse(updated_itinerary)
+        except VersionConflict as conflict:
+            # Edited concurrently from the same version; the client reloads and retries
+            return error(str(conflict), 409)
+        except Exception as db_error:
+            log_to_supabase(f"Database update error: {str(db_error)}")
+            return error("Database update failed", 500)
+    except Exception as e:
+        log_to_supabase(f"Global update error: {str(e)}")
+        return error("Internal server error", 500)
+
+
+async def get_llm_stats(request):
+    return JSONResponse(get_scheduler_stats())
+
+
+async def get_edit_prompts(request):
+    return JSONResponse(get_edit_prompt_stats())
+
+
+async def get_metrics(request):
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "").lower() in ("1", "true", "yes")
+request_seconds = metrics.histogram(
+    "nexplan_http_request_seconds", "HTTP request latency", labelnames=("endpoint", "method", "status")
+)
+metrics.gauge("nexplan_llm_active", "Generations running", lambda: get_scheduler_stats()["active"])
+metrics.gauge("nexplan_llm_queued", "Generations waiting for a slot", lambda: get_scheduler_stats()["queued"])
+
+
+async def request_timing(request, call_next):
+    started = time.perf_counter()
+    token = metrics.start_request()
+    try:
+        response = await call_next(request)
+    finally:
+        spans = metrics.finish_request(token)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    endpoint = route.path if route is not None else "unmatched"
+    request_seconds.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = metrics.server_timing(spans, elapsed)
+    return response
+
+
+app = Starlette(
+    routes=[
+        Route('/', health_check),
+        Route('/ready', readiness_check),
+        Route('/api/auth/signup', signup, methods=['POST']),
+        Route('/api/auth/login', login, methods=['POST']),
+        Route('/api/auth/logout', logout, methods=['POST']),
+        Route('/api/auth/session', get_session, methods=['GET']),
+        Route('/api/gather_info', gather_user_info, methods=['POST']),
+        Route('/api/itinerary', generate_itinerary, methods=['POST']),
+        Route('/api/itinerary/{itinerary_id}', get_itinerary, methods=['GET']),
+        Route('/api/itinerary/{itinerary_id}', update_itinerary, methods=['PUT']),
+        Route('/api/llm/stats', get_llm_stats, methods=['GET']),
+        Route('/api/llm/edit_prompts', get_edit_prompts, methods=['GET']),
+        Route('/metrics', get_metrics, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_headers=['Content-Type', 'Authorization'],
+                   allow_methods=['GET', 'PUT', 'POST', 'DELETE', 'OPTIONS']),
+        Middleware(BaseHTTPMiddleware, dispatch=request_timing),
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv("PORT", 5000)))
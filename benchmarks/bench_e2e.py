@@ -0,0 +1,353 @@
+# benchmarks/bench_e2e.py
+"""End-to-end latency, throughput and memory against local fake upstreams.
+
+    python -m benchmarks.bench_e2e
+    python -m benchmarks.bench_e2e --requests 64 --concurrency 16 --token-rate 300
+    python -m benchmarks.bench_e2e --output after.json --baseline before.json
+
+Starts the fakes in benchmarks.fake_upstreams, points the app at them and
+runs these scenarios at the given concurrency:
+
+    pipeline  get_location_info + create_structured_itinerary
+    http      POST /api/itinerary, GET /api/itinerary/<id>, and the same GET
+              again with If-None-Match, through Flask's test client
+    asgi      the same requests against asgi_server, as concurrent tasks on
+              one event loop instead of threads
+
+Trips cycle through --destinations cities, so repeated destinations hit
+the geocode, places and tips caches the way real traffic would. LLM_*,
+PIPELINE_WORKERS and the other tuning variables are read from the
+environment as usual.
+
+Results (p50/p95/p99 per operation, throughput, peak memory, upstream
+calls and time per pipeline stage) are printed and written to --output as
+JSON. With --baseline, p95 and throughput are compared against an earlier
+run and the exit status is 1 if either got worse by more than --tolerance.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmarks.fake_upstreams import FakeUpstreams
+
+CITIES = ("Lisbon", "Kyoto", "Oaxaca", "Tbilisi", "Hobart", "Bergen", "Cusco", "Hanoi",
+          "Porto", "Valletta", "Ljubljana", "Cartagena")
+
+
+def trip(index, days, destinations):
+    return {
+        "destination": CITIES[index % destinations],
+        "budget": "$2000",
+        "arrival_date": "06/01/2026",
+        "duration": str(days),
+        "people": "2",
+        "shelter": "hotel",
+        "activities": "food, museums, walking",
+    }
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def summarize(latencies):
+    return {
+        operation: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 2),
+            "max_ms": round(max(values) * 1000, 2),
+        }
+        for operation, values in latencies.items() if values
+    }
+
+
+def stage_totals():
+    """(count, seconds) per pipeline stage from the metrics registry so far."""
+    import metrics
+    totals = {}
+    for name, labels, value in metrics.stage_seconds.samples():
+        stage = totals.setdefault(labels["stage"], [0, 0.0])
+        if name.endswith("_count"):
+            stage[0] = value
+        elif name.endswith("_sum"):
+            stage[1] = value
+    return totals
+
+
+def stage_delta(before, after):
+    delta = {}
+    for stage, (count, seconds) in after.items():
+        count -= before.get(stage, (0, 0.0))[0]
+        seconds -= before.get(stage, (0, 0.0))[1]
+        if count:
+            delta[stage] = {"count": count, "mean_ms": round(seconds / count * 1000, 2)}
+    return delta
+
+
+def run_pipeline(index, args, record):
+    import ai_functions
+    user_info = trip(index, args.days, args.destinations)
+    started = time.perf_counter()
+    location_info = ai_functions.get_location_info(user_info["destination"])
+    itinerary = ai_functions.create_structured_itinerary(user_info, location_info)
+    record("create_structured_itinerary", time.perf_counter() - started)
+    if not itinerary.get("days") or not itinerary.get("travel_tips"):
+        raise RuntimeError("incomplete itinerary")
+
+
+def run_http(index, args, record, local=threading.local()):
+    import server
+    if not hasattr(local, "client"):
+        local.client = server.app.test_client()
+    client = local.client
+
+    started = time.perf_counter()
+    response = client.post("/api/itinerary", json=trip(index, args.days, args.destinations))
+    record("POST /api/itinerary", time.perf_counter() - started)
+    if response.status_code != 200:
+        raise RuntimeError(f"POST returned {response.status_code}")
+    itinerary_id = response.get_json()["id"]
+
+    started = time.perf_counter()
+    response = client.get(f"/api/itinerary/{itinerary_id}")
+    record("GET /api/itinerary/<id>", time.perf_counter() - started)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET returned {response.status_code}")
+
+    started = time.perf_counter()
+    response = client.get(f"/api/itinerary/{itinerary_id}", headers={"If-None-Match": response.headers["ETag"]})
+    record("GET /api/itinerary/<id> (304)", time.perf_counter() - started)
+    if response.status_code != 304:
+        raise RuntimeError(f"conditional GET returned {response.status_code}")
+
+
+async def run_asgi(index, args, record, client):
+    started = time.perf_counter()
+    response = await client.post("/api/itinerary", json=trip(index, args.days, args.destinations))
+    record("ASGI POST /api/itinerary", time.perf_counter() - started)
+    if response.status_code != 200:
+        raise RuntimeError(f"POST returned {response.status_code}")
+    itinerary_id = response.json()["id"]
+
+    started = time.perf_counter()
+    response = await client.get(f"/api/itinerary/{itinerary_id}")
+    record("ASGI GET /api/itinerary/<id>", time.perf_counter() - started)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET returned {response.status_code}")
+
+    started = time.perf_counter()
+    response = await client.get(f"/api/itinerary/{itinerary_id}", headers={"If-None-Match": response.headers["ETag"]})
+    record("ASGI GET /api/itinerary/<id> (304)", time.perf_counter() - started)
+    if response.status_code != 304:
+        raise RuntimeError(f"conditional GET returned {response.status_code}")
+
+
+SCENARIOS = {"pipeline": run_pipeline, "http": run_http, "asgi": run_asgi}
+
+
+def run_scenario(name, args, upstreams):
+    fn = SCENARIOS[name]
+    latencies = {}
+    lock = threading.Lock()
+    errors = []
+    before = {}
+
+    def record(operation, seconds):
+        with lock:
+            latencies.setdefault(operation, []).append(seconds)
+
+    def failed(e):
+        with lock:
+            errors.append(str(e))
+
+    def begin():
+        # Warm-up requests fill connection pools and caches but aren't measured
+        upstreams.calls(reset=True)
+        before["stages"] = stage_totals()
+        if args.trace_memory:
+            tracemalloc.start()
+
+    if asyncio.iscoroutinefunction(fn):
+        wall = asyncio.run(drive_async(fn, args, record, failed, begin))
+    else:
+        wall = drive_threads(fn, args, record, failed, begin)
+
+    result = {
+        "requests": args.requests,
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round((args.requests - len(errors)) / wall, 2),
+        "latency": summarize(latencies),
+        "stages": stage_delta(before["stages"], stage_totals()),
+        "upstream_calls": upstreams.calls(),
+    }
+    if args.trace_memory:
+        result["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        tracemalloc.stop()
+    return result
+
+
+def drive_threads(fn, args, record, failed, begin):
+    """Run the measured requests on `args.concurrency` threads; returns wall time."""
+    def one(index):
+        try:
+            fn(index, args, record)
+        except Exception as e:
+            failed(e)
+
+    for index in range(args.warmup):
+        fn(index, args, lambda operation, seconds: None)
+    begin()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.warmup, args.warmup + args.requests)))
+    return time.perf_counter() - started
+
+
+async def drive_async(fn, args, record, failed, begin):
+    """Run the measured requests as `args.concurrency` concurrent tasks against asgi_server."""
+    import asgi_server
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(index):
+        async with semaphore:
+            try:
+                await fn(index, args, record, client)
+            except Exception as e:
+                failed(e)
+
+    # ASGITransport doesn't run the lifespan, which creates the Supabase client
+    transport = httpx.ASGITransport(app=asgi_server.app)
+    async with asgi_server.lifespan(asgi_server.app), \
+            httpx.AsyncClient(transport=transport, base_url="http://asgi") as client:
+        for index in range(args.warmup):
+            await fn(index, args, lambda operation, seconds: None, client)
+        begin()
+        started = time.perf_counter()
+        await asyncio.gather(*(one(index) for index in range(args.warmup, args.warmup + args.requests)))
+        return time.perf_counter() - started
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 2)
+
+
+def compare(results, baseline, tolerance):
+    """Print p95 and throughput against a baseline run; True if nothing regressed."""
+    ok = True
+    for name, scenario in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        pairs = [(f"{name} throughput", before["throughput_rps"], scenario["throughput_rps"], False)]
+        for operation, stats in scenario["latency"].items():
+            if operation in before["latency"]:
+                pairs.append((f"{operation} p95", before["latency"][operation]["p95_ms"], stats["p95_ms"], True))
+        for label, old, new, lower_is_better in pairs:
+            change = (new - old) / old if old else 0.0
+            worse = change > tolerance if lower_is_better else change < -tolerance
+            ok = ok and not worse
+            print(f"{label:<46} {old:>10.2f} -> {new:>10.2f} {change:>+8.1%}{'  REGRESSION' if worse else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="Scenario to run (repeatable; default all)")
+    parser.add_argument("--requests", type=int, default=32, help="Measured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=0, help="Unmeasured requests before each scenario")
+    parser.add_argument("--days", type=int, default=5, help="Trip length")
+    parser.add_argument("--destinations", type=int, default=4, choices=range(1, len(CITIES) + 1),
+                        metavar=f"1..{len(CITIES)}", help="Distinct cities to cycle through")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Model time to first token, seconds")
+    parser.add_argument("--token-rate", type=float, default=1000.0, help="Model tokens per second")
+    parser.add_argument("--upstream-latency", type=float, default=0.02,
+                        help="Added to every GeoNames/Overpass/ORS/Supabase answer, seconds")
+    parser.add_argument("--response", action="append", help="Recorded model response to replay (repeatable)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also report the Python heap peak per scenario (tracemalloc; slows the run)")
+    parser.add_argument("--output", default="bench_e2e.json")
+    parser.add_argument("--baseline", help="Earlier --output to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression, as a fraction")
+    parser.add_argument("--verbose", action="store_true", help="Keep the app's own prints and logs")
+    args = parser.parse_args()
+
+    responses = []
+    for path in args.response or ():
+        with open(path) as f:
+            responses.append(f.read())
+    upstreams = FakeUpstreams(llm_latency=args.llm_latency, token_rate=args.token_rate,
+                              upstream_latency=args.upstream_latency, responses=responses).start()
+
+    # Everything has to point at the fakes before the app modules are
+    # imported; caches stay in memory so each run starts cold
+    os.environ.update(upstreams.env())
+    os.environ.update({"CACHE_DB_PATH": "", "LOG_SPILL_PATH": "", "POI_STORE_PATH": ""})
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with quiet:
+        import asgi_server  # noqa: F401
+        import server  # noqa: F401  (imports ai_functions too)
+        if not args.verbose:
+            import logging
+            logging.getLogger().setLevel(logging.WARNING)
+
+        results = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "llm_max_concurrent": os.getenv("LLM_MAX_CONCURRENT", "2"),
+            },
+            "config": {key: value for key, value in vars(args).items()
+                       if key not in ("output", "baseline", "verbose", "response")},
+            "scenarios": {},
+        }
+        results["config"]["recorded_responses"] = len(responses)
+        for name in args.scenario or list(SCENARIOS):
+            results["scenarios"][name] = run_scenario(name, args, upstreams)
+        results["peak_rss_mb"] = peak_rss_mb()
+    upstreams.stop()
+
+    print(f"{'operation':<36} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, scenario in results["scenarios"].items():
+        for operation, stats in scenario["latency"].items():
+            print(f"{operation:<36} {stats['count']:>5} {stats['p50_ms']:>9.1f} "
+                  f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+        memory = f", heap peak {scenario['peak_traced_mb']} MB" if "peak_traced_mb" in scenario else ""
+        print(f"  {name}: {scenario['throughput_rps']} req/s, {scenario['errors']} errors{memory}")
+    print(f"peak RSS {results['peak_rss_mb']} MB")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# benchmarks/bench_edit_prompt.py
+"""Edit prompt size: the whole itinerary vs. a fresh targeted prompt vs. a continued one.
+
+    python -m benchmarks.bench_edit_prompt
+
+Builds itineraries of 3 to 28 days and compares, for a few typical edit
+requests, the size of the prompt the old PUT handler sent (the whole
+itinerary with indent=2), the prompt prompt_builder writes for a first
+edit, and the one it writes when the edit continues the conversation of
+an earlier edit of the same sections, whose context Ollama already holds.
+Sizes are in approximate tokens (characters / 4, the builder's estimate
+before any calibration).
+"""
+import json
+from datetime import datetime
+
+from benchmarks.bench_parser import synthetic_response
+from itinerary_edits import classify_edit
+from itinerary_parser import parse_days
+from prompt_builder import PromptBuilder, TokenCounter
+
+ARRIVAL = datetime(2025, 6, 1)
+EDITS = (
+    "swap the museum on day 3",
+    "change dinner on the last day",
+    "make the second day more relaxed",
+)
+
+
+class FakeResponse:
+    """What the builder reads from an Ollama response."""
+
+    def __init__(self, context):
+        self.context = context
+        self.prompt_eval_count = None
+        self.prompt_eval_duration = None
+
+
+def synthetic_itinerary(days):
+    return {
+        "destination": "Lisbon",
+        "country": "Portugal",
+        "budget": "$2000",
+        "arrival_date": "06/01/2025",
+        "duration": days,
+        "people": "2",
+        "accommodation": "hotel",
+        "days": parse_days(synthetic_response(days), ARRIVAL),
+        "travel_tips": ["Tip %d" % i for i in range(5)],
+    }
+
+
+def legacy_prompt(itinerary, modification):
+    return f"""
+            CURRENT ITINERARY:
+            {json.dumps(itinerary, indent=2)}
+
+            USER MODIFICATION REQUEST:
+            {modification}
+
+            RULES:
+            1. Maintain valid JSON structure
+            2. Keep existing correct information
+            3. Only use real locations from original data
+            4. Preserve all original fields
+            """
+
+
+def main():
+    counter = TokenCounter()
+    print(f"{'days':>5} {'edit':<34} {'full':>7} {'fresh':>7} {'continued':>10}")
+    for days in (3, 7, 14, 28):
+        itinerary = synthetic_itinerary(days)
+        for modification in EDITS:
+            # Generous limits so nothing is cut; the sizes are what's compared
+            builder = PromptBuilder(budget=10 ** 6, num_ctx=10 ** 6, counter=counter)
+            pointers = classify_edit(modification, itinerary)
+            fresh = builder.build(itinerary, modification, pointers, "trip", 1)
+            # The model's answer left the sections as they were
+            builder.record(fresh, FakeResponse([0] * fresh.tokens), itinerary, "trip", 1)
+            continued = builder.build(itinerary, modification, pointers, "trip", 2)
+            assert continued.session is not None
+            print(f"{days:>5} {modification:<34} {counter.count(legacy_prompt(itinerary, modification)):>7} "
+                  f"{fresh.tokens:>7} {continued.tokens:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# benchmarks/bench_json.py
+"""CPU spent serializing itineraries: encode-once json_codec vs. the old path.
+
+    python -m benchmarks.bench_json
+    python -m benchmarks.bench_json --days 7 --days 60 --repeat 200
+
+For multi-week itineraries shaped like the pipeline's output (parsed days
+plus a route per day), times the JSON work each endpoint does:
+
+    create  POST /api/itinerary: before, json.dumps as a validity check,
+            again for the Supabase row, the response logged with print()
+            and jsonify; now one json_codec.dumps spliced into the response
+    get     GET /api/itinerary/<id>: before, json.loads of the stored text
+            and jsonify; now the stored text is sent as is
+    update  PUT /api/itinerary/<id>: before, json.dumps for the row and
+            jsonify; now one json_codec.dumps for both
+
+Responses from both paths must decode to the same JSON.
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+
+from flask import Flask, jsonify
+
+import json_codec
+from benchmarks.fake_upstreams import synthetic_itinerary
+from itinerary_parser import parse_days
+
+ARRIVAL = datetime(2026, 6, 1)
+PLACES = ["Azure Hotel", "Cedar Hotel", "Harbour Restaurant", "Lantern Restaurant", "Marble Café",
+          "Old Town Museum", "Riverside Gallery", "Botanical Garden", "Night Market"]
+
+
+def synthetic_route(rng):
+    stops = [{"name": rng.choice(PLACES), "part": part,
+              "lat": 38.7 + rng.random() / 10, "lng": -9.1 - rng.random() / 10}
+             for part in ("morning", "afternoon", "evening") for _ in range(3)]
+    legs = [{"from": a["name"], "to": b["name"], "distance_km": round(rng.uniform(0.3, 5), 2),
+             "duration_min": round(rng.uniform(4, 60), 1)} for a, b in zip(stops, stops[1:])]
+    return {
+        "profile": "foot-walking",
+        "source": "openrouteservice",
+        "stops": stops,
+        "legs": legs,
+        "total_distance_km": round(sum(leg["distance_km"] for leg in legs), 2),
+        "total_duration_min": round(sum(leg["duration_min"] for leg in legs), 1)
+    }
+
+
+def synthetic_structured(days, seed=0):
+    """An itinerary as create_structured_itinerary returns it."""
+    rng = random.Random(seed)
+    parsed = parse_days(synthetic_itinerary(days, PLACES), ARRIVAL)
+    for day in parsed:
+        day["route"] = synthetic_route(rng)
+    return {
+        "destination": "Lisbon",
+        "country": "Portugal",
+        "budget": "$4000",
+        "arrival_date": "06/01/2026",
+        "duration": days,
+        "people": "2",
+        "accommodation": "hotel",
+        "days": parsed,
+        "travel_tips": [f"{i}. Tip {i}: book the tram early and carry cash for small cafés." for i in range(1, 6)]
+    }
+
+
+def legacy_create(itinerary, itinerary_id):
+    json.dumps(itinerary)
+    row = json.dumps(itinerary)
+    response_data = {"status": "success", "id": itinerary_id, "itinerary": itinerary}
+    f"Full response data: {response_data}"
+    f"Returning response: {json.dumps(response_data)}"
+    return row, jsonify(response_data).get_data()
+
+
+def codec_create(itinerary, itinerary_id):
+    encoded = json_codec.dumps(itinerary)
+    return encoded.decode("utf-8"), json_codec.envelope({"status": "success", "id": itinerary_id}, itinerary=encoded)
+
+
+def legacy_get(stored):
+    return jsonify(json.loads(stored)).get_data()
+
+
+def codec_get(stored):
+    return stored.encode("utf-8")
+
+
+def legacy_update(itinerary):
+    return json.dumps(itinerary), jsonify(itinerary).get_data()
+
+
+def codec_update(itinerary):
+    encoded = json_codec.dumps(itinerary)
+    return encoded.decode("utf-8"), encoded
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, action="append", help="Trip length to test (repeatable)")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    # Flask's stock provider for the old path, json_codec's for the new one
+    legacy_app = Flask("legacy")
+    codec_app = Flask("codec")
+    codec_app.json = json_codec.FastJSONProvider(codec_app)
+    itinerary_id = "3f2b8c1e-5d7a-4e0b-9c6f-1a2b3c4d5e6f"
+
+    print(f"backend: {'orjson' if json_codec.ORJSON_AVAILABLE else 'json'}")
+    print(f"{'trip':<10} {'bytes':>9} {'endpoint':<8} {'before':>10} {'after':>10} {'speedup':>8}")
+    for days in args.days or (7, 14, 28, 60):
+        itinerary = synthetic_structured(days)
+        stored = json.dumps(itinerary)
+        stored_by_codec = json_codec.dumps_str(itinerary)
+        cases = [
+            ("create", lambda: legacy_create(itinerary, itinerary_id), lambda: codec_create(itinerary, itinerary_id)),
+            ("get", lambda: legacy_get(stored), lambda: codec_get(stored_by_codec)),
+            ("update", lambda: legacy_update(itinerary), lambda: codec_update(itinerary)),
+        ]
+        for name, legacy, codec in cases:
+            with legacy_app.app_context():
+                before = legacy()
+                legacy_time = best_of(legacy, args.repeat)
+            with codec_app.app_context():
+                after = codec()
+                codec_time = best_of(codec, args.repeat)
+            before_body = before[1] if isinstance(before, tuple) else before
+            after_body = after[1] if isinstance(after, tuple) else after
+            assert json.loads(before_body) == json.loads(after_body), f"{days} days, {name}: responses differ"
+            print(f"{days:>3} days   {len(stored):>9} {name:<8} {legacy_time * 1e6:>8.0f}µs "
+                  f"{codec_time * 1e6:>8.0f}µs {legacy_time / codec_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# benchmarks/bench_parser.py
+"""Itinerary response parsing: single-pass DayParser vs. the old split-based parser.
+
+    python -m benchmarks.bench_parser
+    python -m benchmarks.bench_parser --response recorded.txt
+
+Without --response, long responses in the prompt's format are generated for
+1, 7, 14 and 21 day trips. Both parsers must produce identical days.
+
+On a complete response the two are at parity: the ratio moves between
+roughly 0.8x and 1.3x from run to run. DayParser's gain is incremental
+parsing. It returns each day as the stream completes it, while the old
+parser has to re-parse everything received so far, shown here once per
+streamed line ("legacy streamed").
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from itinerary_parser import DayParser, parse_days
+
+ARRIVAL = datetime(2025, 6, 1)
+
+
+def legacy_parse_days(text, arrival_date):
+    """The parser create_structured_itinerary used before itinerary_parser."""
+    days = []
+    day_sections = text.split("DAY ")
+    for i in range(1, len(day_sections)):
+        day_content = day_sections[i].strip()
+        current_date = arrival_date + timedelta(days=i-1)
+        day_parts = {}
+        if "MORNING:" in day_content:
+            morning_content = day_content.split("MORNING:")[1].split("AFTERNOON:")[0].strip()
+            day_parts["morning"] = [item.strip() for item in morning_content.split("\n- ") if item.strip()]
+        if "AFTERNOON:" in day_content:
+            afternoon_content = day_content.split("AFTERNOON:")[1].split("EVENING:")[0].strip()
+            day_parts["afternoon"] = [item.strip() for item in afternoon_content.split("\n- ") if item.strip()]
+        if "EVENING:" in day_content:
+            evening_section = day_content.split("EVENING:")[1]
+            evening_end = None
+            for possible_end in ["DAILY TIPS:", "ESTIMATED DAILY COST:", "DAY "]:
+                if possible_end in evening_section:
+                    if evening_end is None or evening_section.find(possible_end) < evening_section.find(evening_end):
+                        evening_end = possible_end
+            if evening_end:
+                evening_content = evening_section.split(evening_end)[0].strip()
+            else:
+                evening_content = evening_section.strip()
+            evening_activities = []
+            for line in evening_content.split("\n"):
+                line = line.strip()
+                if line.startswith("-") or line.startswith("*"):
+                    evening_activities.append(line[1:].strip())
+                elif line and not line.startswith("**") and "Food recommendation:" not in line:
+                    evening_activities.append(line)
+            day_parts["evening"] = [item for item in evening_activities if item.strip()]
+        if "DAILY TIPS:" in day_content:
+            tips_section = day_content.split("DAILY TIPS:")[1]
+            if "ESTIMATED DAILY COST:" in tips_section:
+                tips_content = tips_section.split("ESTIMATED DAILY COST:")[0].strip()
+            else:
+                tips_content = tips_section.strip()
+            day_parts["tips"] = [item.strip() for item in tips_content.split("\n- ") if item.strip()]
+        cost_estimate = ""
+        if "ESTIMATED DAILY COST:" in day_content:
+            cost_estimate = day_content.split("ESTIMATED DAILY COST:")[1].strip().split("\n")[0].strip()
+        days.append({
+            "day_number": i,
+            "date": current_date.strftime("%A, %B %d, %Y"),
+            "activities": day_parts,
+            "estimated_cost": cost_estimate
+        })
+    return days
+
+
+WORDS = ("visit the old town market museum gallery cathedral riverside walk local "
+         "tram metro bus taxi street food tasting tour sunset viewpoint harbour "
+         "park garden palace bistro tapas wine bar jazz club night").split()
+
+
+def synthetic_response(days, seed=0):
+    """A response shaped like the model's, with markdown quirks it often adds."""
+    rng = random.Random(seed)
+
+    def sentence():
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(12, 30))).capitalize()
+
+    lines = ["Here is your personalised itinerary!", ""]
+    for day in range(1, days + 1):
+        date = (ARRIVAL + timedelta(days=day - 1)).strftime("%A, %B %d")
+        lines += [f"**DAY {day}: {date}**", ""]
+        for header in ("MORNING:", "AFTERNOON:", "EVENING:", "DAILY TIPS:"):
+            lines.append(f"**{header}**" if rng.random() < 0.3 else header)
+            lines += [f"- {sentence()} (approx. ${rng.randint(5, 80)})" for _ in range(rng.randint(2, 5))]
+            lines.append("")
+        lines += [f"ESTIMATED DAILY COST: ${rng.randint(80, 400)} per person", ""]
+    lines.append("Enjoy your trip!")
+    return "\n".join(lines)
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def streamed(text, chunk_size=4):
+    # Ollama streams a few characters per chunk
+    parser = DayParser(ARRIVAL)
+    days = []
+    for i in range(0, len(text), chunk_size):
+        days.extend(parser.feed(text[i:i + chunk_size]))
+    days.extend(parser.close())
+    return days
+
+
+def legacy_streamed(text):
+    # Without an incremental parser, days are found by re-parsing the whole
+    # buffer whenever a line completes
+    end = text.find("\n")
+    while end != -1:
+        legacy_parse_days(text[:end + 1], ARRIVAL)
+        end = text.find("\n", end + 1)
+    return legacy_parse_days(text, ARRIVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--response", action="append", help="Recorded model response (repeatable)")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.response:
+        responses = []
+        for path in args.response:
+            with open(path) as f:
+                responses.append((path, f.read()))
+    else:
+        responses = [(f"{days}-day synthetic", synthetic_response(days)) for days in (1, 7, 14, 21)]
+
+    print(f"{'response':<22} {'chars':>8} {'legacy':>10} {'single-pass':>12} {'ratio':>8} {'streamed':>10} "
+          f"{'legacy streamed':>16}")
+    for label, text in responses:
+        expected = legacy_parse_days(text, ARRIVAL)
+        assert parse_days(text, ARRIVAL) == expected, f"{label}: parsers disagree"
+        assert streamed(text) == expected, f"{label}: streamed parse disagrees"
+
+        legacy = best_of(lambda: legacy_parse_days(text, ARRIVAL), args.repeat)
+        single = best_of(lambda: parse_days(text, ARRIVAL), args.repeat)
+        stream = best_of(lambda: streamed(text), max(args.repeat // 10, 1))
+        legacy_stream = best_of(lambda: legacy_streamed(text), 1)
+        print(f"{label:<22} {len(text):>8} {legacy * 1e6:>8.0f}µs {single * 1e6:>10.0f}µs "
+              f"{legacy / single:>7.2f}x {stream * 1e6:>8.0f}µs {legacy_stream * 1e3:>14.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
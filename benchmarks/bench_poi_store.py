@@ -0,0 +1,88 @@
+# benchmarks/bench_poi_store.py
+"""Radius query latency: offline POIStore vs. the live Overpass path.
+
+    python -m benchmarks.bench_poi_store --store places.npz --lat 48.8566 --lng 2.3522
+    python -m benchmarks.bench_poi_store --synthetic 200000 --live
+
+Without --store a synthetic store is generated around the given point.
+"""
+import argparse
+import random
+import statistics
+import time
+
+from poi_store import BBOX, PLACE_TYPES, POIStore
+
+
+def synthetic_store(lat, lng, count, spread=0.3, seed=42):
+    rng = random.Random(seed)
+    places = [{
+        "id": i,
+        "name": f"Place {i}",
+        "type": rng.choice(PLACE_TYPES),
+        "lat": lat + rng.uniform(-spread, spread),
+        "lon": lng + rng.uniform(-spread, spread),
+    } for i in range(count)]
+    return POIStore.from_places(places, area=(BBOX, lat - spread, lng - spread, lat + spread, lng + spread))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def time_calls(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+def report(label, samples):
+    print(f"{label:<28} p50 {percentile(samples, 50):>10.0f} µs   "
+          f"p99 {percentile(samples, 99):>10.0f} µs   mean {statistics.mean(samples):>10.0f} µs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", help="Store built with `python poi_store.py load`")
+    parser.add_argument("--synthetic", type=int, default=100000, help="Places in the synthetic store")
+    parser.add_argument("--lat", type=float, default=48.8566)
+    parser.add_argument("--lng", type=float, default=2.3522)
+    parser.add_argument("--radius", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--live", action="store_true", help="Also time the live Overpass path")
+    args = parser.parse_args()
+
+    if args.store:
+        store = POIStore.load(args.store)
+    else:
+        store = synthetic_store(args.lat, args.lng, args.synthetic)
+    print(f"Store: {len(store)} places")
+
+    rng = random.Random(0)
+
+    def jittered():
+        return args.lat + rng.uniform(-0.05, 0.05), args.lng + rng.uniform(-0.05, 0.05)
+
+    found = len(store.query(args.lat, args.lng, args.radius))
+    print(f"{found} places within {args.radius} m of the centre")
+    report("store, all types", time_calls(lambda: store.query(*jittered(), args.radius), args.iterations))
+    report("store, hotel+restaurant",
+           time_calls(lambda: store.query(*jittered(), args.radius, ["hotel", "restaurant"]), args.iterations))
+    # What create_structured_itinerary actually asks for
+    report("store, hotel+restaurant, 5",
+           time_calls(lambda: store.query(*jittered(), args.radius, ["hotel", "restaurant"], limit=5),
+                      args.iterations))
+
+    if args.live:
+        from ai_functions import _query_overpass
+        # Keep the live sample small: Overpass rate-limits aggressive clients
+        report("live Overpass, hotel+restaurant",
+               time_calls(lambda: _query_overpass(args.lat, args.lng, args.radius, ["hotel", "restaurant"]), 5))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# benchmarks/bench_storage.py
+"""Row size and read cost of each itinerary_data storage format.
+
+    python -m benchmarks.bench_storage
+    python -m benchmarks.bench_storage --days 14 --repeat 200
+
+For each format in storage_codec, reports the size of the stored value
+and the time get_itinerary spends turning the PostgREST response for
+select=itinerary_data::text into the response body: parsing the response
+JSON, as the Supabase client does, then storage_codec.to_json. "legacy"
+is the read before storage_codec, which parsed the stored string again
+and re-encoded it with jsonify. All formats must produce the same
+itinerary.
+"""
+import argparse
+import json
+
+from flask import Flask, jsonify
+
+import json_codec
+import storage_codec
+from benchmarks.bench_json import best_of, synthetic_structured
+
+
+def read(response_text):
+    return storage_codec.to_json(json.loads(response_text)[0]["itinerary_data"])
+
+
+def legacy_read(response_text):
+    return jsonify(json.loads(json.loads(response_text)[0]["itinerary_data"])).get_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, action="append", help="Trip length to test (repeatable)")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    app = Flask("legacy")
+    print(f"{'trip':<10} {'format':<11} {'stored':>9} {'ratio':>6} {'read':>10} {'vs legacy':>10}")
+    for days in args.days or (7, 14, 28, 60):
+        itinerary = synthetic_structured(days)
+        text_size = None
+        with app.app_context():
+            legacy_body = json.dumps([{"itinerary_data": json.dumps(itinerary)}])
+            legacy_time = best_of(lambda: legacy_read(legacy_body), args.repeat)
+        print(f"{days:>3} days   {'legacy':<11} {len(json.dumps(itinerary)):>9} {'':>6} "
+              f"{legacy_time * 1e6:>8.0f}µs")
+
+        for storage_format in storage_codec.FORMATS:
+            stored = storage_codec.encode(itinerary, storage_format)
+            size = storage_codec.stored_size(stored)
+            text_size = text_size or size
+            # What PostgREST sends back for select=itinerary_data::text
+            as_text = stored if isinstance(stored, str) else json.dumps(stored)
+            response_text = json.dumps([{"itinerary_data": as_text}])
+            assert json_codec.loads(read(response_text)) == itinerary, f"{storage_format}: itinerary changed"
+            read_time = best_of(lambda: read(response_text), args.repeat)
+            print(f"{'':<10} {storage_format:<11} {size:>9} {size / text_size:>5.2f}x "
+                  f"{read_time * 1e6:>8.0f}µs {legacy_time / read_time:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
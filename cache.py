@@ -0,0 +1,380 @@
+# cache.py
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Sentinel returned on a miss, so a cached None ("not found") can be told apart
+MISSING = object()
+
+# Every TieredCache registers itself here so stats can be reported in one place
+_caches = {}
+
+
+class LRUCache:
+    """In-process LRU cache with a per-entry expiry time."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStore:
+    """Persistent key/value store on SQLite with expiry and size-based eviction.
+
+    Values must be JSON serializable. Several namespaces can share one file.
+    The file is opened on first use, so creating a store touches nothing.
+    """
+
+    def __init__(self, path, namespace, max_entries=100000):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._connection = None
+
+    @property
+    def _conn(self):
+        # Only used with self._lock held
+        if self._connection is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            try:
+                with conn:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("""
+                        CREATE TABLE IF NOT EXISTS cache (
+                            namespace TEXT NOT NULL,
+                            key TEXT NOT NULL,
+                            value TEXT NOT NULL,
+                            expires_at REAL,
+                            accessed_at REAL NOT NULL,
+                            PRIMARY KEY (namespace, key)
+                        )
+                    """)
+                    conn.execute(
+                        "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed_at)"
+                    )
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._connection = conn
+        return self._connection
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            ).fetchone()
+            if row is None:
+                return MISSING, None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, key)
+                )
+                return MISSING, None
+            self._conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key)
+            )
+        # Hand back the remaining lifetime so the memory tier expires at the same time
+        return json.loads(value), (expires_at - now if expires_at is not None else None)
+
+    def get_many(self, keys):
+        """{key: (value, remaining ttl)} for the keys that are stored, in one query per 500 keys."""
+        now = time.time()
+        found = {}
+        with self._lock, self._conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, value, expires_at FROM cache WHERE namespace = ? "
+                    f"AND key IN ({', '.join('?' * len(chunk))})",
+                    (self.namespace, *chunk)
+                ).fetchall()
+                expired = []
+                for key, value, expires_at in rows:
+                    if expires_at is not None and expires_at <= now:
+                        expired.append((self.namespace, key))
+                    else:
+                        found[key] = (json.loads(value), expires_at - now if expires_at is not None else None)
+                self._conn.executemany("DELETE FROM cache WHERE namespace = ? AND key = ?", expired)
+            self._conn.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                [(now, self.namespace, key) for key in found]
+            )
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many([(key, value, ttl)])
+
+    def set_many(self, entries):
+        """Store (key, value, ttl) entries in one transaction."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(self.namespace, key, json.dumps(value), now + ttl if ttl else None, now)
+                 for key, value, ttl in entries]
+            )
+            writes = self._writes
+            self._writes += len(entries)
+            # Checking the row count on every write is wasteful, so evict in batches
+            if self._writes // 100 > writes // 100:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key)
+            )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def _evict(self):
+        self._conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+            (self.namespace, time.time())
+        )
+        count = self._conn.execute(
+            "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+        ).fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute("""
+                DELETE FROM cache WHERE namespace = ? AND key IN (
+                    SELECT key FROM cache WHERE namespace = ?
+                    ORDER BY accessed_at LIMIT ?
+                )
+            """, (self.namespace, self.namespace, excess))
+
+
+class TieredCache:
+    """Two-tier cache: an in-process LRU in front of an optional SQLiteStore.
+
+    A value of None is cached as a negative result ("not found") using
+    `negative_ttl`, so repeated lookups for unknown keys don't hit upstream.
+    """
+
+    def __init__(self, name, ttl=None, negative_ttl=None, max_entries=1024, store=None):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self.memory = LRUCache(max_entries)
+        self.store = store
+        self._lock = threading.Lock()
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "loads": 0,
+            "load_seconds": 0.0,
+        }
+        _caches[name] = self
+
+    def get(self, key):
+        return self.get_many([key]).get(key, MISSING)
+
+    def get_many(self, keys):
+        """Cached values for those of `keys` that are cached, as a dict."""
+        found, missing = self._get_memory(keys)
+        if missing and self.store is not None:
+            found.update(self._get_store(missing))
+        self._count_misses(len(keys) - len(found))
+        return found
+
+    async def get_many_async(self, keys):
+        """get_many with the store tier read on a worker thread, off the event loop."""
+        found, missing = self._get_memory(keys)
+        if missing and self.store is not None:
+            found.update(await asyncio.to_thread(self._get_store, missing))
+        self._count_misses(len(keys) - len(found))
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, values):
+        """Cache every key/value pair in `values`, writing the store tier in one transaction."""
+        self._set_store(self._set_memory(values))
+
+    async def set_many_async(self, values):
+        """set_many with the store tier written on a worker thread."""
+        entries = self._set_memory(values)
+        if self.store is not None:
+            await asyncio.to_thread(self._set_store, entries)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for `key`, calling `loader()` on a miss.
+
+        Exceptions raised by the loader propagate and are not cached.
+        """
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        started = time.perf_counter()
+        value = loader()
+        self._loaded(time.perf_counter() - started)
+        self.set(key, value)
+        return value
+
+    async def get_or_load_async(self, key, loader):
+        """get_or_load for a coroutine function `loader`; the store tier is used off the event loop."""
+        found = await self.get_many_async([key])
+        if key in found:
+            return found[key]
+
+        started = time.perf_counter()
+        value = await loader()
+        self._loaded(time.perf_counter() - started)
+        await self.set_many_async({key: value})
+        return value
+
+    def _get_memory(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.memory.get(key)
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+                self._count("memory_hits", value)
+        return found, missing
+
+    def _get_store(self, keys):
+        try:
+            stored = self.store.get_many(keys)
+        except sqlite3.Error as e:
+            print(f"Cache store error ({self.name}): {e}")
+            return {}
+        found = {}
+        for key, (value, remaining) in stored.items():
+            # The memory tier expires at the same time as the stored entry
+            self.memory.set(key, value, remaining)
+            self._count("disk_hits", value)
+            found[key] = value
+        return found
+
+    def _set_memory(self, values):
+        entries = []
+        for key, value in values.items():
+            ttl = self.negative_ttl if value is None else self.ttl
+            self.memory.set(key, value, ttl)
+            entries.append((key, value, ttl))
+        return entries
+
+    def _set_store(self, entries):
+        if self.store is None or not entries:
+            return
+        try:
+            self.store.set_many(entries)
+        except sqlite3.Error as e:
+            print(f"Cache store error ({self.name}): {e}")
+
+    def _loaded(self, elapsed):
+        with self._lock:
+            self._stats["loads"] += 1
+            self._stats["load_seconds"] += elapsed
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def clear(self):
+        self.memory.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        avg_load = stats["load_seconds"] / stats["loads"] if stats["loads"] else 0.0
+        stats.update({
+            "hits": hits,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "avg_load_seconds": round(avg_load, 4),
+            # Every hit is an upstream round trip we didn't make
+            "estimated_seconds_saved": round(hits * avg_load, 3),
+            "memory_entries": len(self.memory),
+        })
+        stats["load_seconds"] = round(stats["load_seconds"], 3)
+        return stats
+
+    def _count(self, field, value=MISSING):
+        with self._lock:
+            self._stats[field] += 1
+            if value is None:
+                self._stats["negative_hits"] += 1
+
+    def _count_misses(self, misses):
+        if misses:
+            with self._lock:
+                self._stats["misses"] += misses
+
+
+def open_store(namespace, path=None, max_entries=100000):
+    """The persistent tier for `namespace`, or None when disabled.
+
+    The file defaults to CACHE_DB_PATH; set it to an empty string to keep
+    caches in memory only. It is opened on first use; if it can't be, the
+    error is reported and the cache carries on from memory.
+    """
+    if path is None:
+        path = os.getenv("CACHE_DB_PATH", "nexplan_cache.sqlite3")
+    if not path:
+        return None
+    return SQLiteStore(path, namespace, max_entries=max_entries)
+
+
+def cache_stats():
+    """Hit/miss counters for every cache created in this process."""
+    return {name: cache.stats() for name, cache in _caches.items()}
@@ -0,0 +1,110 @@
+# clients.py
+"""Supabase and Ollama clients shared by the whole process, created on first use.
+
+Importing server, main or ai_functions doesn't connect to anything or
+validate any keys; the client is built the first time one of its methods
+is used, and every module gets the same instance. LazyClient also holds
+the modules' worker pools, for the same reason.
+
+ModelWarmup loads the model into Ollama's memory in the background at
+startup, so the first itinerary request doesn't pay for the cold load.
+"""
+import os
+import threading
+import time
+
+
+class LazyClient:
+    """Stands in for a client that is only created when first used.
+
+    Attribute access is forwarded to the real client, so it can be passed
+    anywhere the client itself is expected.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+                client = self._client
+        return client
+
+    @property
+    def created(self):
+        return self._client is not None
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def _create_supabase():
+    from supabase import create_client
+    return create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+
+
+def _create_ollama():
+    import ollama
+    return ollama.Client()
+
+
+def _create_async_ollama():
+    import ollama
+    return ollama.AsyncClient()
+
+
+supabase = LazyClient(_create_supabase)
+ollama_client = LazyClient(_create_ollama)
+async_ollama_client = LazyClient(_create_async_ollama)
+
+
+class ModelWarmup:
+    """Runs `load` once on a background thread and reports whether it worked.
+
+    start() is safe to call any number of times: it does nothing while a
+    load is running or after one succeeded, and tries again after a
+    failure (e.g. Ollama wasn't up yet).
+    """
+
+    def __init__(self, load, enabled=True):
+        self.load = load
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._state = "ready" if not enabled else "idle"
+        self._seconds = None
+        self._error = None
+
+    def start(self):
+        with self._lock:
+            if self._state not in ("idle", "failed"):
+                return
+            self._state = "loading"
+            self._error = None
+        threading.Thread(target=self._run, name="model-warmup", daemon=True).start()
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            self.load()
+        except Exception as e:
+            print(f"Model warm-up failed: {e}")
+            with self._lock:
+                self._state = "failed"
+                self._error = str(e)
+            return
+        with self._lock:
+            self._state = "ready"
+            self._seconds = round(time.perf_counter() - started, 3)
+
+    @property
+    def ready(self):
+        return self._state == "ready"
+
+    def status(self):
+        with self._lock:
+            return {"state": self._state, "enabled": self.enabled, "seconds": self._seconds, "error": self._error}
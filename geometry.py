@@ -0,0 +1,92 @@
+# geometry.py
+import numpy as np
+
+from poi_store import EARTH_RADIUS_M
+
+
+def _project(coords):
+    """(lon, lat) degrees to local x/y metres, good enough at city scale."""
+    points = np.asarray(coords, dtype=np.float64)
+    lat0 = np.radians(points[:, 1].mean())
+    x = np.radians(points[:, 0]) * np.cos(lat0) * EARTH_RADIUS_M
+    y = np.radians(points[:, 1]) * EARTH_RADIUS_M
+    return np.column_stack((x, y))
+
+
+def simplify(coords, tolerance_m=10.0):
+    """Douglas-Peucker simplification of a (lon, lat) line.
+
+    Keeps every point that is more than `tolerance_m` metres off the
+    simplified line, so corners survive while long straight stretches
+    collapse to their end points. Each step measures all points of a
+    segment against its chord in one vectorized pass.
+    Returns the kept points as an (n, 2) array.
+    """
+    points = np.asarray(coords, dtype=np.float64)
+    if len(points) < 3 or tolerance_m <= 0:
+        return points
+
+    xy = _project(points)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = xy[first], xy[last]
+        segment = xy[first + 1:last]
+        chord = end - start
+        length = np.hypot(chord[0], chord[1])
+        if length == 0:
+            distances = np.hypot(segment[:, 0] - start[0], segment[:, 1] - start[1])
+        else:
+            # Perpendicular distance from each point to the chord
+            distances = np.abs(chord[0] * (segment[:, 1] - start[1])
+                               - chord[1] * (segment[:, 0] - start[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return points[keep]
+
+
+def encode_polyline(coords, precision=5):
+    """Encode (lon, lat) points in the Google encoded polyline format.
+
+    The format stores latitude first; decoders such as Leaflet's or
+    polyline.js return (lat, lon) pairs.
+    """
+    points = np.asarray(coords, dtype=np.float64)
+    if not len(points):
+        return ""
+    scaled = np.round(points[:, ::-1] * 10 ** precision).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    # Zigzag so small negative deltas stay short too
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    chunks = []
+    for value in values.tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+def decode_polyline(encoded, precision=5):
+    """Inverse of encode_polyline; returns (lon, lat) tuples."""
+    values = []
+    value = shift = 0
+    for char in encoded:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    deltas = np.array(values, dtype=np.int64).reshape(-1, 2)
+    lat_lon = np.cumsum(deltas, axis=0) / 10 ** precision
+    return [(lon, lat) for lat, lon in lat_lon.tolist()]
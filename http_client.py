@@ -0,0 +1,281 @@
+# http_client.py
+import asyncio
+import os
+import random
+import threading
+import time
+
+import httpx
+
+from metrics import SIZE_BUCKETS, histogram, span
+
+try:
+    import h2  # noqa: F401  (httpx only needs it to be importable)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Upstream responses worth another try; anything else is returned as is
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# Defaults per external service. Each value can be overridden with
+# <NAME>_BASE_URL, <NAME>_CONNECT_TIMEOUT, <NAME>_READ_TIMEOUT,
+# <NAME>_RETRIES and <NAME>_MAX_CONNECTIONS, e.g. OVERPASS_READ_TIMEOUT=60.
+SERVICES = {
+    "geonames": {
+        "base_url": "http://api.geonames.org",
+        "connect_timeout": 3.0,
+        "read_timeout": 5.0,
+        "retries": 2,
+        "max_connections": 10,
+    },
+    "overpass": {
+        # Overpass queries are slow to answer but cheap to send
+        "base_url": "https://overpass-api.de",
+        "connect_timeout": 5.0,
+        "read_timeout": 30.0,
+        "retries": 2,
+        "max_connections": 4,
+    },
+    "openrouteservice": {
+        "base_url": "https://api.openrouteservice.org",
+        "connect_timeout": 3.0,
+        "read_timeout": 10.0,
+        "retries": 2,
+        "max_connections": 10,
+    },
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+response_bytes = histogram(
+    "nexplan_upstream_response_bytes", "Size of external API response bodies",
+    buckets=SIZE_BUCKETS, labelnames=("service",)
+)
+
+
+class ServiceClient:
+    """Long-lived httpx.Client for one external service.
+
+    Connections are pooled and kept alive between calls, and HTTP/2 is
+    negotiated when the h2 package is installed and the host supports it.
+    Connection failures and the statuses in RETRY_STATUSES are retried up
+    to `retries` times with full-jitter exponential backoff.
+
+    Every request counts the TCP connections and TLS handshakes it had to
+    make, so stats() shows how often a pooled connection was reused.
+    """
+
+    client_class = httpx.Client
+
+    def __init__(self, name, base_url, connect_timeout=5, read_timeout=30, retries=2,
+                 max_connections=10, backoff=0.25, max_backoff=4):
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.client = self.client_class(
+            base_url=base_url,
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            headers={"User-Agent": "nexplan/1.0"}
+        )
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "connections_opened": 0,
+            "tls_handshakes": 0,
+            "http2_responses": 0,
+            "seconds": 0.0,
+        }
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def request(self, method, path, **kwargs):
+        # One span per call, retries and backoff included
+        with span(self.name):
+            response = self._request(method, path, **kwargs)
+        response_bytes.observe(len(response.content), service=self.name)
+        return response
+
+    def _request(self, method, path, **kwargs):
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = self._trace
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self.client.request(method, path, extensions=extensions, **kwargs)
+            except httpx.TransportError:
+                self._count(seconds=time.perf_counter() - started)
+                if attempt >= self.retries:
+                    self._count(failures=1)
+                    raise
+            else:
+                self._count(
+                    requests=1,
+                    http2_responses=response.http_version == "HTTP/2",
+                    seconds=time.perf_counter() - started
+                )
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                delay = _retry_after(response)
+                response.close()
+                if delay is not None:
+                    attempt += 1
+                    self._count(retries=1)
+                    time.sleep(min(delay, self.max_backoff))
+                    continue
+
+            attempt += 1
+            self._count(retries=1)
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def _trace(self, event, info):
+        # httpcore reports each step of opening a connection; a request on a
+        # reused keep-alive connection reports none of them
+        if event == "connection.connect_tcp.complete":
+            self._count(connections_opened=1)
+        elif event == "connection.start_tls.complete":
+            self._count(tls_handshakes=1)
+
+    def _count(self, **fields):
+        with self._lock:
+            for field, value in fields.items():
+                self._stats[field] += value
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["seconds"] = round(stats["seconds"], 3)
+        stats["reused_connections"] = max(stats["requests"] - stats["connections_opened"], 0)
+        stats["avg_seconds"] = round(stats["seconds"] / stats["requests"], 4) if stats["requests"] else 0.0
+        return stats
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncServiceClient(ServiceClient):
+    """ServiceClient on httpx.AsyncClient, for the ASGI server.
+
+    Same pooling, retries and stats; waiting on the network or a backoff
+    only suspends the calling coroutine. Must only be used from one event
+    loop.
+    """
+
+    client_class = httpx.AsyncClient
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def request(self, method, path, **kwargs):
+        with span(self.name):
+            response = await self._request(method, path, **kwargs)
+        response_bytes.observe(len(response.content), service=self.name)
+        return response
+
+    async def _request(self, method, path, **kwargs):
+        extensions = dict(kwargs.pop("extensions", None) or {})
+        extensions["trace"] = self._atrace
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(method, path, extensions=extensions, **kwargs)
+            except httpx.TransportError:
+                self._count(seconds=time.perf_counter() - started)
+                if attempt >= self.retries:
+                    self._count(failures=1)
+                    raise
+            else:
+                self._count(
+                    requests=1,
+                    http2_responses=response.http_version == "HTTP/2",
+                    seconds=time.perf_counter() - started
+                )
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                delay = _retry_after(response)
+                await response.aclose()
+                if delay is not None:
+                    attempt += 1
+                    self._count(retries=1)
+                    await asyncio.sleep(min(delay, self.max_backoff))
+                    continue
+
+            attempt += 1
+            self._count(retries=1)
+            await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    async def _atrace(self, event, info):
+        self._trace(event, info)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _service_config(name):
+    config = dict(SERVICES[name])
+    prefix = name.upper()
+    for option, default in config.items():
+        value = os.getenv(f"{prefix}_{option.upper()}")
+        if value is not None:
+            config[option] = type(default)(value)
+    return config
+
+
+def get_http_client(name):
+    """The shared ServiceClient for a service in SERVICES, created on first use."""
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = ServiceClient(name, **_service_config(name))
+        return _clients[name]
+
+
+def get_async_http_client(name):
+    """The shared AsyncServiceClient for a service, created on first use.
+
+    Its stats are reported by http_stats() as "<name>_async".
+    """
+    key = f"{name}_async"
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = AsyncServiceClient(name, **_service_config(name))
+        return _clients[key]
+
+
+async def close_async_http_clients():
+    """Close the pooled connections of every async client, e.g. on ASGI shutdown."""
+    with _clients_lock:
+        keys = [key for key, client in _clients.items() if isinstance(client, AsyncServiceClient)]
+        clients = [_clients.pop(key) for key in keys]
+    for client in clients:
+        await client.close()
+
+
+def http_stats():
+    """Request, retry and connection counts for every service used so far."""
+    with _clients_lock:
+        clients = dict(_clients)
+    return {name: client.stats() for name, client in clients.items()}
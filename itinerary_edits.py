@@ -0,0 +1,207 @@
+# itinerary_edits.py
+import json
+import re
+
+import json_patch
+from prompt_builder import PromptTooLarge
+
+# Words in a modification request that point at a part of the day
+SECTION_WORDS = {
+    "morning": "morning", "breakfast": "morning", "brunch": "morning",
+    "afternoon": "afternoon", "lunch": "afternoon",
+    "evening": "evening", "dinner": "evening", "night": "evening", "nightlife": "evening",
+}
+ORDINALS = {
+    "first": 1, "second": 2, "third": 3, "fourth": 4, "fifth": 5,
+    "sixth": 6, "seventh": 7, "eighth": 8, "ninth": 9, "tenth": 10,
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+STOPWORDS = {
+    "about", "after", "also", "instead", "something", "somewhere", "place", "please",
+    "change", "replace", "swap", "visit", "with", "without", "more", "less", "into",
+    "from", "that", "this", "there", "their", "them", "then", "than", "want", "would",
+    "could", "should", "make", "have", "some", "other", "another", "cheaper", "better",
+}
+
+_DAY_NUMBER = re.compile(r"\bday\s*#?\s*(\d+)\b")
+_DAY_WORD = re.compile(r"\b(?:day\s+(\w+)|(\w+)\s+day)\b")
+
+
+class EditError(ValueError):
+    """The model's answer to an edit could not be merged into the itinerary."""
+
+
+class InvalidEditTarget(ValueError):
+    """The request names a day the itinerary doesn't have."""
+
+
+def classify_edit(modification, itinerary):
+    """JSON pointers to the parts of `itinerary` a modification touches.
+
+    Days are found from "day 3", "third day", "last day" or a weekday name;
+    parts of the day from words such as "morning" or "dinner"; travel tips
+    from "tip". Unless a part of the day is named, the sections whose
+    activities share a distinctive word with the request ("swap the museum")
+    are preferred over whole days. Only if nothing at all matches is every
+    day's activities returned. A section the itinerary doesn't have (tips
+    on a day without any) is edited through the day's activities instead.
+
+    Raises InvalidEditTarget for a day outside the trip ("day 5" of 2).
+    """
+    text = modification.lower()
+    days = itinerary.get("days", [])
+    count = len(days)
+
+    day_numbers = set()
+    for match in _DAY_NUMBER.finditer(text):
+        day_numbers.add(int(match.group(1)))
+    for match in _DAY_WORD.finditer(text):
+        word = match.group(1) or match.group(2)
+        if word == "last":
+            day_numbers.add(count)
+        elif word in ORDINALS:
+            day_numbers.add(ORDINALS[word])
+    for index, day in enumerate(days):
+        weekday = day.get("date", "").split(",", 1)[0].lower()
+        if weekday in WEEKDAYS and re.search(rf"\b{weekday}\b", text):
+            day_numbers.add(index + 1)
+    missing = sorted(n for n in day_numbers if not 1 <= n <= count)
+    if missing:
+        raise InvalidEditTarget(
+            f"The itinerary has {count} day(s); there is no day {', '.join(str(n) for n in missing)}"
+        )
+    indexes = sorted(n - 1 for n in day_numbers)
+
+    sections = sorted({section for word, section in SECTION_WORDS.items() if re.search(rf"\b{word}s?\b", text)})
+    wants_tips = re.search(r"\btips?\b", text) is not None
+
+    if not indexes and not sections:
+        if wants_tips and "travel_tips" in itinerary:
+            return ["/travel_tips"]
+        pointers = _content_matches(text, days, range(count))
+        if pointers:
+            return pointers
+        return [f"/days/{index}/activities" for index in range(count)]
+
+    if indexes and not sections:
+        if wants_tips:
+            return [
+                f"/days/{index}/activities/tips" if "tips" in days[index].get("activities", {})
+                else f"/days/{index}/activities"
+                for index in indexes
+            ]
+        pointers = _content_matches(text, days, indexes)
+        if pointers:
+            return pointers
+        # The whole day is in play, including what it costs
+        pointers = []
+        for index in indexes:
+            pointers.append(f"/days/{index}/activities")
+            if "estimated_cost" in days[index]:
+                pointers.append(f"/days/{index}/estimated_cost")
+        return pointers
+
+    return [
+        f"/days/{index}/activities/{section}"
+        for index in (indexes or range(count))
+        for section in sections
+        if section in days[index].get("activities", {})
+    ] or [f"/days/{index}/activities" for index in (indexes or range(count))]
+
+
+def _content_matches(text, days, indexes):
+    words = {word for word in re.findall(r"[a-z']{4,}", text) if word not in STOPWORDS}
+    words -= set(ORDINALS) | set(WEEKDAYS) | {"day", "days", "last"}
+    if not words:
+        return []
+    pointers = []
+    for index in indexes:
+        for section, items in days[index].get("activities", {}).items():
+            content = " ".join(items).lower()
+            if any(re.search(rf"\b{re.escape(word)}", content) for word in words):
+                pointers.append(f"/days/{index}/activities/{section}")
+    return pointers
+
+
+def merge_edit(itinerary, pointers, response_text):
+    """JSON Patch that applies the model's edited fragments to `itinerary`."""
+    try:
+        edited = json.loads(response_text)
+    except json.JSONDecodeError as e:
+        raise EditError(f"Model returned invalid JSON: {e}")
+    if not isinstance(edited, dict):
+        raise EditError("Model did not return a JSON object")
+
+    patch = []
+    for pointer in pointers:
+        if pointer not in edited:
+            continue
+        original = json_patch.resolve(itinerary, pointer)
+        value = edited[pointer]
+        if type(value) is not type(original):
+            raise EditError(f"Model changed the shape of {pointer}")
+        patch.extend(json_patch.diff(original, value, pointer))
+
+    # A planned route no longer matches a day whose activities changed
+    for index in sorted({int(op["path"].split("/")[2]) for op in patch if op["path"].startswith("/days/")}):
+        if "route" in itinerary["days"][index]:
+            patch.append({"op": "remove", "path": f"/days/{index}/route"})
+    return patch
+
+
+def modify_itinerary(itinerary, modification, generate, prompts, session_key=None, version=None):
+    """Apply a free-text modification by regenerating only what it touches.
+
+    `prompts` is the prompt_builder.PromptBuilder that writes the prompt
+    and keeps the conversation; `session_key` and `version` identify the
+    itinerary and the version being edited, so consecutive edits continue
+    it. `generate(prompt, context)` returns Ollama's response. Sections that
+    don't fit the prompt budget are edited in further rounds of the same
+    conversation, as many as PromptBuilder.rounds_for allows. Returns the
+    updated itinerary and the JSON Patch that produced it; raises EditError
+    if an answer can't be merged and PromptTooLarge if a single section
+    doesn't fit the budget, in which case nothing is applied.
+    """
+    pointers = classify_edit(modification, itinerary)
+    produces = version + 1 if version is not None else None
+    patch = []
+    rounds = prompts.rounds_for(itinerary, pointers)
+    for _ in range(rounds):
+        prompt = prompts.build(itinerary, modification, pointers, session_key, version)
+        response = generate(prompt.text, prompt.context)
+        round_patch = merge_edit(itinerary, prompt.pointers, response.response)
+        itinerary = json_patch.apply(itinerary, round_patch)
+        prompts.record(prompt, response, itinerary, session_key, version, produces)
+        patch += round_patch
+        if not prompt.dropped:
+            return itinerary, patch
+        pointers, version = prompt.dropped, produces
+    raise _unfinished(rounds, pointers)
+
+
+async def modify_itinerary_async(itinerary, modification, generate, prompts, session_key=None, version=None):
+    """modify_itinerary for a coroutine `generate(prompt, context)`."""
+    pointers = classify_edit(modification, itinerary)
+    produces = version + 1 if version is not None else None
+    patch = []
+    rounds = prompts.rounds_for(itinerary, pointers)
+    for _ in range(rounds):
+        prompt = prompts.build(itinerary, modification, pointers, session_key, version)
+        response = await generate(prompt.text, prompt.context)
+        round_patch = merge_edit(itinerary, prompt.pointers, response.response)
+        itinerary = json_patch.apply(itinerary, round_patch)
+        prompts.record(prompt, response, itinerary, session_key, version, produces)
+        patch += round_patch
+        if not prompt.dropped:
+            return itinerary, patch
+        pointers, version = prompt.dropped, produces
+    raise _unfinished(rounds, pointers)
+
+
+def _unfinished(rounds, pointers):
+    return PromptTooLarge(
+        f"Edit needs more than {rounds} prompts within the token budget; "
+        f"not edited: {', '.join(pointers)}"
+    )
@@ -0,0 +1,134 @@
+# itinerary_parser.py
+from datetime import timedelta
+
+# Every header the itinerary prompt asks the model to use. "DAY " starts a new
+# day; the rest start a section within the current day.
+SECTIONS = {
+    "MORNING:": "morning",
+    "AFTERNOON:": "afternoon",
+    "EVENING:": "evening",
+    "DAILY TIPS:": "tips",
+    "ESTIMATED DAILY COST:": "cost",
+}
+MARKERS = ("DAY ",) + tuple(SECTIONS)
+
+
+class DayParser:
+    """Single-pass parser for the DAY / MORNING: / ... sections of an itinerary.
+
+    Feed it the model output in chunks of any size and it returns each day as
+    soon as the next one starts, so it works on a token stream as well as on
+    a complete response. Header positions are found in one sweep and each
+    section is sliced out between consecutive headers, instead of
+    re-splitting every day once per section.
+
+    A section runs until the next header of any kind, and if a header repeats
+    within a day only its first occurrence counts.
+    """
+
+    def __init__(self, arrival_date):
+        self.arrival_date = arrival_date
+        self._buffer = ""
+        self._day_number = 0
+        self._sections = {}
+        self._pieces = None
+
+    def feed(self, text):
+        """Add more model output; returns the days completed by it."""
+        self._buffer += text
+        # Headers never span lines, so only whole lines are scanned and a
+        # header split across two chunks is still found
+        cut = self._buffer.rfind("\n") + 1
+        if not cut:
+            return []
+        ready, self._buffer = self._buffer[:cut], self._buffer[cut:]
+        return self._consume(ready)
+
+    def close(self):
+        """Flush the remaining output; returns the final day, if any."""
+        days = self._consume(self._buffer)
+        self._buffer = ""
+        if self._day_number:
+            days.append(self._build_day())
+            self._day_number = 0
+        return days
+
+    def _consume(self, text):
+        # Collect every header position with C-level str.find, then walk them
+        # in order, slicing the text between consecutive headers
+        headers = []
+        for marker in MARKERS:
+            start = text.find(marker)
+            while start != -1:
+                headers.append((start, marker))
+                start = text.find(marker, start + len(marker))
+        headers.sort()
+
+        days = []
+        pos = 0
+        for start, marker in headers:
+            if self._pieces is not None:
+                self._pieces.append(text[pos:start])
+            pos = start + len(marker)
+
+            if marker == "DAY ":
+                if self._day_number:
+                    days.append(self._build_day())
+                self._day_number += 1
+                self._sections = {}
+                self._pieces = None
+            elif not self._day_number or SECTIONS[marker] in self._sections:
+                # Preamble before the first day, or a repeated header
+                self._pieces = None
+            else:
+                self._pieces = self._sections[SECTIONS[marker]] = []
+
+        if self._pieces is not None:
+            self._pieces.append(text[pos:])
+        return days
+
+    def _build_day(self):
+        text = {key: "".join(pieces).strip() for key, pieces in self._sections.items()}
+
+        day_parts = {}
+        if "morning" in text:
+            day_parts["morning"] = _split_items(text["morning"])
+        if "afternoon" in text:
+            day_parts["afternoon"] = _split_items(text["afternoon"])
+        if "evening" in text:
+            day_parts["evening"] = _evening_items(text["evening"])
+        if "tips" in text:
+            day_parts["tips"] = _split_items(text["tips"])
+
+        current_date = self.arrival_date + timedelta(days=self._day_number - 1)
+        return {
+            "day_number": self._day_number,
+            "date": current_date.strftime("%A, %B %d, %Y"),
+            "activities": day_parts,
+            "estimated_cost": text.get("cost", "").split("\n", 1)[0].strip()
+        }
+
+
+def parse_days(text, arrival_date):
+    """Parse a complete model response into the itinerary's `days` list."""
+    parser = DayParser(arrival_date)
+    days = parser.feed(text)
+    days.extend(parser.close())
+    return days
+
+
+def _split_items(content):
+    return [item for item in map(str.strip, content.split("\n- ")) if item]
+
+
+def _evening_items(content):
+    activities = []
+    for line in map(str.strip, content.split("\n")):
+        if line[:1] in ("-", "*"):
+            line = line[1:].strip()
+            if line:
+                activities.append(line)
+        elif line and not line.startswith("**") and "Food recommendation:" not in line:
+            # Catch any non-empty lines that don't start with list markers
+            activities.append(line)
+    return activities
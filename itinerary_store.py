@@ -0,0 +1,294 @@
+# itinerary_store.py
+import os
+import uuid
+from datetime import datetime
+
+import json_codec
+import json_patch
+import storage_codec
+
+# Schema this module expects, on top of the existing itineraries table:
+#
+#   alter table itineraries add column if not exists version integer;
+#   alter table itineraries add column if not exists updated_at timestamptz;
+#   create table if not exists itinerary_versions (
+#       itinerary_id uuid not null references itineraries (id) on delete cascade,
+#       version integer not null,
+#       kind text not null,          -- 'snapshot' or 'delta'
+#       data jsonb not null,         -- full itinerary, or JSON Patch from version - 1
+#       created_at timestamptz not null default now(),
+#       primary key (itinerary_id, version)
+#   );
+
+SNAPSHOT = "snapshot"
+DELTA = "delta"
+
+
+class VersionConflict(Exception):
+    """The itinerary changed since the version an edit was made from."""
+
+
+class ItineraryStore:
+    """Itinerary persistence around a stable id, with compact version history.
+
+    The itineraries row always holds the current version and is upserted in
+    place on every edit, so a session produces one row no matter how many
+    edits it makes. Each version is also recorded in itinerary_versions:
+    the first one, and every `snapshot_every`-th after it, as a full
+    snapshot, and the rest as the JSON Patch from the version before. Any
+    version is rebuilt from the nearest snapshot plus at most
+    `snapshot_every - 1` small deltas.
+
+    `storage_format` is how itinerary_data is written; see storage_codec.
+    Rows in any format are read.
+    """
+
+    def __init__(self, supabase, snapshot_every=10, storage_format=storage_codec.TEXT):
+        self.supabase = supabase
+        self.snapshot_every = snapshot_every
+        self.storage_format = storage_format
+
+    def create(self, itinerary, itinerary_id=None, encoded=None, **fields):
+        """Store a new itinerary as version 1; returns its id.
+
+        `encoded` is the itinerary's json_codec.dumps() bytes, if the caller
+        already has them. Extra `fields` (user_id, ...) are written to the
+        itineraries row.
+        """
+        itinerary_id = itinerary_id or str(uuid.uuid4())
+        row = _new_row(itinerary_id, itinerary, fields, self._stored(itinerary, encoded))
+        self.supabase.table('itineraries').insert(row).execute()
+        self._record(itinerary_id, 1, SNAPSHOT, itinerary)
+        return itinerary_id
+
+    def create_many(self, itineraries, encoded=None, ids=None, **fields):
+        """Store several new itineraries with one insert per table; returns their ids.
+
+        `ids` are used instead of new ones if given, one per itinerary.
+        """
+        ids = ids or [str(uuid.uuid4()) for _ in itineraries]
+        encoded = encoded or [None] * len(itineraries)
+        if itineraries:
+            self.supabase.table('itineraries').insert([
+                _new_row(itinerary_id, itinerary, fields, self._stored(itinerary, data))
+                for itinerary_id, itinerary, data in zip(ids, itineraries, encoded)
+            ]).execute()
+            self.supabase.table('itinerary_versions').insert([
+                _version_row(itinerary_id, 1, SNAPSHOT, itinerary) for itinerary_id, itinerary in zip(ids, itineraries)
+            ]).execute()
+        return ids
+
+    def load(self, itinerary_id):
+        """The current itinerary and its version, or (None, None) if there is none."""
+        response = self.supabase.table('itineraries').select(
+            'itinerary_data, version'
+        ).eq('id', itinerary_id).execute()
+        return _current(response.data)
+
+    def save(self, itinerary_id, itinerary, previous=None, version=None, patch=None, encoded=None):
+        """Store a new current version of an itinerary; returns its version number.
+
+        `previous` and `version` describe the version being replaced and are
+        loaded if not given. `patch` and `encoded`, if the caller already
+        has them, save diffing the two and encoding the itinerary again.
+
+        The version is recorded first; its primary key lets only one save
+        from a given version through. The current row is then only updated
+        if it is still at `version`. Raises VersionConflict otherwise, and
+        nothing is changed.
+        """
+        if previous is None or version is None:
+            previous, version = self.load(itinerary_id)
+        expected = version or 0
+        version = expected + 1
+
+        try:
+            self._record(itinerary_id, version, *self._version_entry(itinerary, previous, version, patch))
+        except Exception as e:
+            if _is_duplicate(e):
+                raise VersionConflict(f"Itinerary {itinerary_id} already has a version {version}") from e
+            raise
+        try:
+            row = _updated_row(itinerary_id, itinerary, version, self._stored(itinerary, encoded))
+            updated = _at_version(self.supabase.table('itineraries').update(row).eq('id', itinerary_id),
+                                  expected).execute()
+        except BaseException:
+            self._forget(itinerary_id, version)
+            raise
+        if not updated.data:
+            self._forget(itinerary_id, version)
+            raise VersionConflict(f"Itinerary {itinerary_id} is no longer at version {expected}")
+        return version
+
+    def _stored(self, itinerary, encoded):
+        return storage_codec.encode(itinerary, self.storage_format, encoded)
+
+    def _version_entry(self, itinerary, previous, version, patch):
+        # Rows written before version history existed have nothing to diff
+        # against, so their first recorded version is a snapshot
+        if previous is None or (version - 1) % self.snapshot_every == 0:
+            return SNAPSHOT, itinerary
+        if patch is None:
+            patch = json_patch.diff(previous, itinerary)
+        return DELTA, patch
+
+    def load_version(self, itinerary_id, version):
+        """Rebuild a past version from its nearest snapshot and the deltas after it."""
+        snapshots = self.supabase.table('itinerary_versions').select('version, data').eq(
+            'itinerary_id', itinerary_id
+        ).eq('kind', SNAPSHOT).lte('version', version).order('version', desc=True).limit(1).execute()
+        if not snapshots.data:
+            return None
+        base = snapshots.data[0]
+        deltas = self.supabase.table('itinerary_versions').select('version, data').eq(
+            'itinerary_id', itinerary_id
+        ).eq('kind', DELTA).gt('version', base['version']).lte('version', version).order('version').execute()
+        return _rebuild(base, deltas.data)
+
+    def history(self, itinerary_id):
+        """Version numbers, kinds and timestamps, oldest first."""
+        response = self.supabase.table('itinerary_versions').select(
+            'version, kind, created_at'
+        ).eq('itinerary_id', itinerary_id).order('version').execute()
+        return response.data
+
+    def _record(self, itinerary_id, version, kind, data):
+        self.supabase.table('itinerary_versions').insert(_version_row(itinerary_id, version, kind, data)).execute()
+
+    def _forget(self, itinerary_id, version):
+        self.supabase.table('itinerary_versions').delete().eq('itinerary_id', itinerary_id).eq(
+            'version', version
+        ).execute()
+
+
+class AsyncItineraryStore(ItineraryStore):
+    """ItineraryStore on the async Supabase client, for the ASGI server."""
+
+    async def create(self, itinerary, itinerary_id=None, encoded=None, **fields):
+        itinerary_id = itinerary_id or str(uuid.uuid4())
+        row = _new_row(itinerary_id, itinerary, fields, self._stored(itinerary, encoded))
+        await self.supabase.table('itineraries').insert(row).execute()
+        await self._record(itinerary_id, 1, SNAPSHOT, itinerary)
+        return itinerary_id
+
+    async def load(self, itinerary_id):
+        response = await self.supabase.table('itineraries').select(
+            'itinerary_data, version'
+        ).eq('id', itinerary_id).execute()
+        return _current(response.data)
+
+    async def save(self, itinerary_id, itinerary, previous=None, version=None, patch=None, encoded=None):
+        if previous is None or version is None:
+            previous, version = await self.load(itinerary_id)
+        expected = version or 0
+        version = expected + 1
+
+        try:
+            await self._record(itinerary_id, version, *self._version_entry(itinerary, previous, version, patch))
+        except Exception as e:
+            if _is_duplicate(e):
+                raise VersionConflict(f"Itinerary {itinerary_id} already has a version {version}") from e
+            raise
+        try:
+            row = _updated_row(itinerary_id, itinerary, version, self._stored(itinerary, encoded))
+            updated = await _at_version(self.supabase.table('itineraries').update(row).eq('id', itinerary_id),
+                                        expected).execute()
+        except BaseException:
+            await self._forget(itinerary_id, version)
+            raise
+        if not updated.data:
+            await self._forget(itinerary_id, version)
+            raise VersionConflict(f"Itinerary {itinerary_id} is no longer at version {expected}")
+        return version
+
+    async def load_version(self, itinerary_id, version):
+        snapshots = await self.supabase.table('itinerary_versions').select('version, data').eq(
+            'itinerary_id', itinerary_id
+        ).eq('kind', SNAPSHOT).lte('version', version).order('version', desc=True).limit(1).execute()
+        if not snapshots.data:
+            return None
+        base = snapshots.data[0]
+        deltas = await self.supabase.table('itinerary_versions').select('version, data').eq(
+            'itinerary_id', itinerary_id
+        ).eq('kind', DELTA).gt('version', base['version']).lte('version', version).order('version').execute()
+        return _rebuild(base, deltas.data)
+
+    async def history(self, itinerary_id):
+        response = await self.supabase.table('itinerary_versions').select(
+            'version, kind, created_at'
+        ).eq('itinerary_id', itinerary_id).order('version').execute()
+        return response.data
+
+    async def _record(self, itinerary_id, version, kind, data):
+        await self.supabase.table('itinerary_versions').insert(
+            _version_row(itinerary_id, version, kind, data)
+        ).execute()
+
+    async def _forget(self, itinerary_id, version):
+        await self.supabase.table('itinerary_versions').delete().eq('itinerary_id', itinerary_id).eq(
+            'version', version
+        ).execute()
+
+
+def _new_row(itinerary_id, itinerary, fields, stored):
+    return {
+        "id": itinerary_id,
+        "itinerary_data": stored,
+        "destination": itinerary.get("destination"),
+        "budget": itinerary.get("budget"),
+        "version": 1,
+        "created_at": datetime.now().isoformat(),
+        **fields
+    }
+
+
+def _updated_row(itinerary_id, itinerary, version, stored):
+    return {
+        "id": itinerary_id,
+        "itinerary_data": stored,
+        "destination": itinerary.get("destination"),
+        "budget": itinerary.get("budget"),
+        "version": version,
+        "updated_at": datetime.now().isoformat()
+    }
+
+
+def _at_version(query, version):
+    # Rows written before versions existed have none
+    return query.eq('version', version) if version else query.is_('version', 'null')
+
+
+def _is_duplicate(error):
+    # Postgres unique_violation, as reported by PostgREST
+    return getattr(error, "code", None) == "23505"
+
+
+def _version_row(itinerary_id, version, kind, data):
+    return {"itinerary_id": itinerary_id, "version": version, "kind": kind, "data": data}
+
+
+def _current(rows):
+    if not rows:
+        return None, None
+    row = rows[0]
+    return storage_codec.decode(row['itinerary_data']), row.get('version') or 0
+
+
+def _rebuild(base, deltas):
+    itinerary = _decode(base['data'])
+    for delta in deltas:
+        itinerary = json_patch.apply(itinerary, _decode(delta['data']))
+    return itinerary
+
+
+def _decode(data):
+    # jsonb comes back parsed; tolerate rows written as text
+    return json_codec.loads(data) if isinstance(data, str) else data
+
+
+def create_itinerary_store(supabase, store_class=ItineraryStore):
+    return store_class(
+        supabase,
+        snapshot_every=int(os.getenv("ITINERARY_SNAPSHOT_EVERY", 10)),
+        storage_format=os.getenv("ITINERARY_STORAGE_FORMAT", storage_codec.TEXT)
+    )
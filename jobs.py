@@ -0,0 +1,323 @@
+# jobs.py
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the runner's queue is full."""
+
+    def __init__(self, retry_after):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+
+class InMemoryJobStore:
+    """Jobs kept in a dict; finished jobs beyond `max_jobs` are dropped oldest first."""
+
+    def __init__(self, max_jobs=10000):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+            if len(self._jobs) > self.max_jobs:
+                for job_id in [i for i, j in self._jobs.items() if j["status"] in FINISHED]:
+                    del self._jobs[job_id]
+                    if len(self._jobs) <= self.max_jobs:
+                        break
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields, updated_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def unfinished(self):
+        with self._lock:
+            return [dict(job) for job in self._jobs.values() if job["status"] not in FINISHED]
+
+    def orphaned(self, stale_before):
+        """Unfinished jobs with no owner, or whose owner stopped heartbeating before `stale_before`."""
+        with self._lock:
+            return [dict(job) for job in self._jobs.values() if _is_orphan(job, stale_before)]
+
+    def claim(self, job_id, owner, stale_before):
+        """Requeue an orphaned job for `owner`; False if it isn't orphaned (any more)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or not _is_orphan(job, stale_before):
+                return False
+            now = time.time()
+            job.update(status=QUEUED, stage=None, owner=owner, heartbeat_at=now, updated_at=now)
+            return True
+
+    def heartbeat(self, owner):
+        """Mark `owner` alive on every unfinished job it holds."""
+        with self._lock:
+            now = time.time()
+            for job in self._jobs.values():
+                if job.get("owner") == owner and job["status"] not in FINISHED:
+                    job["heartbeat_at"] = now
+
+
+def _is_orphan(job, stale_before):
+    if job["status"] in FINISHED:
+        return False
+    return not job.get("owner") or (job.get("heartbeat_at") or 0) < stale_before
+
+
+class SQLiteJobStore:
+    """Jobs kept in SQLite, so status and results survive a restart.
+
+    Finished jobs older than `ttl` seconds are pruned as new ones arrive.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    payload TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    owner TEXT,
+                    heartbeat_at REAL
+                )
+            """)
+            # Tables created before jobs had owners
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (("owner", "TEXT"), ("heartbeat_at", "REAL")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    def create(self, job):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, stage, payload, result, error, created_at, updated_at, owner, heartbeat_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], job["status"], job.get("stage"), json.dumps(job.get("payload")),
+                 json.dumps(job.get("result")), job.get("error"), job["created_at"], job["updated_at"],
+                 job.get("owner"), job.get("heartbeat_at"))
+            )
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (*FINISHED, time.time() - self.ttl)
+            )
+
+    def update(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        if "payload" in fields:
+            fields["payload"] = json.dumps(fields["payload"])
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._conn:
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def unfinished(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE status NOT IN (?, ?) ORDER BY created_at", FINISHED
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def orphaned(self, stale_before):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE status NOT IN (?, ?) "
+                "AND (owner IS NULL OR heartbeat_at IS NULL OR heartbeat_at < ?) ORDER BY created_at",
+                (*FINISHED, stale_before)
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def claim(self, job_id, owner, stale_before):
+        # One conditional update, so two processes can't both take a job
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, stage = NULL, owner = ?, heartbeat_at = ?, updated_at = ? "
+                "WHERE id = ? AND status NOT IN (?, ?) "
+                "AND (owner IS NULL OR heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (QUEUED, owner, now, now, job_id, *FINISHED, stale_before)
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, owner):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status NOT IN (?, ?)",
+                (time.time(), owner, *FINISHED)
+            )
+
+    @staticmethod
+    def _to_job(row):
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+def create_job_store():
+    """The job store selected by JOB_STORE ("memory", the default, or "sqlite")."""
+    if os.getenv("JOB_STORE", "memory") == "sqlite":
+        return SQLiteJobStore(os.getenv("JOB_DB_PATH", "nexplan_jobs.sqlite3"))
+    return InMemoryJobStore()
+
+
+class JobRunner:
+    """Runs jobs on a bounded worker pool and records their progress in a store.
+
+    `pipeline(payload, progress)` does the work: it calls `progress(stage)` as
+    it moves through its stages and returns a JSON-serializable result. At
+    most `max_workers` jobs run at once and at most `max_queued` more wait;
+    beyond that submit() raises QueueFullError.
+
+    Every job records the runner that holds it, and the runner heartbeats
+    its jobs every `heartbeat_interval` seconds. A job whose runner hasn't
+    done so for `orphan_after` seconds was left by a process that is gone;
+    resume() takes such jobs over, and runners sharing a store keep
+    checking for them, so a live runner's jobs are never run twice.
+    """
+
+    def __init__(self, store, pipeline, max_workers=4, max_queued=100, retry_after=30,
+                 heartbeat_interval=10, orphan_after=60):
+        self.store = store
+        self.pipeline = pipeline
+        self.retry_after = retry_after
+        self.heartbeat_interval = heartbeat_interval
+        self.orphan_after = orphan_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        # Orphaned jobs waiting for a free slot
+        self._backlog = deque()
+        self._backlog_lock = threading.Lock()
+        self._heartbeat = None
+        self._heartbeat_lock = threading.Lock()
+
+    def submit(self, payload):
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(self.retry_after)
+        now = time.time()
+        job = {
+            "id": str(uuid.uuid4()),
+            "status": QUEUED,
+            "stage": None,
+            "payload": payload,
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now,
+            "owner": self.owner,
+            "heartbeat_at": now,
+        }
+        self._start_heartbeat()
+        try:
+            self.store.create(job)
+            self._executor.submit(self._run, job["id"], payload)
+        except Exception:
+            self._slots.release()
+            raise
+        return job["id"]
+
+    def resume(self):
+        """Requeue jobs that a process which is gone left queued or running.
+
+        As many start as there are free slots; the rest follow as slots
+        free up. Returns how many were started now.
+        """
+        self._start_heartbeat()
+        return self._resume_orphans()
+
+    def _resume_orphans(self):
+        with self._backlog_lock:
+            if not self._backlog:
+                self._backlog.extend(self.store.orphaned(self._stale_before()))
+        return self._drain_backlog()
+
+    def _drain_backlog(self):
+        resumed = 0
+        while True:
+            if not self._slots.acquire(blocking=False):
+                return resumed
+            with self._backlog_lock:
+                job = self._backlog.popleft() if self._backlog else None
+            # Another runner may have taken the job since it was listed
+            if job is None or not self.store.claim(job["id"], self.owner, self._stale_before()):
+                self._slots.release()
+                if job is None:
+                    return resumed
+                continue
+            try:
+                self._executor.submit(self._run, job["id"], job["payload"])
+            except Exception:
+                self._slots.release()
+                raise
+            resumed += 1
+
+    def _stale_before(self):
+        return time.time() - self.orphan_after
+
+    def _start_heartbeat(self):
+        with self._heartbeat_lock:
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+                self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.store.heartbeat(self.owner)
+                # Pick up jobs left by a sibling process that has since died
+                self._resume_orphans()
+            except Exception as e:
+                print(f"Job heartbeat failed: {e}")
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def _run(self, job_id, payload):
+        try:
+            self.store.update(job_id, status=RUNNING)
+            result = self.pipeline(payload, lambda stage: self.store.update(job_id, stage=stage))
+            self.store.update(job_id, status=SUCCEEDED, stage="done", result=result)
+        except Exception as e:
+            self.store.update(job_id, status=FAILED, error=str(e))
+        finally:
+            self._slots.release()
+            if self._backlog:
+                self._drain_backlog()
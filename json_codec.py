@@ -0,0 +1,97 @@
+# json_codec.py
+"""JSON encoding for API responses and stored itineraries.
+
+Uses orjson when it is installed, which encodes several times faster than
+the json module and produces bytes ready to send. Without it everything
+falls back to json with compact separators, so output is the same JSON
+either way (key order included; keys are not sorted).
+
+An itinerary is encoded once with dumps(), and those bytes are stored and
+spliced into the response with envelope() instead of being encoded again.
+"""
+import dataclasses
+import decimal
+import json
+import uuid
+from datetime import date
+
+from flask.json.provider import JSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _default(obj):
+    # The types Flask's own provider handles, converted the same way, so
+    # responses don't change with the backend. datetime is passed through
+    # to here as well, since orjson would otherwise write it as ISO 8601.
+    if isinstance(obj, date):
+        return http_date(obj)
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if ORJSON_AVAILABLE:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        """obj as compact UTF-8 JSON bytes."""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(obj):
+        """obj as compact UTF-8 JSON bytes."""
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
+
+
+def dumps_str(obj):
+    """dumps() as text, for columns and APIs that want a str."""
+    return dumps(obj).decode("utf-8")
+
+
+def envelope(fields, **encoded):
+    """A JSON object of `fields` plus already-encoded values under the given keys.
+
+    envelope({"status": "success"}, itinerary=encoded) gives
+    {"status":"success","itinerary":<encoded>} without decoding or
+    re-encoding the itinerary.
+    """
+    body = dumps(fields)[:-1]
+    for key, value in encoded.items():
+        if body != b"{":
+            body += b","
+        body += dumps(key) + b":" + value
+    return body + b"}"
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask JSON provider on dumps()/loads(), for jsonify and request.get_json.
+
+        app.json = FastJSONProvider(app)
+    """
+
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return dumps_str(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
@@ -0,0 +1,101 @@
+# json_patch.py
+import copy
+
+
+def escape(token):
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def split_pointer(pointer):
+    """JSON Pointer (RFC 6901) to its list of tokens; "" is the whole document."""
+    if not pointer:
+        return []
+    if not pointer.startswith("/"):
+        raise ValueError(f"Invalid JSON pointer: {pointer!r}")
+    return [unescape(token) for token in pointer[1:].split("/")]
+
+
+def resolve(doc, pointer):
+    """The value `pointer` refers to inside `doc`."""
+    for token in split_pointer(pointer):
+        doc = doc[int(token)] if isinstance(doc, list) else doc[token]
+    return doc
+
+
+def diff(old, new, path=""):
+    """JSON Patch (RFC 6902) operations that turn `old` into `new`.
+
+    Dicts are compared key by key and equal-length lists item by item, so a
+    change deep inside an itinerary becomes one small "replace" rather than
+    a copy of the whole document. Lists that change length are replaced
+    whole, except for items appended or removed at the end.
+    """
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{escape(key)}"})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "add", "path": f"{path}/{escape(key)}", "value": copy.deepcopy(value)})
+            else:
+                ops.extend(diff(old[key], value, f"{path}/{escape(key)}"))
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        shared = min(len(old), len(new))
+        if old[:shared] != new[:shared] and len(old) != len(new):
+            return [{"op": "replace", "path": path, "value": copy.deepcopy(new)}]
+        ops = []
+        for index in range(shared):
+            ops.extend(diff(old[index], new[index], f"{path}/{index}"))
+        for index in range(shared, len(new)):
+            ops.append({"op": "add", "path": f"{path}/{index}", "value": copy.deepcopy(new[index])})
+        # Remove from the end so earlier indexes stay valid
+        for index in range(len(old) - 1, shared - 1, -1):
+            ops.append({"op": "remove", "path": f"{path}/{index}"})
+        return ops
+    return [{"op": "replace", "path": path, "value": copy.deepcopy(new)}]
+
+
+def apply(doc, patch):
+    """A copy of `doc` with the add/remove/replace operations in `patch` applied."""
+    doc = copy.deepcopy(doc)
+    for op in patch:
+        tokens = split_pointer(op["path"])
+        if not tokens:
+            if op["op"] == "remove":
+                raise ValueError("Cannot remove the whole document")
+            doc = copy.deepcopy(op["value"])
+            continue
+
+        parent = doc
+        for token in tokens[:-1]:
+            parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+        last = tokens[-1]
+
+        if isinstance(parent, list):
+            index = len(parent) if last == "-" else int(last)
+            if op["op"] == "add":
+                parent.insert(index, copy.deepcopy(op["value"]))
+            elif op["op"] == "remove":
+                del parent[index]
+            elif op["op"] == "replace":
+                parent[index] = copy.deepcopy(op["value"])
+            else:
+                raise ValueError(f"Unsupported patch operation: {op['op']}")
+        else:
+            if op["op"] in ("add", "replace"):
+                if op["op"] == "replace" and last not in parent:
+                    raise KeyError(op["path"])
+                parent[last] = copy.deepcopy(op["value"])
+            elif op["op"] == "remove":
+                del parent[last]
+            else:
+                raise ValueError(f"Unsupported patch operation: {op['op']}")
+    return doc
@@ -0,0 +1,252 @@
+# llm_client.py
+import hashlib
+import json
+import os
+import threading
+import time
+
+import ollama
+
+from cache import TieredCache, open_store
+from llm_scheduler import PRIORITY_ITINERARY, PRIORITY_NAMES
+from metrics import RATE_BUCKETS, histogram, span
+from singleflight import AsyncSingleFlight, SingleFlight
+
+# Generation parameters that change what the model returns, and so belong in
+# the cache key alongside model, prompt and options
+KEYED_ARGUMENTS = ("suffix", "system", "template", "format", "raw", "context", "images")
+
+tokens_per_second = histogram(
+    "nexplan_llm_tokens_per_second", "Generation speed reported by Ollama",
+    buckets=RATE_BUCKETS, labelnames=("priority",)
+)
+generated_tokens = histogram(
+    "nexplan_llm_generated_tokens", "Tokens generated per call",
+    buckets=(16, 64, 128, 256, 512, 1024, 2048, 4096, 8192), labelnames=("priority",)
+)
+
+
+class LLMClient:
+    """Wrapper around ollama.Client that can cache generate() responses.
+
+    Caching is opt-in per call site: pass `cache_site="travel_tips"` (or any
+    other name) to generate() for prompts whose answer only depends on the
+    prompt itself. Calls without a cache_site, and streaming calls, go
+    straight to Ollama. Hits and misses are counted per call site.
+
+    Identical non-streaming calls that overlap in time are coalesced, so a
+    burst of the same request puts one generation on Ollama's queue.
+
+    With a scheduler, every call that reaches Ollama first waits for a slot
+    at its `priority` (see llm_scheduler); cache hits skip the queue.
+
+    `keep_alive` (seconds, or a duration such as "30m"; negative means
+    forever) is sent with every call, so the model stays loaded for that
+    long after each one instead of Ollama's default five minutes.
+    """
+
+    def __init__(self, client=None, cache=None, scheduler=None, keep_alive=None):
+        self.client = client or ollama.Client()
+        self.cache = cache
+        self.scheduler = scheduler
+        self.keep_alive = keep_alive
+        self.flights = SingleFlight("llm")
+        self._lock = threading.Lock()
+        self._site_stats = {}
+
+    def generate(self, model, prompt, options=None, cache_site=None, priority=PRIORITY_ITINERARY, **kwargs):
+        if kwargs.get("stream"):
+            return self._stream(priority, model=model, prompt=prompt, options=options, **kwargs)
+
+        key = cache_key(model, prompt, options, **kwargs)
+        if cache_site is None or self.cache is None:
+            return self.flights.do(key, lambda: self._generate(
+                priority, model=model, prompt=prompt, options=options, **kwargs
+            ))
+        return self.flights.do(key, lambda: self._cached_generate(
+            key, cache_site, priority, model, prompt, options, kwargs
+        ))
+
+    def warm_up(self, model):
+        """Load `model` into memory and keep it there for `keep_alive`.
+
+        An empty prompt makes Ollama load the model without generating.
+        """
+        self.client.generate(model=model, prompt="", keep_alive=self.keep_alive)
+
+    def _generate(self, priority, **kwargs):
+        kwargs.setdefault("keep_alive", self.keep_alive)
+
+        def call():
+            with span(_stage(priority)):
+                response = self.client.generate(**kwargs)
+            _observe_tokens(response, priority)
+            return response
+
+        if self.scheduler is None:
+            return call()
+        return self.scheduler.run(priority, call)
+
+    def _stream(self, priority, **kwargs):
+        # Take the slot now so a full queue is reported before streaming
+        # starts, and keep it until the stream is exhausted or closed
+        queued_at = time.perf_counter()
+        if self.scheduler is not None:
+            self.scheduler.acquire(priority)
+        started = time.perf_counter()
+        kwargs.setdefault("keep_alive", self.keep_alive)
+        try:
+            chunks = self.client.generate(**kwargs)
+        except BaseException:
+            if self.scheduler is not None:
+                self.scheduler.release()
+            raise
+        return self._release_after(chunks, priority, started - queued_at, started)
+
+    def _release_after(self, chunks, priority, queue_wait, started):
+        last = None
+        try:
+            with span(_stage(priority)):
+                for last in chunks:
+                    yield last
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.release()
+                self.scheduler.record(priority, queue_wait, time.perf_counter() - started)
+            # The final chunk carries the counts for the whole generation
+            if last is not None:
+                _observe_tokens(last, priority)
+
+    def _cached_generate(self, key, cache_site, priority, model, prompt, options, kwargs):
+        generated = []
+
+        def load():
+            response = self._generate(priority, model=model, prompt=prompt, options=options, **kwargs)
+            generated.append(response)
+            # The context token list is large and only useful to continue
+            # this exact conversation, so it isn't worth storing
+            return response.model_dump(mode="json", exclude={"context"}, exclude_none=True)
+
+        cached = self.cache.get_or_load(key, load)
+        if generated:
+            self._count(cache_site, "misses")
+            return generated[0]
+        self._count(cache_site, "hits")
+        return ollama.GenerateResponse(**cached)
+
+    def site_stats(self):
+        """Cache hits and misses for each call site that opted in."""
+        with self._lock:
+            stats = {site: dict(counts) for site, counts in self._site_stats.items()}
+        for counts in stats.values():
+            lookups = counts["hits"] + counts["misses"]
+            counts["hit_ratio"] = round(counts["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _count(self, site, field):
+        with self._lock:
+            counts = self._site_stats.setdefault(site, {"hits": 0, "misses": 0})
+            counts[field] += 1
+
+    def __getattr__(self, name):
+        # Everything else (chat, pull, list, ...) goes to the wrapped client
+        return getattr(self.client, name)
+
+
+class AsyncLLMClient(LLMClient):
+    """LLMClient around ollama.AsyncClient, for the ASGI server.
+
+    Caching, coalescing and scheduling work as in LLMClient, with an
+    AsyncGenerationScheduler. Streaming is not supported.
+    """
+
+    def __init__(self, client=None, cache=None, scheduler=None, keep_alive=None):
+        super().__init__(client or ollama.AsyncClient(), cache, scheduler, keep_alive)
+        self.flights = AsyncSingleFlight("llm_async")
+
+    async def generate(self, model, prompt, options=None, cache_site=None, priority=PRIORITY_ITINERARY, **kwargs):
+        if kwargs.get("stream"):
+            raise ValueError("AsyncLLMClient does not stream")
+
+        key = cache_key(model, prompt, options, **kwargs)
+        if cache_site is None or self.cache is None:
+            return await self.flights.do(key, lambda: self._generate(
+                priority, model=model, prompt=prompt, options=options, **kwargs
+            ))
+        return await self.flights.do(key, lambda: self._cached_generate(
+            key, cache_site, priority, model, prompt, options, kwargs
+        ))
+
+    async def warm_up(self, model):
+        await self.client.generate(model=model, prompt="", keep_alive=self.keep_alive)
+
+    async def _generate(self, priority, **kwargs):
+        kwargs.setdefault("keep_alive", self.keep_alive)
+
+        async def call():
+            with span(_stage(priority)):
+                response = await self.client.generate(**kwargs)
+            _observe_tokens(response, priority)
+            return response
+
+        if self.scheduler is None:
+            return await call()
+        return await self.scheduler.run(priority, call)
+
+    async def _cached_generate(self, key, cache_site, priority, model, prompt, options, kwargs):
+        generated = []
+
+        async def load():
+            response = await self._generate(priority, model=model, prompt=prompt, options=options, **kwargs)
+            generated.append(response)
+            return response.model_dump(mode="json", exclude={"context"}, exclude_none=True)
+
+        cached = await self.cache.get_or_load_async(key, load)
+        if generated:
+            self._count(cache_site, "misses")
+            return generated[0]
+        self._count(cache_site, "hits")
+        return ollama.GenerateResponse(**cached)
+
+
+def _stage(priority):
+    return "llm_" + PRIORITY_NAMES.get(priority, "other")
+
+
+def _observe_tokens(response, priority):
+    count = getattr(response, "eval_count", None)
+    duration = getattr(response, "eval_duration", None)
+    if not count:
+        return
+    name = PRIORITY_NAMES.get(priority, "other")
+    generated_tokens.observe(count, priority=name)
+    if duration:
+        tokens_per_second.observe(count / (duration / 1e9), priority=name)
+
+
+def cache_key(model, prompt, options=None, **kwargs):
+    """Content hash of everything that determines a generate() response."""
+    if isinstance(options, ollama.Options):
+        options = options.model_dump(exclude_none=True)
+    keyed = {name: kwargs.get(name) for name in KEYED_ARGUMENTS if kwargs.get(name) is not None}
+    payload = json.dumps([model, prompt, options or {}, keyed], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def create_llm_cache():
+    return TieredCache(
+        "llm",
+        ttl=int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600)),
+        max_entries=int(os.getenv("LLM_CACHE_SIZE", 512)),
+        store=open_store("llm", max_entries=int(os.getenv("LLM_CACHE_STORE_SIZE", 20000)))
+    )
+
+
+def parse_keep_alive(value):
+    """LLM_KEEP_ALIVE as Ollama takes it: seconds as a number, else a duration string."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
@@ -0,0 +1,201 @@
+# llm_scheduler.py
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Lower runs first: a user waiting on an edit beats a fresh itinerary, which
+# beats the travel tips that accompany it
+PRIORITY_EDIT = 0
+PRIORITY_ITINERARY = 1
+PRIORITY_TIPS = 2
+PRIORITY_NAMES = {PRIORITY_EDIT: "edit", PRIORITY_ITINERARY: "itinerary", PRIORITY_TIPS: "tips"}
+
+
+class AdmissionError(Exception):
+    """Raised when a generation is turned away because the model host is saturated."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GenerationScheduler:
+    """Caps concurrent generations and hands out free slots by priority.
+
+    At most `max_concurrent` generations run at once. Callers beyond that
+    wait in a priority queue (FIFO within a priority). When `max_queue_depth`
+    callers are already waiting, or a caller has waited `max_wait` seconds,
+    AdmissionError is raised so the API can answer 429 instead of piling
+    more work onto Ollama's own queue.
+    """
+
+    def __init__(self, max_concurrent=2, max_queue_depth=32, max_wait=120, retry_after=10):
+        self.max_concurrent = max_concurrent
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._rejected = 0
+        self._samples = {name: deque(maxlen=1000) for name in (*PRIORITY_NAMES.values(), "other")}
+
+    def has_capacity(self):
+        """True if a new generation would be admitted right now."""
+        with self._lock:
+            return self._active < self.max_concurrent or len(self._waiting) < self.max_queue_depth
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_ITINERARY):
+        """Hold a generation slot for the duration of the with-block."""
+        queued_at = time.perf_counter()
+        self.acquire(priority)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release()
+            self.record(priority, started - queued_at, time.perf_counter() - started)
+
+    def record(self, priority, queue_wait, generation):
+        """Add a timing sample for a slot held outside of slot()."""
+        with self._lock:
+            self._samples[PRIORITY_NAMES.get(priority, "other")].append((queue_wait, generation))
+
+    def run(self, priority, fn):
+        with self.slot(priority):
+            return fn()
+
+    def acquire(self, priority=PRIORITY_ITINERARY):
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                return
+            if len(self._waiting) >= self.max_queue_depth:
+                self._rejected += 1
+                raise AdmissionError("Too many generations queued", self.retry_after)
+            entry = (priority, next(self._sequence), threading.Event())
+            heapq.heappush(self._waiting, entry)
+
+        if entry[2].wait(self.max_wait):
+            return
+        with self._lock:
+            # The slot may have been handed over just as the wait timed out
+            if entry[2].is_set():
+                return
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+            self._rejected += 1
+        raise AdmissionError(f"Waited more than {self.max_wait}s for a generation slot", self.retry_after)
+
+    def release(self):
+        with self._lock:
+            # Hand the slot straight to the most urgent waiter, if any
+            if self._waiting:
+                heapq.heappop(self._waiting)[2].set()
+            else:
+                self._active -= 1
+
+    def stats(self):
+        """Queue wait and generation time, reported separately per priority."""
+        with self._lock:
+            stats = {
+                "active": self._active,
+                "queued": len(self._waiting),
+                "max_concurrent": self.max_concurrent,
+                "max_queue_depth": self.max_queue_depth,
+                "rejected": self._rejected,
+            }
+            samples = {name: list(values) for name, values in self._samples.items()}
+
+        for name, values in samples.items():
+            if not values:
+                continue
+            waits = sorted(v[0] for v in values)
+            runs = sorted(v[1] for v in values)
+            stats[name] = {
+                "count": len(values),
+                "queue_wait_seconds": _summary(waits),
+                "generation_seconds": _summary(runs),
+            }
+        return stats
+
+
+class AsyncGenerationScheduler(GenerationScheduler):
+    """GenerationScheduler for coroutines, used by the ASGI server.
+
+    Waiting for a slot suspends the coroutine instead of blocking a thread,
+    so a long queue costs no threads. Must only be used from one event loop.
+    """
+
+    async def run(self, priority, fn):
+        queued_at = time.perf_counter()
+        await self.acquire(priority)
+        started = time.perf_counter()
+        try:
+            return await fn()
+        finally:
+            self.release()
+            self.record(priority, started - queued_at, time.perf_counter() - started)
+
+    async def acquire(self, priority=PRIORITY_ITINERARY):
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                return
+            if len(self._waiting) >= self.max_queue_depth:
+                self._rejected += 1
+                raise AdmissionError("Too many generations queued", self.retry_after)
+            entry = (priority, next(self._sequence), asyncio.get_running_loop().create_future())
+            heapq.heappush(self._waiting, entry)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[2]), self.max_wait)
+            return
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                handed_over = entry[2].done()
+                if not handed_over:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    if isinstance(e, asyncio.TimeoutError):
+                        self._rejected += 1
+            if isinstance(e, asyncio.CancelledError):
+                # A cancelled caller must not keep a slot it was just given
+                if handed_over:
+                    self.release()
+                raise
+            if handed_over:
+                return
+        raise AdmissionError(f"Waited more than {self.max_wait}s for a generation slot", self.retry_after)
+
+    def release(self):
+        with self._lock:
+            if self._waiting:
+                heapq.heappop(self._waiting)[2].set_result(None)
+            else:
+                self._active -= 1
+
+
+def _summary(ordered):
+    return {
+        "mean": round(sum(ordered) / len(ordered), 3),
+        "p50": round(ordered[len(ordered) // 2], 3),
+        "p95": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+def create_scheduler(scheduler_class=GenerationScheduler):
+    return scheduler_class(
+        max_concurrent=int(os.getenv("LLM_MAX_CONCURRENT", 2)),
+        max_queue_depth=int(os.getenv("LLM_MAX_QUEUE", 32)),
+        max_wait=float(os.getenv("LLM_MAX_WAIT", 120)),
+        retry_after=int(os.getenv("LLM_RETRY_AFTER", 10))
+    )
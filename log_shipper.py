@@ -0,0 +1,184 @@
+# log_shipper.py
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+# Loggers of the HTTP stack the inserts go through. Shipping their records
+# would make every batch produce records for the next one.
+CLIENT_LOGGERS = ("httpx", "httpcore", "hpack", "supabase", "postgrest")
+
+
+class ShipperTrafficFilter(logging.Filter):
+    """Drops records logged by the shipper's own thread or its HTTP client."""
+
+    def __init__(self, thread_name):
+        super().__init__()
+        self.thread_name = thread_name
+
+    def filter(self, record):
+        if record.threadName == self.thread_name:
+            return False
+        return not any(record.name == name or record.name.startswith(name + ".") for name in CLIENT_LOGGERS)
+
+
+class SupabaseLogHandler(logging.Handler):
+    """logging handler that ships records to a Supabase table in the background.
+
+    emit() only puts the record on a bounded queue, so logging never waits
+    on the database. A worker thread inserts queued records in bulk once
+    `batch_size` have collected or `flush_interval` seconds have passed.
+
+    When the queue is full, or an insert fails, records are appended to
+    `spill_path` as JSON lines (or dropped if no path is set). Spilled
+    records are sent again after the next successful insert. Pending
+    records are flushed when the handler is closed, which logging does
+    on interpreter exit.
+
+    The worker thread only runs once start() is called. Records from that
+    thread and from the HTTP client's loggers are never shipped.
+    """
+
+    def __init__(self, supabase, table="logs", level=logging.ERROR, batch_size=50, flush_interval=2.0,
+                 max_queue=10000, spill_path=None):
+        super().__init__(level)
+        self.supabase = supabase
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"shipped": 0, "batches": 0, "failed_batches": 0, "spilled": 0, "dropped": 0}
+        self._flush_requested = threading.Event()
+        self._idle = threading.Event()
+        self._stopping = False
+        self._start_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+        self.addFilter(ShipperTrafficFilter(self._worker.name))
+
+    def start(self):
+        """Start the worker thread, if it isn't running yet."""
+        with self._start_lock:
+            if self._worker.ident is None and not self._stopping:
+                self._worker.start()
+
+    def emit(self, record):
+        try:
+            row = {
+                "message": self.format(record),
+                "user_id": str(uuid.uuid4())
+            }
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self._spill([row])
+
+    def flush(self, timeout=5.0):
+        """Ship everything queued so far, waiting at most `timeout` seconds."""
+        if not self._worker.is_alive():
+            return
+        self._idle.clear()
+        self._flush_requested.set()
+        self._idle.wait(timeout)
+
+    def close(self):
+        with self._start_lock:
+            stopping, self._stopping = self._stopping, True
+        if not stopping and self._worker.ident is not None:
+            self._flush_requested.set()
+            self._worker.join(timeout=10)
+        super().close()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+    def _run(self):
+        while True:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self._flush_requested.is_set() and self._queue.empty():
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=max(min(deadline - time.monotonic(), 0.1), 0)))
+                except queue.Empty:
+                    if time.monotonic() >= deadline:
+                        break
+
+            if batch and self._ship(batch):
+                self._replay_spill()
+            if self._queue.empty() and self._flush_requested.is_set():
+                self._flush_requested.clear()
+                self._idle.set()
+                if self._stopping:
+                    return
+
+    def _ship(self, batch):
+        try:
+            self.supabase.table(self.table).insert(batch).execute()
+        except Exception as e:
+            print(f"Log shipping failed, keeping {len(batch)} record(s) for later: {e}")
+            self._count(failed_batches=1)
+            self._spill(batch)
+            return False
+        self._count(shipped=len(batch), batches=1)
+        return True
+
+    def _spill(self, rows):
+        if not self.spill_path:
+            self._count(dropped=len(rows))
+            return
+        try:
+            with self._spill_lock, open(self.spill_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+            self._count(spilled=len(rows))
+        except OSError as e:
+            print(f"Could not spill log records to {self.spill_path}: {e}")
+            self._count(dropped=len(rows))
+
+    def _replay_spill(self):
+        if not self.spill_path:
+            return
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            # Take the file over so new spills start a fresh one
+            replaying = self.spill_path + ".replay"
+            os.replace(self.spill_path, replaying)
+        with open(replaying, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        os.remove(replaying)
+        for start in range(0, len(rows), self.batch_size):
+            # A failed batch is spilled again by _ship; stop until the next success
+            if not self._ship(rows[start:start + self.batch_size]):
+                self._spill(rows[start + self.batch_size:])
+                return
+
+    def _count(self, **fields):
+        with self._stats_lock:
+            for field, value in fields.items():
+                self._stats[field] += value
+
+
+def create_log_handler(supabase):
+    """SupabaseLogHandler configured from LOG_SHIP_* environment variables."""
+    return SupabaseLogHandler(
+        supabase,
+        level=os.getenv("LOG_SHIP_LEVEL", "ERROR"),
+        batch_size=int(os.getenv("LOG_SHIP_BATCH_SIZE", 50)),
+        flush_interval=float(os.getenv("LOG_SHIP_INTERVAL", 2.0)),
+        max_queue=int(os.getenv("LOG_SHIP_QUEUE_SIZE", 10000)),
+        spill_path=os.getenv("LOG_SPILL_PATH", "nexplan_logs.spill.jsonl") or None
+    )
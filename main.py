@@ -1,10 +1,12 @@
-import ollama
-from supabase import create_client, Client
 import uuid
 import json
 import requests
 from datetime import datetime, timedelta
-from ai_functions import get_location_info, create_structured_itinerary
+from ai_functions import get_location_info, create_structured_itinerary, apply_modification
+from itinerary_edits import EditError, InvalidEditTarget
+from prompt_builder import PromptTooLarge
+from itinerary_store import create_itinerary_store
+from clients import supabase
 import os
 
 # API Keys and URLs
@@ -14,14 +16,7 @@ SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 GEONAMES_USERNAME = os.getenv("GEONAMES_USERNAME")
 OPENROUTE_API_KEY = os.getenv("OPENROUTE_API_KEY")
 
-# Create a Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# Initialize the Ollama client
-client = ollama.Client()
-
-# Define the model 
-model = "AI-Planner"
+# The Supabase client is shared with the server and created on first use
 
 # Hardcoded questions
 # Hardcoded questions
@@ -38,45 +33,41 @@ questions = {
 # Function to get coordinates from GeoNames
 
 
+itinerary_store = create_itinerary_store(supabase)
+
 # Function to save the data to Supabase
-def save_itinerary_to_supabase(user_id, itinerary_data):
-    # Insert the itinerary data into the Supabase 'itineraries' table
-    response = supabase.table('itineraries').insert({
-        "user_id": user_id,
-        "destination": itinerary_data["destination"],
-        "budget": itinerary_data["budget"],
-        "itinerary_data": json.dumps(itinerary_data)
-    }).execute()
+def save_itinerary_to_supabase(user_id, itinerary_data, itinerary_id=None, previous=None, version=None):
+    """Create the itinerary on first save, then upsert it with each edit.
 
-    # Check if there is an error
-    if hasattr(response, 'error') and response.error:
-        print(f"Failed to save itinerary: {response.error}")
-        return False
-    else:
-        print("Itinerary successfully saved!")
-        return True
+    Returns (itinerary_id, version), or (itinerary_id, None) if saving failed.
+    """
+    try:
+        if itinerary_id is None:
+            itinerary_id = itinerary_store.create(itinerary_data, user_id=user_id)
+            version = 1
+        else:
+            version = itinerary_store.save(itinerary_id, itinerary_data, previous=previous, version=version)
+    except Exception as e:
+        print(f"Failed to save itinerary: {e}")
+        return itinerary_id, None
+
+    print("Itinerary successfully saved!")
+    return itinerary_id, version
 
 # Function to update itinerary with user modifications
-def update_itinerary(user_id, user_input, current_itinerary):
-    update_prompt = f"""
-    The user has the following itinerary for {current_itinerary['destination']}:
-    {json.dumps(current_itinerary, indent=2)}
-    
-    The user is requesting the following modification:
-    "{user_input}"
-    
-    Please update the itinerary accordingly while maintaining the structured format.
-    """
-    
-    response = client.generate(model=model, prompt=update_prompt)
-    
+def update_itinerary(user_id, user_input, current_itinerary, itinerary_id=None, version=None):
+    # Only the days and sections the request touches are sent to the model,
+    # continuing the conversation of the previous edit of this version
     try:
-        # Try to parse the response as JSON
-        updated_itinerary = json.loads(response.response)
+        updated_itinerary, patch = apply_modification(current_itinerary, user_input, itinerary_id, version)
         return updated_itinerary
-    except json.JSONDecodeError:
-        # If parsing fails, use the original itinerary as a base and add the AI response as notes
-        current_itinerary["modification_notes"] = response.response
+    except InvalidEditTarget as e:
+        print(e)
+        return current_itinerary
+    except (EditError, PromptTooLarge) as e:
+        # If the edit can't be merged, keep the original itinerary and note the request
+        print(f"Could not apply modification: {e}")
+        current_itinerary = dict(current_itinerary, modification_notes=user_input)
         return current_itinerary
 
 # Function to format the itinerary for display
@@ -156,10 +147,10 @@ def main():
     print("=" * 80 + "\n")
     
     # Save the generated itinerary to Supabase
-    save_result = save_itinerary_to_supabase(user_id, itinerary)
+    itinerary_id, version = save_itinerary_to_supabase(user_id, itinerary)
     
-    if save_result:
-        print(f"Your itinerary has been saved! Your unique ID is: {user_id}")
+    if version:
+        print(f"Your itinerary has been saved! Your unique ID is: {itinerary_id}")
     
     # Loop to continue the conversation and modify the itinerary
     current_itinerary = itinerary
@@ -173,7 +164,8 @@ def main():
         
         # Update the itinerary with user input
         print("Updating your itinerary...")
-        current_itinerary = update_itinerary(user_id, user_input, current_itinerary)
+        previous_itinerary = current_itinerary
+        current_itinerary = update_itinerary(user_id, user_input, current_itinerary, itinerary_id, version)
         
         # Format and display the updated itinerary
         formatted_itinerary = format_itinerary_for_display(current_itinerary)
@@ -181,10 +173,12 @@ def main():
         print(formatted_itinerary)
         print("=" * 80 + "\n")
         
-        # Save the updated itinerary to Supabase
-        save_result = save_itinerary_to_supabase(user_id, current_itinerary)
-        
-        if save_result:
+        # Save the updated itinerary to Supabase as a new version of the same itinerary
+        saved_id, saved_version = save_itinerary_to_supabase(
+            user_id, current_itinerary, itinerary_id, previous_itinerary if version else None, version
+        )
+        if saved_version:
+            itinerary_id, version = saved_id, saved_version
             print("Your updated itinerary has been saved!")
 
 if __name__ == "__main__":
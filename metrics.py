@@ -0,0 +1,214 @@
+# metrics.py
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; wide enough for a 1 ms cache hit and a multi-minute generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+# Spans recorded while handling the current request, for the Server-Timing
+# header. Pipeline stages on other threads share the list through
+# submit_with_context.
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram, optionally split by labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # labels -> [bucket counts..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values[:-1]):
+                cumulative += count
+                yield self.name + "_bucket", dict(labels, le=_format_bound(bound)), cumulative
+            yield self.name + "_sum", labels, values[-1]
+            yield self.name + "_count", labels, cumulative
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Gauge:
+    """Value read from a callback at scrape time.
+
+    The callback returns a number, or a dict mapping label tuples (in
+    `labelnames` order) to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Gauge {self.name} failed: {e}")
+            return
+        if isinstance(value, dict):
+            for key, number in sorted(value.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                yield self.name, dict(zip(self.labelnames, key)), number
+        elif value is not None:
+            yield self.name, {}, value
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS, labelnames=()):
+    return _register(Histogram(name, help_text, buckets, labelnames))
+
+
+def counter(name, help_text, labelnames=()):
+    return _register(Counter(name, help_text, labelnames))
+
+
+def gauge(name, help_text, fn, labelnames=()):
+    return _register(Gauge(name, help_text, fn, labelnames))
+
+
+stage_seconds = histogram(
+    "nexplan_stage_seconds", "Time spent in each pipeline stage", labelnames=("stage",)
+)
+stage_errors = counter(
+    "nexplan_stage_errors_total", "Pipeline stages that raised", labelnames=("stage",)
+)
+
+
+@contextmanager
+def span(stage):
+    """Time a block as `stage`, for /metrics and this request's Server-Timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+def start_request():
+    """Begin collecting spans for the current request; returns a reset token."""
+    return _request_spans.set([])
+
+
+def finish_request(token):
+    """Spans collected since start_request, as (stage, seconds) pairs."""
+    spans = _request_spans.get() or []
+    _request_spans.reset(token)
+    return spans
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """executor.submit that keeps the caller's request spans visible to `fn`."""
+    context = contextvars.copy_context()
+    return executor.submit(context.run, fn, *args, **kwargs)
+
+
+def server_timing(spans, total=None):
+    """Server-Timing header value; repeated stages are added together."""
+    totals = {}
+    for stage, seconds in spans:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == math.inf else repr(float(bound))
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
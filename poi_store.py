@@ -0,0 +1,392 @@
+# poi_store.py
+import argparse
+import json
+import math
+import os
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# Overpass tag each supported place type lives under
+PLACE_TYPE_TAGS = {
+    "hotel": "tourism",
+    "guesthouse": "tourism",
+    "attraction": "tourism",
+    "restaurant": "amenity",
+    "cafe": "amenity",
+    "bar": "amenity",
+}
+PLACE_TYPES = list(PLACE_TYPE_TAGS)
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEGREE = 111320.0
+STRING_FIELDS = ("name", "address", "website", "phone")
+# Kinds of extract area: a bounding box (OSM <bounds>) or a circle (an
+# Overpass around: query)
+BBOX = "bbox"
+AROUND = "around"
+
+
+class POIStore:
+    """Array-backed points-of-interest store with a uniform grid index.
+
+    Points are sorted by grid cell, so the cells of one grid row covering a
+    query circle form a single contiguous slice of the arrays. A radius query
+    is a handful of binary searches followed by a vectorized distance check.
+
+    `area` is the region the places were extracted from, as
+    (BBOX, min_lat, min_lon, max_lat, max_lon) or (AROUND, lat, lng, radius).
+    Only queries inside it are answered from the store.
+    """
+
+    def __init__(self, ids, lats, lons, type_codes, strings, cell_size=0.01, area=None):
+        self.cell_size = float(cell_size)
+        self._cols = int(math.ceil(360.0 / self.cell_size))
+
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        keys = self._cell_keys(lats, lons)
+        order = np.argsort(keys, kind="stable")
+
+        self.keys = keys[order]
+        self.ids = np.asarray(ids, dtype=np.int64)[order]
+        self.lats = lats[order]
+        self.lons = lons[order]
+        self.type_codes = np.asarray(type_codes, dtype=np.int8)[order]
+        self.strings = {
+            field: np.asarray(strings[field], dtype=str)[order] for field in STRING_FIELDS
+        }
+        self.area = _area(area)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell_keys(self, lats, lons):
+        rows = np.floor((lats + 90.0) / self.cell_size).astype(np.int64)
+        cols = np.floor((lons + 180.0) / self.cell_size).astype(np.int64)
+        return rows * self._cols + np.clip(cols, 0, self._cols - 1)
+
+    def covers(self, lat, lng, radius):
+        """True if the query circle lies inside the area this store was extracted from.
+
+        A store without a recorded area covers nothing: the bounding box of
+        its points says nothing about where places are missing.
+        """
+        if self.area is None:
+            return False
+        kind, *values = self.area
+        if kind == AROUND:
+            centre_lat, centre_lng, area_radius = values
+            return float(haversine_m(centre_lat, centre_lng, lat, lng)) + radius <= area_radius
+        dlat, dlon = _degree_offsets(lat, radius)
+        min_lat, min_lon, max_lat, max_lon = values
+        return (min_lat <= lat - dlat and lat + dlat <= max_lat
+                and min_lon <= lng - dlon and lng + dlon <= max_lon)
+
+    def query(self, lat, lng, radius=5000, place_types=None, limit=None):
+        """Places within `radius` metres, nearest first, shaped like Overpass results.
+
+        `limit` caps the number of results per type, which is all callers
+        like create_structured_itinerary need and saves building the rest.
+        """
+        lat, lng = float(lat), float(lng)
+        dlat, dlon = _degree_offsets(lat, radius)
+
+        row_lo = int(math.floor((lat - dlat + 90.0) / self.cell_size))
+        row_hi = int(math.floor((lat + dlat + 90.0) / self.cell_size))
+        col_lo = max(int(math.floor((lng - dlon + 180.0) / self.cell_size)), 0)
+        col_hi = min(int(math.floor((lng + dlon + 180.0) / self.cell_size)), self._cols - 1)
+
+        row_keys = np.arange(row_lo, row_hi + 1, dtype=np.int64) * self._cols
+        starts = np.searchsorted(self.keys, row_keys + col_lo, side="left")
+        ends = np.searchsorted(self.keys, row_keys + col_hi, side="right")
+        slices = [np.arange(start, end) for start, end in zip(starts, ends) if end > start]
+        if not slices:
+            return []
+        candidates = np.concatenate(slices)
+
+        if place_types:
+            codes = [PLACE_TYPES.index(t) for t in place_types if t in PLACE_TYPE_TAGS]
+            candidates = candidates[np.isin(self.type_codes[candidates], codes)]
+
+        distances = haversine_m(lat, lng, self.lats[candidates], self.lons[candidates])
+        inside = distances <= radius
+        candidates = candidates[inside]
+        candidates = candidates[np.argsort(distances[inside], kind="stable")]
+
+        if limit is not None:
+            codes = self.type_codes[candidates]
+            keep = np.zeros(len(candidates), dtype=bool)
+            for code in np.unique(codes):
+                keep[np.flatnonzero(codes == code)[:limit]] = True
+            candidates = candidates[keep]
+
+        return self._results(candidates)
+
+    def _results(self, indices):
+        # Pull whole columns out with tolist(): indexing numpy scalars one by
+        # one is far slower than the query itself
+        names = self.strings['name'][indices].tolist()
+        addresses = self.strings['address'][indices].tolist()
+        websites = self.strings['website'][indices].tolist()
+        phones = self.strings['phone'][indices].tolist()
+        return [{
+            'id': element_id,
+            'name': name or 'Unnamed Location',
+            'type': PLACE_TYPES[code],
+            'lat': lat,
+            'lon': lon,
+            'address': address or None,
+            'website': website or None,
+            'phone': phone or None
+        } for element_id, name, code, lat, lon, address, website, phone in zip(
+            self.ids[indices].tolist(), names, self.type_codes[indices].tolist(),
+            self.lats[indices].tolist(), self.lons[indices].tolist(),
+            addresses, websites, phones
+        )]
+
+    def save(self, path):
+        area = {}
+        if self.area is not None:
+            area = {"area_kind": np.str_(self.area[0]), "area": np.asarray(self.area[1:], dtype=np.float64)}
+        np.savez_compressed(
+            path,
+            cell_size=np.float64(self.cell_size),
+            **area,
+            ids=self.ids,
+            lats=self.lats,
+            lons=self.lons,
+            type_codes=self.type_codes,
+            **self.strings
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            area = None
+            if "area_kind" in data:
+                area = (str(data["area_kind"]), *data["area"].tolist())
+            return cls(
+                data["ids"], data["lats"], data["lons"], data["type_codes"],
+                {field: data[field] for field in STRING_FIELDS},
+                cell_size=float(data["cell_size"]), area=area
+            )
+
+    @classmethod
+    def from_places(cls, places, cell_size=0.01, area=None):
+        """Build a store from Overpass-shaped place dicts, skipping unusable ones."""
+        columns = {"ids": [], "lats": [], "lons": [], "type_codes": []}
+        strings = {field: [] for field in STRING_FIELDS}
+        for place in places:
+            if place.get("type") not in PLACE_TYPE_TAGS or place.get("lat") is None or place.get("lon") is None:
+                continue
+            columns["ids"].append(place["id"])
+            columns["lats"].append(float(place["lat"]))
+            columns["lons"].append(float(place["lon"]))
+            columns["type_codes"].append(PLACE_TYPES.index(place["type"]))
+            for field in STRING_FIELDS:
+                strings[field].append(place.get(field) or "")
+        return cls(columns["ids"], columns["lats"], columns["lons"], columns["type_codes"],
+                   strings, cell_size=cell_size, area=area)
+
+
+def haversine_m(lat, lng, lats, lons):
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lons)
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def _area(area):
+    if area is None:
+        return None
+    kind, *values = area
+    if kind not in (BBOX, AROUND) or len(values) != (4 if kind == BBOX else 3):
+        raise ValueError(f"Unknown extract area: {area}")
+    return (kind, *(float(value) for value in values))
+
+
+def _degree_offsets(lat, radius):
+    dlat = radius / METERS_PER_DEGREE
+    dlon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+    return dlat, dlon
+
+
+def _place_from_tags(element_id, lat, lon, tags):
+    return {
+        'id': element_id,
+        'name': tags.get('name', 'Unnamed Location'),
+        'type': tags.get('tourism') or tags.get('amenity'),
+        'lat': lat,
+        'lon': lon,
+        'address': tags.get('addr:street'),
+        'website': tags.get('website'),
+        'phone': tags.get('phone')
+    }
+
+
+def places_from_overpass(data):
+    """Parse an Overpass JSON response (queried with "out center")."""
+    places = []
+    for element in data.get('elements', []):
+        if 'tags' not in element:
+            continue
+        center = element.get('center', {})
+        places.append(_place_from_tags(
+            element['id'],
+            element.get('lat', center.get('lat')),
+            element.get('lon', center.get('lon')),
+            element['tags']
+        ))
+    return places
+
+
+def places_from_osm_xml(path):
+    """Parse an OSM XML extract into its places and its <bounds> area, if any.
+
+    Ways are placed at the mean of their nodes. Relations are skipped: the
+    few hotels or attractions mapped only as relations are not worth
+    resolving their member geometry for.
+    """
+    node_coords = {}
+    places = []
+    way_refs = []
+    area = None
+    for _, elem in ET.iterparse(path, events=("end",)):
+        if elem.tag == "bounds":
+            area = (BBOX, *(float(elem.get(k)) for k in ("minlat", "minlon", "maxlat", "maxlon")))
+        elif elem.tag == "node":
+            lat, lon = float(elem.get("lat")), float(elem.get("lon"))
+            node_coords[int(elem.get("id"))] = (lat, lon)
+            tags = {t.get("k"): t.get("v") for t in elem.findall("tag")}
+            if tags:
+                places.append(_place_from_tags(int(elem.get("id")), lat, lon, tags))
+            elem.clear()
+        elif elem.tag == "way":
+            tags = {t.get("k"): t.get("v") for t in elem.findall("tag")}
+            if (tags.get("tourism") or tags.get("amenity")) in PLACE_TYPE_TAGS:
+                refs = [int(nd.get("ref")) for nd in elem.findall("nd")]
+                way_refs.append((int(elem.get("id")), refs, tags))
+            elem.clear()
+        elif elem.tag == "relation":
+            elem.clear()
+
+    for way_id, refs, tags in way_refs:
+        coords = [node_coords[ref] for ref in refs if ref in node_coords]
+        if coords:
+            lat = sum(c[0] for c in coords) / len(coords)
+            lon = sum(c[1] for c in coords) / len(coords)
+            places.append(_place_from_tags(way_id, lat, lon, tags))
+    return places, area
+
+
+def load_places(path):
+    """Places and extract area from an Overpass JSON dump or an OSM XML extract.
+
+    Dumps written by `poi_store.py dump` record the circle they were
+    queried for; the area is None if the source doesn't say.
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            data = json.load(f)
+        around = data.get("around")
+        area = (AROUND, around["lat"], around["lng"], around["radius"]) if around else None
+        return places_from_overpass(data), area
+    return places_from_osm_xml(path)
+
+
+_store = None
+_store_failed = None
+_store_lock = threading.Lock()
+
+
+def get_poi_store():
+    """The store configured by POI_STORE_PATH, loaded once; None if not configured.
+
+    A store that fails to load is not tried again.
+    """
+    global _store, _store_failed
+    path = os.getenv("POI_STORE_PATH")
+    if not path:
+        return None
+    if _store is None and _store_failed != path:
+        with _store_lock:
+            if _store is None and _store_failed != path:
+                try:
+                    _store = POIStore.load(path)
+                except Exception as e:
+                    _store_failed = path
+                    print(f"Could not load POI store from {path}: {e}")
+                    return None
+                print(f"Loaded {len(_store)} places from {path}")
+                if _store.area is None:
+                    print(f"{path} has no recorded extract area; rebuild it with `poi_store.py load` to use it")
+    return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the offline POI store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load = commands.add_parser("load", help="Build a store from an OSM extract or Overpass dump")
+    load.add_argument("source", help="OSM XML extract (.osm) or Overpass JSON dump (.json)")
+    load.add_argument("output", help="Store file to write (.npz)")
+    load.add_argument("--cell-size", type=float, default=0.01, help="Grid cell size in degrees")
+    load.add_argument("--around", type=float, nargs=3, metavar=("LAT", "LNG", "RADIUS"),
+                      help="Circle the source was extracted for, if it doesn't record one")
+
+    dump = commands.add_parser("dump", help="Save an Overpass response around a point as JSON")
+    dump.add_argument("lat", type=float)
+    dump.add_argument("lng", type=float)
+    dump.add_argument("output")
+    dump.add_argument("--radius", type=int, default=20000)
+
+    query = commands.add_parser("query", help="Run a radius query against a store")
+    query.add_argument("store")
+    query.add_argument("lat", type=float)
+    query.add_argument("lng", type=float)
+    query.add_argument("--radius", type=int, default=5000)
+    query.add_argument("--type", dest="place_type", choices=PLACE_TYPES)
+
+    args = parser.parse_args()
+
+    if args.command == "load":
+        started = time.perf_counter()
+        places, area = load_places(args.source)
+        if args.around:
+            area = (AROUND, *args.around)
+        if area is None:
+            parser.error(f"{args.source} doesn't record the area it covers; pass --around LAT LNG RADIUS")
+        store = POIStore.from_places(places, cell_size=args.cell_size, area=area)
+        store.save(args.output)
+        print(f"Stored {len(store)} places in {args.output} ({time.perf_counter() - started:.1f}s)")
+
+    elif args.command == "dump":
+        import requests
+        from ai_functions import build_overpass_query
+        response = requests.post("https://overpass-api.de/api/interpreter",
+                                 data=build_overpass_query(args.lat, args.lng, args.radius))
+        response.raise_for_status()
+        data = response.json()
+        # Overpass doesn't echo the query area back; `load` needs it
+        data["around"] = {"lat": args.lat, "lng": args.lng, "radius": args.radius}
+        with open(args.output, "w") as f:
+            json.dump(data, f)
+        print(f"Saved {len(data['elements'])} elements to {args.output}")
+
+    elif args.command == "query":
+        store = POIStore.load(args.store)
+        started = time.perf_counter()
+        places = store.query(args.lat, args.lng, args.radius,
+                             [args.place_type] if args.place_type else None)
+        elapsed_us = (time.perf_counter() - started) * 1e6
+        for place in places[:20]:
+            print(f"{place['type']:<12} {place['name']}")
+        print(f"{len(places)} places in {elapsed_us:.0f} µs")
+
+
+if __name__ == "__main__":
+    main()
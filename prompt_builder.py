@@ -0,0 +1,326 @@
+# prompt_builder.py
+"""Itinerary edit prompts: compact, within a token budget, and continued across edits.
+
+A prompt carries the trip in two short lines, the request, and the
+targeted sections as minified JSON, with no indentation anywhere.
+
+Prompt tokens are estimated from characters, with the ratio calibrated
+on the prompt_eval_count Ollama reports. A prompt over the per-call
+budget is cut down according to the policy:
+
+    drop_sections  split a whole day's activities into morning, afternoon
+                   and evening, then keep as many of the targeted
+                   sections, in order, as fit; the rest are deferred to
+                   further rounds of the same edit (default). An edit
+                   gets `max_rounds`, or one round per section it
+                   targets if that is more, so a wide edit of a long
+                   trip always finishes
+    reject         raise PromptTooLarge
+
+Consecutive edits of the same itinerary continue one Ollama conversation.
+The context returned by the last edit is sent with the next one, so the
+rules and every section the model has already seen or written are not
+sent or prefilled again: the next prompt is just the request, the
+pointers to edit and any section that changed since. A session is only
+continued from the version its last edit produced, and starts over when
+the conversation would no longer fit in `num_ctx` tokens, which should
+match the model's num_ctx.
+
+Every call reports the tokens Ollama prefilled and the tokens and time
+saved compared with sending the same edit as a fresh prompt.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from collections import deque
+
+import json_patch
+import metrics
+from cache import MISSING, LRUCache
+
+DROP_SECTIONS = "drop_sections"
+REJECT = "reject"
+POLICIES = (DROP_SECTIONS, REJECT)
+
+prefilled_tokens = metrics.histogram(
+    "nexplan_edit_prompt_tokens", "Prompt tokens Ollama prefilled per itinerary edit",
+    buckets=(32, 64, 128, 256, 512, 1024, 2048, 4096, 8192), labelnames=("session",)
+)
+tokens_saved = metrics.counter(
+    "nexplan_edit_prefill_tokens_saved_total", "Prompt tokens not prefilled thanks to a continued edit session"
+)
+seconds_saved = metrics.counter(
+    "nexplan_edit_prefill_seconds_saved_total", "Estimated prefill time saved by continued edit sessions"
+)
+
+
+class PromptTooLarge(ValueError):
+    """The edit prompt can't be made to fit the token budget."""
+
+
+class TokenCounter:
+    """Prompt token estimates from character counts.
+
+    Starts at `chars_per_token` and moves towards the ratio seen in
+    Ollama's prompt_eval_count for prompts sent without a context. The
+    count includes the model's template, so short prompts read a little
+    high, which errs on the side of the budget.
+    """
+
+    def __init__(self, chars_per_token=4.0, weight=0.2):
+        self.chars_per_token = chars_per_token
+        self.weight = weight
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def observe(self, text, tokens):
+        if not text or not tokens:
+            return
+        with self._lock:
+            self.chars_per_token += self.weight * (len(text) / tokens - self.chars_per_token)
+
+
+class EditPrompt:
+    """A built prompt and what went into it."""
+
+    def __init__(self, text, pointers, dropped, tokens, standalone_tokens, session):
+        self.text = text
+        self.pointers = pointers
+        self.dropped = dropped
+        self.tokens = tokens
+        # Estimate for the same edit sent as a fresh prompt
+        self.standalone_tokens = standalone_tokens
+        # The session this prompt continues, or None for a fresh one
+        self.session = session
+
+    @property
+    def context(self):
+        return self.session["context"] if self.session else None
+
+
+class PromptBuilder:
+    def __init__(self, budget=1024, num_ctx=2048, policy=DROP_SECTIONS, reuse_context=True,
+                 counter=None, max_sessions=1000, session_ttl=1800, max_rounds=3):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown prompt policy: {policy}")
+        self.budget = budget
+        self.num_ctx = num_ctx
+        self.policy = policy
+        self.reuse_context = reuse_context
+        self.max_rounds = max_rounds
+        self.counter = counter or TokenCounter()
+        self.session_ttl = session_ttl
+        self.sessions = LRUCache(max_entries=max_sessions)
+        self._lock = threading.Lock()
+        self._seconds_per_token = None
+        self._recent = deque(maxlen=100)
+        self._totals = {"calls": 0, "continued": 0, "prefilled_tokens": 0, "tokens_saved": 0,
+                        "seconds_saved": 0.0, "deferred_sections": 0}
+
+    def build(self, itinerary, modification, pointers, session_key=None, version=None):
+        """The prompt for an edit of `pointers`, continuing the itinerary's session if it can.
+
+        Raises PromptTooLarge if it can't be brought within the budget.
+        """
+        session = self._session(session_key, version)
+        kept = list(pointers)
+        dropped = []
+        while True:
+            fragments = {pointer: json_patch.resolve(itinerary, pointer) for pointer in kept}
+            standalone = render_fresh(itinerary, modification, fragments)
+            standalone_tokens = self.counter.count(standalone)
+            text, tokens = standalone, standalone_tokens
+            if session is not None:
+                text = render_continued(modification, fragments, session["known"])
+                tokens = self.counter.count(text)
+                # The conversation so far, this prompt and an answer about
+                # the size of the sections all have to fit
+                answer_tokens = self.counter.count(_compact(fragments))
+                if session["tokens"] + tokens + answer_tokens > self.num_ctx:
+                    session = None
+                    text, tokens = standalone, standalone_tokens
+            if tokens <= self.budget:
+                return EditPrompt(text, kept, dropped, tokens, standalone_tokens, session)
+            if self.policy == REJECT:
+                raise PromptTooLarge(
+                    f"Edit prompt needs about {tokens} tokens, over the budget of {self.budget}"
+                )
+            split = _split(kept, fragments)
+            if split is not None:
+                kept = split
+            elif len(kept) > 1:
+                dropped.insert(0, kept.pop())
+            else:
+                raise PromptTooLarge(
+                    f"Edit prompt needs about {tokens} tokens even for one section, over the budget of {self.budget}"
+                )
+
+    def rounds_for(self, itinerary, pointers):
+        """How many prompts an edit of `pointers` may take.
+
+        Every round edits at least one section, counting each part of a
+        split day, so one round per section is always enough.
+        """
+        sections = sum(_section_count(json_patch.resolve(itinerary, pointer)) for pointer in pointers)
+        return max(self.max_rounds, sections)
+
+    def record(self, prompt, response, itinerary, session_key=None, version=None, produces=None):
+        """Account for a finished edit and keep its conversation for the next one.
+
+        `itinerary` is the result of the edit and `version` the one it was
+        made from; the conversation is kept for `produces`, by default the
+        version after it. Returns this call's report.
+        """
+        evaluated = getattr(response, "prompt_eval_count", None) or 0
+        duration = getattr(response, "prompt_eval_duration", None) or 0
+        if prompt.session is None:
+            self.counter.observe(prompt.text, evaluated)
+        with self._lock:
+            if evaluated and duration:
+                rate = duration / 1e9 / evaluated
+                self._seconds_per_token = rate if self._seconds_per_token is None else (
+                    self._seconds_per_token + 0.2 * (rate - self._seconds_per_token)
+                )
+            seconds_per_token = self._seconds_per_token or 0.0
+
+        prefilled = evaluated or prompt.tokens
+        # If Ollama no longer had the conversation cached it prefilled all
+        # of it again, and the saving comes out negative
+        saved = prompt.standalone_tokens - prefilled if prompt.session is not None else 0
+        report = {
+            "session": "continued" if prompt.session is not None else "new",
+            "prefilled_tokens": prefilled,
+            "estimated_tokens": prompt.tokens,
+            "standalone_tokens": prompt.standalone_tokens,
+            "context_tokens": prompt.session["tokens"] if prompt.session else 0,
+            "tokens_saved": saved,
+            "seconds_saved": round(saved * seconds_per_token, 4),
+            "deferred_sections": prompt.dropped,
+        }
+        self._count(report)
+
+        context = getattr(response, "context", None)
+        if self.reuse_context and session_key is not None and version is not None and context:
+            known = dict(prompt.session["known"]) if prompt.session else {}
+            for pointer in prompt.pointers:
+                try:
+                    known[pointer] = _digest(json_patch.resolve(itinerary, pointer))
+                except (KeyError, IndexError, TypeError):
+                    known.pop(pointer, None)
+            self._store(session_key, version, {
+                "version": produces if produces is not None else version + 1,
+                "context": context, "tokens": len(context), "known": known
+            })
+        return report
+
+    def _session(self, session_key, version):
+        if not self.reuse_context or session_key is None or version is None:
+            return None
+        session = self.sessions.get(session_key)
+        if session is MISSING or session["version"] != version:
+            return None
+        return session
+
+    def _store(self, session_key, version, session):
+        with self._lock:
+            # An edit made concurrently from the same version may already
+            # have moved the session on; its conversation wins
+            current = self.sessions.get(session_key)
+            if current is MISSING or current["version"] <= version:
+                self.sessions.set(session_key, session, self.session_ttl)
+
+    def _count(self, report):
+        prefilled_tokens.observe(report["prefilled_tokens"], session=report["session"])
+        if report["tokens_saved"]:
+            tokens_saved.inc(report["tokens_saved"])
+            seconds_saved.inc(report["seconds_saved"])
+        with self._lock:
+            totals = self._totals
+            totals["calls"] += 1
+            totals["continued"] += report["session"] == "continued"
+            totals["prefilled_tokens"] += report["prefilled_tokens"]
+            totals["tokens_saved"] += report["tokens_saved"]
+            totals["seconds_saved"] += report["seconds_saved"]
+            totals["deferred_sections"] += len(report["deferred_sections"])
+            self._recent.append(report)
+        logging.info(f"Edit prompt: {report}")
+
+    def stats(self):
+        """Totals since startup, the calibration in use and the latest reports."""
+        with self._lock:
+            stats = dict(self._totals)
+            stats["recent"] = list(self._recent)[-10:]
+            stats["seconds_per_token"] = self._seconds_per_token
+        stats["seconds_saved"] = round(stats["seconds_saved"], 3)
+        stats["chars_per_token"] = round(self.counter.chars_per_token, 3)
+        stats["sessions"] = len(self.sessions)
+        stats["budget"] = self.budget
+        stats["policy"] = self.policy
+        return stats
+
+
+def render_fresh(itinerary, modification, fragments):
+    """A standalone edit prompt: trip, request, sections and rules."""
+    return (
+        f"You are editing part of a {itinerary.get('duration', '')}-day trip to {itinerary.get('destination', '')}, "
+        f"{itinerary.get('country', '')} starting {itinerary.get('arrival_date', '')}.\n"
+        f"Travelers: {itinerary.get('people', '')}. Budget: {itinerary.get('budget', '')}. "
+        f"Accommodation: {itinerary.get('accommodation', '')}.\n\n"
+        f"USER MODIFICATION REQUEST:\n{modification}\n\n"
+        f"ITINERARY SECTIONS TO EDIT (JSON object keyed by location in the itinerary):\n{_compact(fragments)}\n\n"
+        "RULES:\n"
+        "1. Reply with a JSON object with exactly the same keys\n"
+        "2. Each value must keep its original shape (a list of strings stays a list of strings)\n"
+        "3. Only change what the request asks for; keep everything else as it is\n"
+        "4. Only use real locations\n"
+    )
+
+
+def render_continued(modification, fragments, known):
+    """The next edit in a conversation: sections the model already has are only named."""
+    changed = {pointer: value for pointer, value in fragments.items() if known.get(pointer) != _digest(value)}
+    text = f"USER MODIFICATION REQUEST:\n{modification}\n\nSECTIONS TO EDIT: {_compact(list(fragments))}\n"
+    if changed:
+        text += f"Their current values, where they differ from earlier in this conversation:\n{_compact(changed)}\n"
+    return text + "Reply with a JSON object with exactly these keys, following the same rules as before.\n"
+
+
+def _split(pointers, fragments):
+    """`pointers` with the first object-valued section replaced by its parts, or None."""
+    for index, pointer in enumerate(pointers):
+        value = fragments[pointer]
+        if isinstance(value, dict) and value:
+            parts = [f"{pointer}/{json_patch.escape(key)}" for key in value]
+            return pointers[:index] + parts + pointers[index + 1:]
+    return None
+
+
+def _section_count(value):
+    # Sections a value can be split into, as _split does
+    if isinstance(value, dict) and value:
+        return sum(_section_count(part) for part in value.values())
+    return 1
+
+
+def _compact(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def create_prompt_builder():
+    return PromptBuilder(
+        budget=int(os.getenv("EDIT_PROMPT_BUDGET", 1024)),
+        num_ctx=int(os.getenv("EDIT_NUM_CTX", 2048)),
+        policy=os.getenv("EDIT_PROMPT_POLICY", DROP_SECTIONS),
+        reuse_context=os.getenv("EDIT_CONTEXT_REUSE", "1").lower() not in ("0", "false", "no"),
+        session_ttl=int(os.getenv("EDIT_SESSION_TTL", 1800)),
+        max_rounds=int(os.getenv("EDIT_MAX_ROUNDS", 3))
+    )
@@ -0,0 +1,319 @@
+# route_planner.py
+import os
+import re
+
+import numpy as np
+
+from cache import TieredCache, open_store
+from http_client import get_async_http_client, get_http_client
+from poi_store import haversine_m
+
+OPENROUTE_API_KEY = os.getenv("OPENROUTE_API_KEY")
+ROUTE_PROFILE = os.getenv("ROUTE_PROFILE", "foot-walking")
+
+# Used when OpenRouteService is unavailable: straight-line distance times a
+# detour factor, at a typical urban speed for the profile
+DETOUR_FACTOR = 1.3
+SPEEDS_KMH = {"foot-walking": 4.5, "cycling-regular": 14.0, "driving-car": 25.0}
+
+# Parts of the day, in the order they happen. Stops are reordered within a
+# part, never moved between parts.
+DAY_PARTS = ("morning", "afternoon", "evening")
+
+# Travel time and distance between two coordinates hardly ever change, so a
+# pair fetched for one itinerary is reused by every later one
+pair_cache = TieredCache(
+    "route_pairs",
+    ttl=int(os.getenv("ROUTE_PAIR_CACHE_TTL", 30 * 24 * 3600)),
+    max_entries=int(os.getenv("ROUTE_PAIR_CACHE_SIZE", 50000)),
+    store=open_store("route_pairs")
+)
+
+_MIN_NAME_LENGTH = 4
+
+
+class PlaceMatcher:
+    """Finds known places mentioned in free-text itinerary activities.
+
+    The longest place name contained in an activity wins, so "Cafe de Flore"
+    is preferred over a nearby place that is just called "Flore".
+    """
+
+    def __init__(self, places):
+        by_name = {}
+        for place in places:
+            name = _normalize(place.get("name", ""))
+            if len(name) >= _MIN_NAME_LENGTH and name != "unnamed location" and name not in by_name:
+                by_name[name] = place
+        # Longest first, so the first hit is the most specific one
+        self._names = sorted(by_name, key=len, reverse=True)
+        self._places = by_name
+
+    def match(self, text):
+        text = _normalize(text)
+        for name in self._names:
+            if name in text:
+                return self._places[name]
+        return None
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def pair_key(profile, a, b):
+    return f"{profile}|{a[0]:.5f},{a[1]:.5f}|{b[0]:.5f},{b[1]:.5f}"
+
+
+def travel_matrix(coords, profile=ROUTE_PROFILE):
+    """Duration (seconds) and distance (metres) matrices between (lat, lng) points.
+
+    Pairs already in the cache are not fetched again. Everything missing is
+    fetched with a single OpenRouteService matrix request; if that isn't
+    possible the remaining pairs are estimated from straight-line distance.
+    Returns (durations, distances, source).
+    """
+    keys = _pair_keys(coords, profile)
+    cached = pair_cache.get_many(list(keys.values()))
+    durations, distances, missing = _cached_matrix(coords, keys, cached)
+    if not missing:
+        return durations, distances, "cache"
+
+    try:
+        if not OPENROUTE_API_KEY:
+            raise RuntimeError("OPENROUTE_API_KEY is not set")
+        response = get_http_client("openrouteservice").post(
+            f"/v2/matrix/{profile}", headers=_matrix_headers(), json=_matrix_body(coords)
+        )
+        response.raise_for_status()
+        fetched_durations, fetched_distances = _parse_matrix(response.json(), coords, profile)
+    except Exception as e:
+        print(f"OpenRouteService matrix error: {e}")
+        return _fill_estimates(coords, profile, durations, distances, missing)
+
+    pair_cache.set_many(_matrix_entries(keys, fetched_durations, fetched_distances))
+    return fetched_durations, fetched_distances, "openrouteservice"
+
+
+async def travel_matrix_async(coords, profile=ROUTE_PROFILE):
+    """travel_matrix for coroutines, using the async OpenRouteService client.
+
+    The cache's disk tier is read and written on a worker thread.
+    """
+    keys = _pair_keys(coords, profile)
+    cached = await pair_cache.get_many_async(list(keys.values()))
+    durations, distances, missing = _cached_matrix(coords, keys, cached)
+    if not missing:
+        return durations, distances, "cache"
+
+    try:
+        if not OPENROUTE_API_KEY:
+            raise RuntimeError("OPENROUTE_API_KEY is not set")
+        response = await get_async_http_client("openrouteservice").post(
+            f"/v2/matrix/{profile}", headers=_matrix_headers(), json=_matrix_body(coords)
+        )
+        response.raise_for_status()
+        fetched_durations, fetched_distances = _parse_matrix(response.json(), coords, profile)
+    except Exception as e:
+        print(f"OpenRouteService matrix error: {e}")
+        return _fill_estimates(coords, profile, durations, distances, missing)
+
+    await pair_cache.set_many_async(_matrix_entries(keys, fetched_durations, fetched_distances))
+    return fetched_durations, fetched_distances, "openrouteservice"
+
+
+def _pair_keys(coords, profile):
+    return {
+        (i, j): pair_key(profile, a, b)
+        for i, a in enumerate(coords)
+        for j, b in enumerate(coords)
+        if i != j
+    }
+
+
+def _cached_matrix(coords, keys, cached):
+    """Matrices filled from `cached` (pair_cache values by key), and the pairs it didn't have."""
+    n = len(coords)
+    durations = np.zeros((n, n))
+    distances = np.zeros((n, n))
+    missing = []
+    for (i, j), key in keys.items():
+        if key in cached:
+            durations[i, j], distances[i, j] = cached[key]
+        else:
+            missing.append((i, j))
+    return durations, distances, missing
+
+
+def _fill_estimates(coords, profile, durations, distances, missing):
+    estimated_durations, estimated_distances = estimate_matrix(coords, profile)
+    for i, j in missing:
+        durations[i, j] = estimated_durations[i, j]
+        distances[i, j] = estimated_distances[i, j]
+    return durations, distances, "estimate"
+
+
+def _matrix_entries(keys, durations, distances):
+    return {key: [float(durations[i, j]), float(distances[i, j])] for (i, j), key in keys.items()}
+
+
+def _matrix_headers():
+    return {"Authorization": OPENROUTE_API_KEY, "Accept": "application/json"}
+
+
+def _matrix_body(coords):
+    return {
+        "locations": [[lng, lat] for lat, lng in coords],
+        "metrics": ["duration", "distance"]
+    }
+
+
+def _parse_matrix(data, coords, profile):
+    # Unroutable pairs come back as null
+    durations = np.array(data["durations"], dtype=np.float64)
+    distances = np.array(data["distances"], dtype=np.float64)
+    if np.isnan(durations).any() or np.isnan(distances).any():
+        estimated_durations, estimated_distances = estimate_matrix(coords, profile)
+        durations = np.where(np.isnan(durations), estimated_durations, durations)
+        distances = np.where(np.isnan(distances), estimated_distances, distances)
+    return durations, distances
+
+
+def estimate_matrix(coords, profile=ROUTE_PROFILE):
+    """Straight-line estimate of the duration and distance matrices."""
+    points = np.asarray(coords, dtype=np.float64)
+    distances = haversine_m(
+        points[:, None, 0], points[:, None, 1], points[None, :, 0], points[None, :, 1]
+    ) * DETOUR_FACTOR
+    speed = SPEEDS_KMH.get(profile, SPEEDS_KMH["driving-car"]) * 1000 / 3600
+    return distances / speed, distances
+
+
+def solve_path(cost):
+    """Visiting order for an open path that starts at node 0.
+
+    Nearest-neighbour construction followed by 2-opt, both vectorized. The
+    cost matrix is symmetrized first, since 2-opt reverses segments.
+    """
+    n = len(cost)
+    if n <= 2:
+        return list(range(n))
+    cost = (cost + cost.T) / 2
+
+    # Nearest neighbour from node 0
+    order = [0]
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, cost[order[-1]])
+        nxt = int(np.argmin(row))
+        order.append(nxt)
+        visited[nxt] = True
+
+    # A zero-cost dummy node after the last stop lets the same 2-opt move
+    # (reverse tour[i+1..j]) change which stop comes last. Every move is
+    # scored at once and the best one applied, until none helps.
+    padded = np.zeros((n + 1, n + 1))
+    padded[:n, :n] = cost
+    tour = np.array(order + [n])
+    i, j = np.triu_indices(n, k=2)
+    while True:
+        a, b = tour[i], tour[i + 1]
+        c, d = tour[j], tour[j + 1]
+        delta = padded[a, c] + padded[b, d] - padded[a, b] - padded[c, d]
+        best = int(np.argmin(delta))
+        if delta[best] >= -1e-9:
+            break
+        tour[i[best] + 1:j[best] + 1] = tour[i[best] + 1:j[best] + 1][::-1].copy()
+
+    # Position 0 and the dummy at position n are never part of a reversal
+    return tour[:n].tolist()
+
+
+def plan_day(day, matcher, profile=ROUTE_PROFILE):
+    """A copy of `day` with its stops reordered to cut travel time.
+
+    Activities that mention a known place become stops. Within each part of
+    the day, stops are reordered with solve_path, starting from the last
+    stop of the previous part. Activities that don't name a known place
+    keep their position. The copy gets a "route" entry with every leg's
+    travel time; a day with fewer than two stops is returned as is.
+    """
+    stops = find_stops(day, matcher)
+    if len(stops) < 2:
+        return day
+    return route_day(day, stops, *travel_matrix(_stop_coords(stops), profile), profile)
+
+
+async def plan_day_async(day, matcher, profile=ROUTE_PROFILE):
+    """plan_day for coroutines; only the matrix request is awaited."""
+    stops = find_stops(day, matcher)
+    if len(stops) < 2:
+        return day
+    return route_day(day, stops, *(await travel_matrix_async(_stop_coords(stops), profile)), profile)
+
+
+def find_stops(day, matcher):
+    """Activities of `day` that name a known place, in the order they happen."""
+    activities = day.get("activities", {})
+    stops = []
+    for part in DAY_PARTS:
+        for index, text in enumerate(activities.get(part, [])):
+            place = matcher.match(text)
+            if place is not None:
+                stops.append({"part": part, "index": index, "text": text, "place": place})
+    return stops
+
+
+def _stop_coords(stops):
+    return [(float(s["place"]["lat"]), float(s["place"]["lon"])) for s in stops]
+
+
+def route_day(day, stops, durations, distances, source, profile=ROUTE_PROFILE):
+    """A copy of `day` with `stops` reordered using the given travel matrices."""
+    day = dict(day)
+    activities = day["activities"] = dict(day.get("activities", {}))
+    coords = _stop_coords(stops)
+
+    route = []
+    anchor = None
+    for part in DAY_PARTS:
+        members = [k for k, stop in enumerate(stops) if stop["part"] == part]
+        if not members:
+            continue
+        nodes = ([anchor] if anchor is not None else []) + members
+        order = [nodes[k] for k in solve_path(durations[np.ix_(nodes, nodes)])]
+        if anchor is not None:
+            order = order[1:]
+
+        # Put this part's stops back into the slots they occupied, in the new order
+        slots = [stops[k]["index"] for k in members]
+        items = list(activities[part])
+        for slot, k in zip(slots, order):
+            items[slot] = stops[k]["text"]
+        activities[part] = items
+
+        route.extend(order)
+        anchor = order[-1]
+
+    legs = []
+    for a, b in zip(route, route[1:]):
+        legs.append({
+            "from": stops[a]["place"]["name"],
+            "to": stops[b]["place"]["name"],
+            "distance_km": round(float(distances[a, b]) / 1000, 2),
+            "duration_min": round(float(durations[a, b]) / 60, 1)
+        })
+    day["route"] = {
+        "profile": profile,
+        "source": source,
+        "stops": [
+            {"name": stops[k]["place"]["name"], "part": stops[k]["part"],
+             "lat": coords[k][0], "lng": coords[k][1]}
+            for k in route
+        ],
+        "legs": legs,
+        "total_distance_km": round(sum(leg["distance_km"] for leg in legs), 2),
+        "total_duration_min": round(sum(leg["duration_min"] for leg in legs), 1)
+    }
+    return day
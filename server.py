@@ -1,9 +1,28 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context, url_for, g
 from flask_cors import CORS  # import CORS
-from supabase import create_client, Client
-from ai_functions import get_location_info, create_structured_itinerary
+from ai_functions import (get_location_info, get_places_by_type, create_structured_itinerary, stream_structured_itinerary,
+                          get_stream_stats, get_llm_cache_stats, get_scheduler_stats, get_edit_prompt_stats,
+                          apply_modification, llm_scheduler, model_warmup, normalize_place_name)
+from itinerary_edits import EditError, InvalidEditTarget
+from prompt_builder import PromptTooLarge
+from llm_scheduler import AdmissionError
+from cache import MISSING, LRUCache, cache_stats
+from singleflight import flight_stats
+from http_client import http_stats
+from itinerary_store import VersionConflict, create_itinerary_store
+from log_shipper import create_log_handler
+import json_codec
+import metrics
+from clients import LazyClient, supabase
+import storage_codec
+from metrics import span
+from jobs import JobRunner, QueueFullError, create_job_store
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import os
 import uuid
+import hashlib
+import threading
+import time
 import json
 from datetime import datetime, timedelta
 import logging
@@ -11,40 +30,48 @@ import logging
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
 
 app = Flask(__name__)
+app.json = json_codec.FastJSONProvider(app)
 CORS(app)
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-# Setup Supabase connection
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# The Supabase client is shared and only created on first use
+itinerary_store = create_itinerary_store(supabase)
 
-def json_serialize(obj):
-    """
-    Custom JSON serializer to handle non-serializable objects
-    """
-    try:
-        return json.dumps(obj)
-    except TypeError:
-        # If standard serialization fails, convert to string
-        return str(obj)
+REQUIRED_FIELDS = ['destination', 'budget', 'arrival_date', 'duration', 'people', 'shelter', 'activities']
 
-def log_to_supabase(log_message: str):
-    try:
-        print(f"Attempting to log: {log_message}")
-        # Generate a UUID for user_id
-        log_user_id = str(uuid.uuid4())
-        response = supabase.table('logs').insert({
-            "message": log_message,
-            "user_id": log_user_id  # Use a valid UUID
-        }).execute()
-        print(f"Supabase response: {response}")
-    except Exception as e:
-        print(f"Supabase log error: {str(e)}")
+# Error records from any logger are shipped to the Supabase 'logs' table in
+# batches from a background thread, so logging never blocks a request. The
+# handler is attached and its thread started by start_background_work().
+log_handler = create_log_handler(supabase)
+
+def log_to_supabase(log_message: str, level=logging.ERROR):
+    """Log at `level`; records at or above LOG_SHIP_LEVEL are shipped."""
+    logging.log(level, log_message)
 
 @app.route('/')
 def health_check():
     return jsonify({"status": "healthy", "message": "API is running"})
 
+@app.route('/ready')
+def readiness_check():
+    """503 until the model is loaded, then 200; / only says the process is up.
+
+    Also starts the warm-up if nothing has yet (e.g. under a WSGI server,
+    where the __main__ block doesn't run), or retries one that failed.
+    """
+    model_warmup.start()
+    status = model_warmup.status()
+    if model_warmup.ready:
+        return jsonify({"status": "ready", "model": status})
+    return jsonify({"status": "not_ready", "model": status}), 503
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    stats = cache_stats()
+    stats["llm_call_sites"] = get_llm_cache_stats()
+    stats["single_flight"] = flight_stats()
+    with _itinerary_cache_lock:
+        stats["itinerary_reads"] = dict(itinerary_cache_stats, entries=len(itinerary_cache))
+    return jsonify(stats)
 
 
 # Add these routes to server.py
@@ -113,41 +140,141 @@ def get_session():
 def gather_user_info():
     data = request.get_json()
     if data:
-        log_to_supabase(f"User info gathered: {data}")
+        log_to_supabase("User info gathered", logging.INFO)
         return jsonify({"status": "success", "message": "User info gathered successfully"})
     else:
-        log_to_supabase("Failed to gather user info")
+        log_to_supabase("Failed to gather user info", logging.INFO)
         return jsonify({"status": "error", "message": "Failed to gather user info"}), 400
 
-@app.route('/api/itinerary', methods=['POST'])
-def generate_itinerary():
-    logging.info("Received a request for itinerary generation")
+class ItineraryError(Exception):
+    """A failed itinerary pipeline run, with the HTTP status to report it with."""
 
-    try:
-        data = request.get_json()
-        logging.debug(f"Request data: {data}")
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
 
-        if not data:
-            logging.error("Empty or invalid JSON payload received")
-            return jsonify({"error": "Invalid request data"}), 400
+def missing_field(user_info):
+    """The first required field missing from user_info, or None."""
+    for field in REQUIRED_FIELDS:
+        if field not in user_info or not user_info[field]:
+            return field
+    return None
+
+def resolve_location(destination):
+    # Get real location info 
+    try:
+        location_info = get_location_info(destination) 
+        if not location_info:
+            log_to_supabase(f"Location info fetch failed for: {destination}", logging.INFO)
+            location_info = {"name": destination}
     except Exception as e:
-        logging.exception("Error parsing JSON request")
-        return jsonify({"error": "Invalid JSON format"}), 400
+        log_to_supabase(f"Location info error: {str(e)}")
+        location_info = {"name": destination}
+    return location_info
 
-    logging.info("Calling AI to generate structured itinerary...")
-    response_data = create_structured_itinerary(data)
+def run_itinerary_pipeline(user_info, progress=None):
+    """Geocode, generate and store an itinerary.
 
+    Returns (id, itinerary, encoded), where `encoded` is the itinerary's
+    JSON as stored. `progress`, if given, is called with the name of each stage as it starts.
+    Raises ItineraryError if the itinerary can't be created or stored.
+    """
+    progress = progress or (lambda stage: None)
+    destination = user_info.get('destination', 'Unknown Destination')
+    itinerary_id = str(uuid.uuid4())
 
-    
-    print("Full request headers:", request.headers)
-    print("Request content type:", request.content_type)
+    progress("geocoding")
+    with span("geocode"):
+        location_info = resolve_location(destination)
+
+    # Create the itinerary using AI 
     try:
-        # Explicitly log the incoming request data
-        raw_data = request.get_data(as_text=True)
-        print(f"Received raw data: {raw_data}")
+        logging.info("Calling Llama 3.2 to generate itinerary...")
+        itinerary_data = create_structured_itinerary(user_info, location_info, progress=progress)
+        logging.debug("Generated itinerary: %s day(s)", len(itinerary_data.get("days", [])))
+    except AdmissionError:
+        raise
+    except Exception as e:
+        error_msg = f"Failed to create itinerary: {str(e)}"
+        log_to_supabase(error_msg)
+        raise ItineraryError(error_msg)
 
-        
-        
+    # Encoded once here; the same bytes are stored and sent back
+    try:
+        encoded = json_codec.dumps(itinerary_data)
+        itinerary_bytes.observe(len(encoded))
+    except TypeError as e:
+        error_msg = f"Itinerary data not JSON serializable: {str(e)}"
+        print(error_msg)
+        raise ItineraryError(error_msg)
+
+    # Store in Supabase 
+    progress("saving")
+    try:
+        with span("supabase_insert"):
+            itinerary_store.create(itinerary_data, itinerary_id=itinerary_id, encoded=encoded)
+    except Exception as e:
+        error_msg = f"Failed to store itinerary in Supabase: {str(e)}"
+        log_to_supabase(error_msg)
+        print(error_msg)  # Add print for immediate visibility
+        raise ItineraryError(error_msg)
+
+    return itinerary_id, itinerary_data, encoded
+
+def itinerary_job(user_info, progress):
+    itinerary_id, itinerary_data, _ = run_itinerary_pipeline(user_info, progress)
+    return {"id": itinerary_id, "itinerary": itinerary_data}
+
+# Itinerary jobs for POST /api/itinerary?async=true. Generation runs on this
+# bounded pool instead of holding an HTTP worker for the whole run.
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+def get_job_runner():
+    """The job runner, created on first use so importing server doesn't open the job store."""
+    global _job_runner
+    if _job_runner is None:
+        with _job_runner_lock:
+            if _job_runner is None:
+                _job_runner = JobRunner(
+                    create_job_store(),
+                    itinerary_job,
+                    max_workers=int(os.getenv("JOB_WORKERS", 4)),
+                    max_queued=int(os.getenv("JOB_QUEUE_SIZE", 100))
+                )
+    return _job_runner
+
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_work():
+    """Ship logs and requeue jobs left by a previous process, once per process.
+
+    Runs before the first request (or from __main__), not on import.
+    """
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    logging.getLogger().addHandler(log_handler)
+    log_handler.start()
+    get_job_runner().resume()
+
+@app.before_request
+def start_background_on_first_request():
+    start_background_work()
+
+def wants_async():
+    """True if the client asked for a job instead of waiting for the itinerary."""
+    return (request.args.get('async', '').lower() in ('1', 'true', 'yes')
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+@app.route('/api/itinerary', methods=['POST'])
+def generate_itinerary():
+    logging.info("Received a request for itinerary generation")
+    try:
         # Try parsing JSON with error handling
         try:
             user_info = request.get_json(force=True)
@@ -167,86 +294,42 @@ def generate_itinerary():
             }), 400
 
         # Required field validation
-        required_fields = ['destination', 'budget', 'arrival_date', 'duration', 'people', 'shelter', 'activities']
-        for field in required_fields:
-            if field not in user_info or not user_info[field]:
-                print(f"Missing required field: {field}")
-                return jsonify({
-                    "status": "error", 
-                    "message": f"Missing required field: {field}"
-                }), 400
-
-        # Rest of the code remains the same as in the previous artifact
-        destination = user_info.get('destination', 'Unknown Destination')
-        budget = user_info.get('budget', 'Unknown Budget')
-        itinerary_id = str(uuid.uuid4())
-
-        # Get real location info 
-        try:
-            location_info = get_location_info(destination) 
-            if not location_info:
-                log_to_supabase(f"Location info fetch failed for: {destination}")
-                location_info = {"name": destination}
-        except Exception as e:
-            log_to_supabase(f"Location info error: {str(e)}")
-            location_info = {"name": destination}
-
-        # Create the itinerary using AI 
-        try:
-            logging.info("Calling Llama 3.2 to generate itinerary...")
-            itinerary_data = create_structured_itinerary(user_info, location_info)
-            logging.debug(f"AI response: {itinerary_data}")
-        except Exception as e:
-            error_msg = f"Failed to create itinerary: {str(e)}"
-            log_to_supabase(error_msg)
-            logging.error(error_msg)
+        field = missing_field(user_info)
+        if field:
+            print(f"Missing required field: {field}")
             return jsonify({
                 "status": "error", 
-                "message": error_msg
-            }), 500
-
-        # Ensure itinerary_data is JSON serializable
-        try:
-            json.dumps(itinerary_data)
-        except TypeError as e:
-            error_msg = f"Itinerary data not JSON serializable: {str(e)}"
-            print(error_msg)
-            return jsonify({
-                "status": "error", 
-                "message": error_msg
-            }), 500
+                "message": f"Missing required field: {field}"
+            }), 400
 
-        # Store in Supabase 
-        try:
-            response = supabase.table('itineraries').insert({ 
-                "id": itinerary_id, 
-                "itinerary_data": json_serialize(itinerary_data),
-                "destination": destination, 
-                "budget": budget, 
-                "created_at": datetime.now().isoformat() 
-            }).execute()
-        except Exception as e:
-            error_msg = f"Failed to store itinerary in Supabase: {str(e)}"
-            log_to_supabase(error_msg)
-            print(error_msg)  # Add print for immediate visibility
+        if wants_async():
+            try:
+                job_id = get_job_runner().submit(user_info)
+            except QueueFullError as e:
+                return jsonify({
+                    "status": "error",
+                    "message": "Too many itineraries in progress, please retry shortly"
+                }), 429, {"Retry-After": str(e.retry_after)}
+            status_url = url_for('get_itinerary_job', job_id=job_id)
             return jsonify({
-                "status": "error", 
-                "message": error_msg
-            }), 500
+                "status": "accepted",
+                "job_id": job_id,
+                "status_url": status_url
+            }), 202, {"Location": status_url}
 
-        # Return a consistent JSON response with debug info
-        response_data = { 
-            "status": "success",
-            "id": itinerary_id, 
-            "itinerary": itinerary_data 
-        }
+        itinerary_id, itinerary_data, encoded = run_itinerary_pipeline(user_info)
 
-        print(f"Full response data: {response_data}")
-        print(f"Itinerary data type: {type(itinerary_data)}")
-        print(f"Itinerary data keys: {itinerary_data.keys() if isinstance(itinerary_data, dict) else 'Not a dictionary'}")
-        print(f"Returning response: {json.dumps(response_data)}")
-        return jsonify(response_data)
+        # The itinerary's stored bytes are spliced in rather than encoded again
+        body = json_codec.envelope({"status": "success", "id": itinerary_id}, itinerary=encoded)
+        return Response(body, mimetype='application/json')
 
+    except ItineraryError as e:
+        return jsonify({
+            "status": "error", 
+            "message": e.message
+        }), e.status
+    except AdmissionError as e:
+        return model_busy(e.retry_after)
     except Exception as e:
         error_msg = f"Unexpected error creating itinerary: {str(e)}"
         print(error_msg)
@@ -255,25 +338,308 @@ def generate_itinerary():
             "status": "error", 
             "message": error_msg
         }), 500
+
+# Batch generation for partners that submit many trips at once. Each city in
+# a batch is geocoded and searched for places once, and at most BATCH_WORKERS
+# itineraries are generated at a time across all batches. Finished trips are
+# stored together once BATCH_FLUSH_ROWS of them are waiting or the oldest has
+# waited BATCH_FLUSH_SECONDS, and when the batch ends.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
+BATCH_FLUSH_ROWS = int(os.getenv("BATCH_FLUSH_ROWS", 20))
+BATCH_FLUSH_SECONDS = float(os.getenv("BATCH_FLUSH_SECONDS", 2))
+batch_executor = LazyClient(
+    lambda: ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_WORKERS", 4)), thread_name_prefix="batch")
+)
+
+def prepare_destination(destination):
+    """Location and every nearby place for a city, shared by a batch's trips to it."""
+    with span("geocode"):
+        location_info = resolve_location(destination)
+    places = {}
+    if location_info.get('lat') and location_info.get('lng'):
+        with span("place_lookup"):
+            places = get_places_by_type(location_info['lat'], location_info['lng'])
+    return location_info, places
+
+def batch_itinerary(user_info, destination_future):
+    # The city's lookup was submitted before any of its trips, so it is
+    # already running or done by the time a worker gets here
+    location_info, places = destination_future.result()
+    itinerary_data = create_structured_itinerary(user_info, location_info, places=places)
+    encoded = json_codec.dumps(itinerary_data)
+    itinerary_bytes.observe(len(encoded))
+    return itinerary_data, encoded
+
+@app.route('/api/itineraries/batch', methods=['POST'])
+def generate_itinerary_batch():
+    """Generate many itineraries and stream each one back as it finishes.
+
+    Takes a JSON array of POST /api/itinerary bodies and answers with NDJSON,
+    one line per trip in completion order: {"index", "status": "success",
+    "id", "itinerary"} or {"index", "status": "error", "message"}. The last
+    line is {"status": "done"} with counts. Finished itineraries are buffered
+    and stored with one insert per table for each flush (see
+    BATCH_FLUSH_ROWS); a trip's success line is only sent once it is stored.
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        return jsonify({
+            "status": "error",
+            "message": "Expected a JSON array of itinerary requests"
+        }), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({
+            "status": "error",
+            "message": f"At most {BATCH_MAX_ITEMS} itineraries per batch"
+        }), 413
+
+    def line(data, **encoded):
+        return json_codec.envelope(data, **encoded) + b"\n"
+
+    def store(finished, counts):
+        try:
+            with span("supabase_insert"):
+                itinerary_store.create_many([itinerary_data for _, _, itinerary_data, _ in finished],
+                                            encoded=[encoded for _, _, _, encoded in finished],
+                                            ids=[itinerary_id for _, itinerary_id, _, _ in finished])
+        except Exception as e:
+            error_msg = f"Failed to store itinerary in Supabase: {str(e)}"
+            log_to_supabase(error_msg)
+            counts["failed"] += len(finished)
+            for index, _, _, _ in finished:
+                yield line({"index": index, "status": "error", "message": error_msg})
+            return
+        counts["succeeded"] += len(finished)
+        for index, itinerary_id, _, encoded in finished:
+            yield line({"index": index, "status": "success", "id": itinerary_id}, itinerary=encoded)
+
+    def generate():
+        started = time.perf_counter()
+        counts = {"succeeded": 0, "failed": 0}
+        destinations = {}
+        pending = {}
+        try:
+            for index, user_info in enumerate(items):
+                field = missing_field(user_info) if isinstance(user_info, dict) else "destination"
+                if field:
+                    counts["failed"] += 1
+                    yield line({"index": index, "status": "error", "message": f"Missing required field: {field}"})
+                    continue
+                key = normalize_place_name(user_info['destination'])
+                if key not in destinations:
+                    destinations[key] = batch_executor.submit(prepare_destination, user_info['destination'])
+                pending[batch_executor.submit(batch_itinerary, user_info, destinations[key])] = index
+
+            buffered = []
+            flush_at = None
+            while pending or buffered:
+                done = ()
+                if pending:
+                    timeout = max(flush_at - time.perf_counter(), 0) if buffered else None
+                    done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future)
+                    try:
+                        itinerary_data, encoded = future.result()
+                    except AdmissionError as e:
+                        counts["failed"] += 1
+                        yield line({"index": index, "status": "error", "retry_after": e.retry_after,
+                                    "message": "The itinerary model is busy, please retry shortly"})
+                        continue
+                    except Exception as e:
+                        counts["failed"] += 1
+                        error_msg = f"Failed to create itinerary: {str(e)}"
+                        log_to_supabase(error_msg)
+                        yield line({"index": index, "status": "error", "message": error_msg})
+                        continue
+                    if not buffered:
+                        flush_at = time.perf_counter() + BATCH_FLUSH_SECONDS
+                    buffered.append((index, str(uuid.uuid4()), itinerary_data, encoded))
+
+                if buffered and (not pending or len(buffered) >= BATCH_FLUSH_ROWS
+                                 or time.perf_counter() >= flush_at):
+                    yield from store(buffered, counts)
+                    buffered = []
+
+            yield line({
+                "status": "done",
+                "succeeded": counts["succeeded"],
+                "failed": counts["failed"],
+                "destinations": len(destinations),
+                "seconds": round(time.perf_counter() - started, 3)
+            })
+        finally:
+            # The client went away; don't generate what nobody will read
+            for future in pending:
+                future.cancel()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/api/itinerary/jobs/<job_id>', methods=['GET'])
+def get_itinerary_job(job_id):
+    job = get_job_runner().get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({
+        "job_id": job["id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"]
+    })
     
 
 
+def model_busy(retry_after):
+    """429 response for a generation the scheduler turned away."""
+    return jsonify({
+        "status": "error",
+        "message": "The itinerary model is busy, please retry shortly"
+    }), 429, {"Retry-After": str(retry_after)}
+
+@app.route('/api/http/stats', methods=['GET'])
+def get_http_stats():
+    """Requests, retries and connection reuse for each external service."""
+    return jsonify(http_stats())
+
+@app.route('/api/llm/stats', methods=['GET'])
+def get_llm_stats():
+    """Generation slots in use, queue depth, and queue wait vs generation time per priority."""
+    return jsonify(get_scheduler_stats())
+
+@app.route('/api/llm/edit_prompts', methods=['GET'])
+def get_edit_prompts():
+    """Edit prompt tokens prefilled and saved by continued conversations, plus the latest calls."""
+    return jsonify(get_edit_prompt_stats())
+
+def sse_event(event, data):
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json_codec.dumps_str(data)}\n\n"
+
+@app.route('/api/itinerary/stream', methods=['GET', 'POST'])
+def stream_itinerary():
+    """Generate an itinerary and stream it back as server-sent events.
+
+    Takes the same fields as POST /api/itinerary, either as a JSON body or,
+    so EventSource can be used, as query parameters. Events are "itinerary"
+    (trip details), one "day" per day as soon as it is generated, "tips",
+    then "done" with the stored id and timings, or "error".
+    """
+    user_info = request.get_json(silent=True) or request.args.to_dict()
+    field = missing_field(user_info)
+    if field:
+        return jsonify({
+            "status": "error",
+            "message": f"Missing required field: {field}"
+        }), 400
+
+    # Once the stream has started the status code can't change, so turn the
+    # request away up front if the generation queue is already full
+    if not llm_scheduler.has_capacity():
+        return model_busy(llm_scheduler.retry_after)
+
+    destination = user_info['destination']
+    location_info = resolve_location(destination)
+
+    def generate():
+        try:
+            for event, data in stream_structured_itinerary(user_info, location_info):
+                if event != "complete":
+                    yield sse_event(event, data)
+                    continue
+
+                itinerary_id = itinerary_store.create(data["itinerary"])
+                logging.info(f"Streamed itinerary {itinerary_id}: {data['metrics']}")
+                yield sse_event("done", {"status": "success", "id": itinerary_id, "metrics": data["metrics"]})
+        except Exception as e:
+            error_msg = f"Failed to stream itinerary: {str(e)}"
+            log_to_supabase(error_msg)
+            yield sse_event("error", {"status": "error", "message": error_msg})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Don't let a reverse proxy hold events back
+    })
+
+@app.route('/api/itinerary/stream/stats', methods=['GET'])
+def get_itinerary_stream_stats():
+    return jsonify(get_stream_stats())
+
+# Serialized GET /api/itinerary/<id> responses, keyed by id. Entries are
+# dropped when the itinerary is updated through this process; the TTL bounds
+# how stale a copy can get when another worker did the update.
+itinerary_cache = LRUCache(max_entries=int(os.getenv("ITINERARY_CACHE_SIZE", 1000)))
+ITINERARY_CACHE_TTL = int(os.getenv("ITINERARY_CACHE_TTL", 300))
+itinerary_cache_stats = {"hits": 0, "misses": 0, "not_modified": 0}
+_itinerary_cache_lock = threading.Lock()
+# A marker per recent update, so a read that started before it doesn't cache
+# what it fetched. Markers only matter while such a read is in flight.
+_itinerary_updates = LRUCache(max_entries=int(os.getenv("ITINERARY_CACHE_SIZE", 1000)))
+ITINERARY_UPDATE_MARKER_TTL = 60
+
+def invalidate_itinerary(itinerary_id):
+    with _itinerary_cache_lock:
+        _itinerary_updates.set(itinerary_id, object(), ITINERARY_UPDATE_MARKER_TTL)
+        itinerary_cache.delete(itinerary_id)
+
+def itinerary_etag(itinerary_id, version, body):
+    """Weak ETag from the stored version, the same in every worker.
+
+    Rows from before versions existed fall back to a hash of the body.
+    """
+    return f"{itinerary_id}-v{version}" if version else hashlib.sha256(body).hexdigest()
+
+def _count_itinerary_read(field):
+    with _itinerary_cache_lock:
+        itinerary_cache_stats[field] += 1
+
+def itinerary_response(body, etag):
+    """200 with the cached body, or 304 if the client already has this version."""
+    if request.if_none_match.contains_weak(etag):
+        _count_itinerary_read("not_modified")
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    # Clients may keep a copy but must revalidate it before every use
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/itinerary/<itinerary_id>', methods=['GET'])
 def get_itinerary(itinerary_id):
     try:
+        cached = itinerary_cache.get(itinerary_id)
+        if cached is not MISSING:
+            _count_itinerary_read("hits")
+            return itinerary_response(*cached)
+        _count_itinerary_read("misses")
+        with _itinerary_cache_lock:
+            last_update = _itinerary_updates.get(itinerary_id)
+
         print(f"Attempting to get itinerary with ID: {itinerary_id}")
         # Fetch the itinerary from Supabase
-        response = supabase.table('itineraries').select('itinerary_data').eq('id', itinerary_id).execute()
-        
-        print(f"Response from Supabase: {response}")
-        
+        with span("supabase_fetch"):
+            response = supabase.table('itineraries').select(
+                'itinerary_data::text, version'
+            ).eq('id', itinerary_id).execute()
+
         if not response.data or len(response.data) == 0:
             return jsonify({"error": "Itinerary not found"}), 404
             
-        # Access the itinerary_data directly without parsing
-        itinerary_data = json.loads(response.data[0]['itinerary_data'])
+        # Cast to text, a jsonb row also comes back as the JSON to send and
+        # isn't parsed; only compressed rows are decoded and encoded here
+        body = storage_codec.to_json(response.data[0]['itinerary_data'])
+
+        etag = itinerary_etag(itinerary_id, response.data[0].get('version'), body)
+        with _itinerary_cache_lock:
+            if _itinerary_updates.get(itinerary_id) is last_update:
+                itinerary_cache.set(itinerary_id, (body, etag), ITINERARY_CACHE_TTL)
         
-        return jsonify(itinerary_data)
+        return itinerary_response(body, etag)
         
     except Exception as e:
         error_msg = f"Error retrieving itinerary: {str(e)}"
@@ -281,6 +647,27 @@ def get_itinerary(itinerary_id):
         log_to_supabase(error_msg)
         return jsonify({"error": error_msg}), 500
 
+@app.route('/api/itinerary/<itinerary_id>/versions', methods=['GET'])
+def get_itinerary_versions(itinerary_id):
+    try:
+        return jsonify(itinerary_store.history(itinerary_id))
+    except Exception as e:
+        error_msg = f"Error retrieving itinerary history: {str(e)}"
+        log_to_supabase(error_msg)
+        return jsonify({"error": error_msg}), 500
+
+@app.route('/api/itinerary/<itinerary_id>/versions/<int:version>', methods=['GET'])
+def get_itinerary_version(itinerary_id, version):
+    try:
+        itinerary = itinerary_store.load_version(itinerary_id, version)
+        if itinerary is None:
+            return jsonify({"error": "Itinerary version not found"}), 404
+        return jsonify(itinerary)
+    except Exception as e:
+        error_msg = f"Error retrieving itinerary version: {str(e)}"
+        log_to_supabase(error_msg)
+        return jsonify({"error": error_msg}), 500
+
 @app.route('/api/itinerary/<itinerary_id>', methods=['PUT'])
 def update_itinerary(itinerary_id):
     try:
@@ -303,55 +690,44 @@ def update_itinerary(itinerary_id):
             
         # Fetch existing itinerary with proper error handling
         try:
-            response = supabase.table('itineraries').select('*').eq('id', itinerary_id).execute()
-            if not response.data:
+            current_itinerary, version = itinerary_store.load(itinerary_id)
+            if current_itinerary is None:
                 return jsonify({"error": "Itinerary not found"}), 404
-            current_data = response.data[0]
+        except json.JSONDecodeError as parse_error:
+            return jsonify({"error": f"Stored itinerary is invalid: {str(parse_error)}"}), 400
         except Exception as fetch_error:
             log_to_supabase(f"Fetch error: {str(fetch_error)}")
             return jsonify({"error": "Database error"}), 500
 
-        # Build AI prompt with validation
+        # Only the days and sections the request touches are regenerated
         try:
-            current_itinerary = json.loads(current_data['itinerary_data'])
-            update_prompt = f"""
-            CURRENT ITINERARY:
-            {json.dumps(current_itinerary, indent=2)}
-            
-            USER MODIFICATION REQUEST:
-            {data['modification']}
-            
-            RULES:
-            1. Maintain valid JSON structure
-            2. Keep existing correct information
-            3. Only use real locations from original data
-            4. Preserve all original fields
-            """
-        except Exception as prompt_error:
-            return jsonify({"error": f"Prompt construction failed: {str(prompt_error)}"}), 400
-
-        # Get AI response with error handling
-        try:
-            from ai_functions import get_ai_response
-            ai_response = get_ai_response(update_prompt)
-            updated_itinerary = json.loads(ai_response)
-        except json.JSONDecodeError:
-            return jsonify({"error": "AI returned invalid JSON"}), 500
+            with span("edit"):
+                updated_itinerary, patch = apply_modification(current_itinerary, data['modification'],
+                                                              itinerary_id, version)
+            logging.info(f"Itinerary {itinerary_id} edit touched {len(patch)} field(s)")
+        except AdmissionError as e:
+            return model_busy(e.retry_after)
+        except InvalidEditTarget as invalid_target:
+            return jsonify({"error": str(invalid_target)}), 400
+        except PromptTooLarge as too_large:
+            return jsonify({"error": str(too_large)}), 413
+        except EditError as edit_error:
+            return jsonify({"error": f"AI returned an unusable edit: {str(edit_error)}"}), 500
         except Exception as ai_error:
             return jsonify({"error": f"AI processing failed: {str(ai_error)}"}), 500
 
-        # Update database with proper error handling
+        # Record the edit as a delta, then move the current row on to it
         try:
-            update_response = supabase.table('itineraries').update({
-                "itinerary_data": json.dumps(updated_itinerary),
-                "updated_at": datetime.now().isoformat()
-            }).eq('id', itinerary_id).execute()
-            
-            if not update_response.data:
-                return jsonify({"error": "Update failed"}), 500
-                
-            return jsonify(updated_itinerary)
+            encoded = json_codec.dumps(updated_itinerary)
+            with span("supabase_upsert"):
+                itinerary_store.save(itinerary_id, updated_itinerary, previous=current_itinerary,
+                                     version=version, patch=patch, encoded=encoded)
+            invalidate_itinerary(itinerary_id)
+            return Response(encoded, mimetype='application/json')
             
+        except VersionConflict as conflict:
+            # Edited concurrently from the same version; the client reloads and retries
+            return jsonify({"error": str(conflict)}), 409
         except Exception as db_error:
             log_to_supabase(f"Database update error: {str(db_error)}")
             return jsonify({"error": "Database update failed"}), 500
@@ -360,12 +736,61 @@ def update_itinerary(itinerary_id):
         log_to_supabase(f"Global update error: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
     
+# Request-level metrics. Stage spans come from metrics.span in the pipeline;
+# with SERVER_TIMING=1 each response also lists them in a Server-Timing header.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "").lower() in ("1", "true", "yes")
+request_seconds = metrics.histogram(
+    "nexplan_http_request_seconds", "HTTP request latency", labelnames=("endpoint", "method", "status")
+)
+response_bytes = metrics.histogram(
+    "nexplan_http_response_bytes", "HTTP response body size",
+    buckets=metrics.SIZE_BUCKETS, labelnames=("endpoint",)
+)
+itinerary_bytes = metrics.histogram(
+    "nexplan_itinerary_bytes", "Serialized size of generated itineraries", buckets=metrics.SIZE_BUCKETS
+)
+metrics.gauge("nexplan_llm_active", "Generations running", lambda: get_scheduler_stats()["active"])
+metrics.gauge("nexplan_llm_queued", "Generations waiting for a slot", lambda: get_scheduler_stats()["queued"])
+metrics.gauge(
+    "nexplan_cache_hit_ratio", "Hit ratio per cache",
+    lambda: {name: stats["hit_ratio"] for name, stats in cache_stats().items()}, labelnames=("cache",)
+)
+metrics.gauge(
+    "nexplan_upstream_connections_opened", "TCP connections opened per external service",
+    lambda: {name: stats["connections_opened"] for name, stats in http_stats().items()}, labelnames=("service",)
+)
+metrics.gauge(
+    "nexplan_log_records", "Log records by shipping outcome",
+    lambda: log_handler.stats(), labelnames=("outcome",)
+)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.request_spans = metrics.start_request()
+
 @app.after_request
 def add_headers(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
     response.headers['Access-Control-Allow-Methods'] = 'GET,PUT,POST,DELETE,OPTIONS'
+
+    if 'request_spans' in g:
+        elapsed = time.perf_counter() - g.request_started
+        spans = metrics.finish_request(g.pop('request_spans'))
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+        if response.content_length is not None:
+            response_bytes.observe(response.content_length, endpoint=endpoint)
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = metrics.server_timing(spans, elapsed)
     return response
 
 if __name__ == '__main__':
+    start_background_work()
+    model_warmup.start()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,107 @@
+# singleflight.py
+import asyncio
+import threading
+from concurrent.futures import Future
+
+# Every SingleFlight registers itself here so stats can be reported in one place
+_groups = {}
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one upstream call.
+
+    The first caller for a key runs the function. Callers that arrive while
+    it is still running wait for it and get the same result, or the same
+    exception. Nothing is remembered once the call finishes; that's what the
+    caches are for.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._stats = {"calls": 0, "shared": 0}
+        _groups[name] = self
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = Future()
+                self._stats["calls"] += 1
+            else:
+                self._stats["shared"] += 1
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._in_flight)
+        return stats
+
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight for coroutines: callers await the leader's result.
+
+    The call runs in its own task, so a caller that is cancelled (a
+    timeout, a client that went away) only stops waiting; the others still
+    get the result. The call itself is cancelled once nobody is waiting for
+    it any more. Must only be used from one event loop.
+    """
+
+    async def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = _AsyncCall(asyncio.get_running_loop().create_task(fn()))
+                call.task.add_done_callback(lambda _: self._forget(key, call))
+                self._stats["calls"] += 1
+            else:
+                self._stats["shared"] += 1
+            call.waiters += 1
+
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            with self._lock:
+                call.waiters -= 1
+                abandoned = call.waiters == 0 and not call.task.done()
+                if abandoned:
+                    self._forget_locked(key, call)
+            if abandoned:
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        with self._lock:
+            self._forget_locked(key, call)
+
+    def _forget_locked(self, key, call):
+        # A later call for the key may already have replaced this one
+        if self._in_flight.get(key) is call:
+            del self._in_flight[key]
+
+
+class _AsyncCall:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+def flight_stats():
+    """Upstream calls made and calls that piggybacked on them, per group."""
+    return {name: group.stats() for name, group in _groups.items()}
@@ -0,0 +1,200 @@
+# storage_codec.py
+"""How itineraries are stored in the itinerary_data column.
+
+Three formats, picked with ITINERARY_STORAGE_FORMAT:
+
+    text        the itinerary as a JSON string, as rows have always been
+                written. Works with the original text column.
+    jsonb       the itinerary as a JSON object. With the column converted
+                to jsonb the database can filter and index on its content,
+                e.g. itinerary_data->>'destination' or (itinerary_data->>'duration')::int,
+                and reads skip parsing a JSON string inside the response.
+    compressed  msgpack packed and zstd compressed, base64 encoded as
+                {"msgpack+zstd": "<data>"}. Several times smaller, for
+                archival rows; needs the msgpack and zstandard packages.
+
+Reads accept all three whatever the setting, so rows in different
+formats can live side by side. To move existing rows to another format:
+
+    python storage_codec.py migrate --to jsonb
+    python storage_codec.py migrate --to compressed --older-than 90
+
+Converting the column itself is a one-off in the SQL editor; existing
+JSON strings become objects:
+
+    alter table itineraries alter column itinerary_data type jsonb using itinerary_data::jsonb;
+    create index if not exists itineraries_destination_idx on itineraries ((itinerary_data->>'destination'));
+"""
+import argparse
+import base64
+import os
+import time
+from datetime import datetime, timedelta
+
+import json_codec
+
+try:
+    import msgpack
+    import zstandard
+    COMPRESSION_AVAILABLE = True
+except ImportError:
+    COMPRESSION_AVAILABLE = False
+
+TEXT = "text"
+JSONB = "jsonb"
+COMPRESSED = "compressed"
+FORMATS = (TEXT, JSONB, COMPRESSED)
+
+# A compressed row is an object with this as its only key, so it fits a
+# text or jsonb column and can't be mistaken for an itinerary
+COMPRESSED_KEY = "msgpack+zstd"
+_COMPRESSED_PREFIX = '{"' + COMPRESSED_KEY + '"'
+
+ZSTD_LEVEL = int(os.getenv("ITINERARY_ZSTD_LEVEL", 9))
+
+
+def encode(itinerary, storage_format=TEXT, encoded=None):
+    """The itinerary_data value for an itinerary in the given format.
+
+    `encoded` is the itinerary's json_codec.dumps() bytes, if the caller
+    already has them; the text format stores them as they are.
+    """
+    if storage_format == TEXT:
+        return encoded.decode("utf-8") if encoded is not None else json_codec.dumps_str(itinerary)
+    if storage_format == JSONB:
+        return itinerary
+    if storage_format == COMPRESSED:
+        return {COMPRESSED_KEY: base64.b64encode(compress(itinerary)).decode("ascii")}
+    raise ValueError(f"Unknown itinerary storage format: {storage_format}")
+
+
+def decode(value):
+    """The itinerary stored in an itinerary_data value of any format."""
+    if isinstance(value, str):
+        value = json_codec.loads(value)
+    if _is_compressed(value):
+        return decompress(base64.b64decode(value[COMPRESSED_KEY]))
+    return value
+
+
+def to_json(value):
+    """The stored itinerary as JSON bytes for a response.
+
+    Text rows are already JSON and are sent without being parsed.
+    """
+    if format_of(value) == TEXT:
+        return value.encode("utf-8")
+    return json_codec.dumps(decode(value))
+
+
+def format_of(value):
+    if _is_compressed(value):
+        return COMPRESSED
+    return TEXT if isinstance(value, str) else JSONB
+
+
+def _is_compressed(value):
+    if isinstance(value, str):
+        # Only the start is looked at, so text rows aren't parsed to check
+        return value[:len(_COMPRESSED_PREFIX) + 16].lstrip().startswith(_COMPRESSED_PREFIX)
+    return isinstance(value, dict) and len(value) == 1 and COMPRESSED_KEY in value
+
+
+def compress(itinerary):
+    _require_compression()
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(msgpack.packb(itinerary, use_bin_type=True))
+
+
+def decompress(data):
+    _require_compression()
+    return msgpack.unpackb(zstandard.ZstdDecompressor().decompress(data), raw=False)
+
+
+def _require_compression():
+    if not COMPRESSION_AVAILABLE:
+        raise RuntimeError("Compressed itineraries need the msgpack and zstandard packages")
+
+
+def stored_size(value):
+    """Bytes the value takes in the request body, roughly its size in the row."""
+    return len(value.encode("utf-8")) if isinstance(value, str) else len(json_codec.dumps(value))
+
+
+def migrate(supabase, storage_format, batch_size=200, older_than=None, dry_run=False):
+    """Re-encode every itinerary not already in `storage_format`.
+
+    Rows are read in pages of `batch_size` by id. Each row's itinerary_data
+    is then updated only if the row is still at the version that was read,
+    so an edit saved in between is never overwritten; such rows are
+    counted as skipped and picked up by the next run. updated_at and the
+    version history are left alone. `older_than` (days) limits it to rows
+    created before then, e.g. to compress only archival trips. Returns
+    counts and total sizes before and after.
+    """
+    if storage_format not in FORMATS:
+        raise ValueError(f"Unknown itinerary storage format: {storage_format}")
+    cutoff = (datetime.now() - timedelta(days=older_than)).isoformat() if older_than else None
+    stats = {"scanned": 0, "migrated": 0, "skipped": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    last_id = None
+    while True:
+        query = supabase.table('itineraries').select('id, itinerary_data, version').order('id').limit(batch_size)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        if cutoff:
+            query = query.lt('created_at', cutoff)
+        rows = query.execute().data
+        if not rows:
+            return stats
+        last_id = rows[-1]['id']
+        stats["scanned"] += len(rows)
+
+        for row in rows:
+            value = row['itinerary_data']
+            if value is None or format_of(value) == storage_format:
+                continue
+            try:
+                new_value = encode(decode(value), storage_format)
+            except Exception as e:
+                print(f"Could not re-encode itinerary {row['id']}: {e}")
+                stats["failed"] += 1
+                continue
+            if not dry_run and not _update_at_version(supabase, row['id'], row.get('version'), new_value):
+                stats["skipped"] += 1
+                continue
+            stats["bytes_before"] += stored_size(value)
+            stats["bytes_after"] += stored_size(new_value)
+            stats["migrated"] += 1
+        print(f"{stats['scanned']} scanned, {stats['migrated']} re-encoded, {stats['skipped']} changed meanwhile")
+
+
+def _update_at_version(supabase, itinerary_id, version, value):
+    """Write itinerary_data if the row is still at `version`; False if it has moved on."""
+    query = supabase.table('itineraries').update({"itinerary_data": value}).eq('id', itinerary_id)
+    # Rows written before versions existed have none
+    query = query.eq('version', version) if version else query.is_('version', 'null')
+    return bool(query.execute().data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-encode stored itineraries")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_command = commands.add_parser("migrate", help="Move existing rows to another storage format")
+    migrate_command.add_argument("--to", dest="storage_format", choices=FORMATS, required=True)
+    migrate_command.add_argument("--batch-size", type=int, default=200)
+    migrate_command.add_argument("--older-than", type=int, metavar="DAYS",
+                                 help="Only rows created more than DAYS days ago")
+    migrate_command.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        from supabase import create_client
+        started = time.perf_counter()
+        stats = migrate(create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")), args.storage_format,
+                        batch_size=args.batch_size, older_than=args.older_than, dry_run=args.dry_run)
+        saved = stats["bytes_before"] - stats["bytes_after"]
+        print(f"{'Would re-encode' if args.dry_run else 'Re-encoded'} {stats['migrated']} of {stats['scanned']} "
+              f"itineraries to {args.storage_format} ({stats['skipped']} changed meanwhile, {stats['failed']} failed), "
+              f"{stats['bytes_before']} -> {stats['bytes_after']} bytes ({saved} saved) "
+              f"in {time.perf_counter() - started:.1f}s")